@@ -2,8 +2,10 @@ import xgboost as xgb
 import pandas as pd
 import numpy as np
 import time
+import metrics
 from pandas import to_datetime
 from datetime import datetime
+from patient_store import HISTORY_COLUMN_PAIRS
 
 def load_model(model_path):
     '''
@@ -18,29 +20,85 @@ def load_model(model_path):
     model.load_model(model_path)
     return model
 
-def aggregate_data(new_data, patient_history, last_hour_test_data):
+# XGBClassifier.predict reports AKI when the positive class probability is above 0.5
+DEFAULT_THRESHOLD = 0.5
+# predictions run at startup so the first message does not pay for lazy initialisation
+WARMUP_PREDICTIONS = 10
+
+class InferenceEngine:
+    '''
+    Description:
+        Low-latency AKI predictions from the raw XGBoost Booster. The model is loaded once and
+        predicts straight from a float32 feature row with in-place prediction, skipping the
+        sklearn wrapper's validation and the DMatrix conversion of every call.
+    '''
+
+    def __init__(self, model_path, threshold=DEFAULT_THRESHOLD, warmup=WARMUP_PREDICTIONS):
+        self.booster = xgb.Booster()
+        self.booster.load_model(model_path)
+        # one row at a time, a thread pool only adds overhead
+        self.booster.set_param({'nthread': 1})
+        self.threshold = threshold
+        self.num_features = self.booster.num_features()
+        self.warm(warmup)
+
+    def warm(self, rounds=WARMUP_PREDICTIONS):
+        '''run a few predictions on empty and typical rows, e.g. right after loading the model'''
+        rows = np.full((2, self.num_features), np.nan, dtype=np.float32)
+        rows[1, :4] = [60, 1, 100, 0]
+        for _ in range(rounds):
+            for i in range(len(rows)):
+                self.predict_proba(rows[i:i + 1])
+
+    def predict_proba(self, features):
+        '''
+        Description:
+            Probability of AKI for each feature row
+        input:
+            features: float32 numpy array (rows, num_features)
+        output:
+            probabilities: numpy array (rows,)
+        '''
+        return self.booster.inplace_predict(features, validate_features=False)
+
+    def predict(self, features):
+        '''1 for every feature row whose AKI probability is above the threshold, 0 otherwise'''
+        return (self.predict_proba(features) > self.threshold).astype(np.int64)
+
+def load_engine(model_path, threshold=DEFAULT_THRESHOLD):
+    '''
+    Description:
+        Load the pre-trained XGBoost model into a warmed up InferenceEngine
+    input:
+        model_path: STRING
+        threshold: FLOAT, AKI probability above which a patient is paged
+    output:
+        engine: InferenceEngine
+    '''
+    return InferenceEngine(model_path, threshold=threshold)
+
+@metrics.timed('update')
+def aggregate_data(new_data, patient_history, input_quantiles, now=None):
     '''
     Description:
         This function appends the new test date and result to the last non-NaN historical data
     input:
         new_data: DIC
         patient_history: pd DataFrame
-        last_hour_test_data: pd DataFrame
+        input_quantiles: RollingQuantiles of the recent test results
+        now: FLOAT epoch seconds the result was received at, default the current time
     output:
         combined_data: pd DataFrame
-        last_hour_test_data: pd DataFrame
-        median_last_hour_test_data: pd DataFrame
+        input_quantiles: RollingQuantiles
+        median_input: FLOAT, median of the test results in the window
     '''
     # get the new blood test date and result
     test_time = to_datetime(new_data['test_time'], format='%Y%m%d%H%M%S')
     test_result = float(new_data['test_result'])
 
-    # calculate the median of the test result in last an hour
-    current_time = datetime.now()
-    new_test_data = [test_result] + [current_time]
-    last_hour_test_data.loc[len(last_hour_test_data)] = new_test_data
-    last_hour_test_data = last_hour_test_data[last_hour_test_data['prediction_time'] > (current_time - pd.Timedelta(hours=1))]
-    median_last_hour_test_data = last_hour_test_data.iloc[:, :1].median().values[0]
+    # calculate the median of the recent test results
+    input_quantiles.add(test_result, now)
+    median_input = input_quantiles.median(now)
 
     # Add the new test result to the last non-NaN historical data
     creatinine_pairs_count = (len(patient_history.columns) - 2) // 2
@@ -55,15 +113,21 @@ def aggregate_data(new_data, patient_history, last_hour_test_data):
             patient_history.at[patient_history.index[0], result_col] = test_result
             break  # Only update the first NaN column and then exit the loop
 
-    # No NaN found, so add a new pair of columns
+    # No NaN found, so add a new pair of columns up to the width of the history layout
     else:
-        new_date_col_name = f'creatinine_date_{creatinine_pairs_count}'
-        new_result_col_name = f'creatinine_result_{creatinine_pairs_count}'
-        patient_history[new_date_col_name] = test_time
-        patient_history[new_result_col_name] = test_result
+        if creatinine_pairs_count < HISTORY_COLUMN_PAIRS:
+            new_date_col_name = f'creatinine_date_{creatinine_pairs_count}'
+            new_result_col_name = f'creatinine_result_{creatinine_pairs_count}'
+            patient_history[new_date_col_name] = test_time
+            patient_history[new_result_col_name] = test_result
+        # beyond it, drop the oldest pair instead of widening the frame for one busy patient
+        else:
+            values = patient_history.values[0].tolist()
+            values = values[:2] + values[4:] + [test_time, test_result]
+            patient_history = pd.DataFrame([values], columns=patient_history.columns, index=patient_history.index)
 
     combined_data = patient_history
-    return combined_data, last_hour_test_data, median_last_hour_test_data
+    return combined_data, input_quantiles, median_input
 
 def reverse_data(combined_data):
     '''
@@ -138,24 +202,17 @@ def create_test_data(combined_data, reversed_data):
         test_data[creatinine_date_col] = pd.to_datetime(test_data[creatinine_date_col], errors='coerce')
     return test_data
 
-def predict_aki(model, combined_data, prediction_rate_dic):
+@metrics.timed('features')
+def build_test_data(combined_data):
     '''
-    Description:    
-        Predict acute kidney injury (AKI) using an XGBoost model based on the provided patient data.
+    Description:
+        Build the model input row from the patient data
     input:
-        model: XGBoost model
         combined_data: pd DataFrame
-        prediction_rate_dic: DIC
     output:
-        prediction: np array
-        prediction_date: datetime
-        prediction_latency: FLOAT
-        prediction_rate_dic: DIC
+        test_data: pd DataFrame with the model's 12 feature columns
+        prediction_date: datetime of the most recent test
     '''
-    # Start the timer
-    start_time = time.time()
-
-
     # Reverse the data
     reversed_data = reverse_data(combined_data)
 
@@ -178,9 +235,41 @@ def predict_aki(model, combined_data, prediction_rate_dic):
 
     # Map age to numeric
     test_data['age'] = pd.to_numeric(test_data['age'], errors='coerce')
+    return test_data, prediction_date
+
+def update_prediction_rate(prediction, prediction_rate_dic):
+    '''
+    Description:
+        Count the predictions of one or more rows and update the share of positive predictions
+    '''
+    positive = int(np.count_nonzero(prediction == 1))
+    prediction_rate_dic["positive"] += positive
+    prediction_rate_dic["negative"] += len(prediction) - positive
+    prediction_rate_dic["rate"] = prediction_rate_dic["positive"] / (prediction_rate_dic["positive"] + prediction_rate_dic["negative"])
+    return prediction_rate_dic
+
+def predict_aki(model, combined_data, prediction_rate_dic):
+    '''
+    Description:    
+        Predict acute kidney injury (AKI) using an XGBoost model based on the provided patient data.
+    input:
+        model: XGBoost model
+        combined_data: pd DataFrame
+        prediction_rate_dic: DIC
+    output:
+        prediction: np array
+        prediction_date: datetime
+        prediction_latency: FLOAT
+        prediction_rate_dic: DIC
+    '''
+    # Start the timer
+    start_time = time.time()
+
+    test_data, prediction_date = build_test_data(combined_data)
 
     # Make the prediction using the model
-    prediction = model.predict(test_data)
+    with metrics.timed('predict'):
+        prediction = model.predict(test_data)
 
     # End the timer
     end_time = time.time()
@@ -189,11 +278,28 @@ def predict_aki(model, combined_data, prediction_rate_dic):
     prediction_latency = end_time - start_time
 
     # Update the prediction rate
-    if prediction[0] == 1:
-        prediction_rate_dic["positive"] += 1
-    else:
-        prediction_rate_dic["negative"] += 1
-    prediction_rate_dic["rate"] = prediction_rate_dic["positive"] / (prediction_rate_dic["positive"] + prediction_rate_dic["negative"])
+    prediction_rate_dic = update_prediction_rate(prediction, prediction_rate_dic)
         
     return prediction, prediction_date, prediction_latency, prediction_rate_dic
 
+def predict_features(model, features, prediction_rate_dic):
+    '''
+    Description:
+        Predict AKI from feature rows maintained by the PatientStore, e.g. a whole micro-batch
+        with one model call, without building a DataFrame
+    input:
+        model: InferenceEngine or XGBoost model
+        features: float32 numpy array of shape (rows, FEATURE_COLUMNS), in the column order of build_test_data
+        prediction_rate_dic: DIC
+    output:
+        prediction: np array with one prediction per row
+        prediction_latency: FLOAT, of the whole model call
+        prediction_rate_dic: DIC
+    '''
+    start_time = time.time()
+    with metrics.timed('predict'):
+        prediction = model.predict(features)
+    prediction_latency = time.time() - start_time
+    prediction_rate_dic = update_prediction_rate(prediction, prediction_rate_dic)
+    return prediction, prediction_latency, prediction_rate_dic
+
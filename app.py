@@ -1,38 +1,64 @@
 #!/usr/bin/env python3
 import warnings
-from listener import start_listener, receive_message, ack_message, close_connection
+from listener import start_listener, receive_message, ack_message, close_connection, control_id
+import ingestion
+import sharding
+import cluster
 from hl7_processor import parse_hl7_message, extract_mrn
-from data_processor import load_and_process_history, get_patient_history, update_patient_data
-from aki_detector import load_model, aggregate_data, predict_aki
-from pager_system import send_pager_message
+from data_processor import load_history_arrays
+from patient_store import PatientStore, HistoryBase, hl7_to_epoch, columns_from_history, sort_columns, DEFAULT_MAX_RESULTS, FEATURE_RESULTS
+from journal import Journal, replay as replay_journal, DEFAULT_COMMIT_INTERVAL
+from snapshot import Snapshotter, load_latest_snapshot, DEFAULT_SNAPSHOT_INTERVAL
+from history_compiler import ensure_compiled, open_history_base
+from history_index import open_lazy_history, default_memory_budget, DEFAULT_CACHE_PATIENTS
+from backfill import read_capture, backfill
+from aki_detector import load_engine, predict_features, DEFAULT_THRESHOLD
+from rolling_quantiles import RollingQuantiles, DEFAULT_WINDOW
+from pager_system import PagerDispatcher, PAGER_QUEUE_SIZE, PAGER_TIMEOUT
 from f3_evaluation import check_aki_detection_accuracy
 import argparse
+import numpy as np
 import pandas as pd
 import os
 import signal
 import sys
+import threading
 import time
-from prometheus_client import start_http_server
+from concurrent.futures import ThreadPoolExecutor
 import metrics
 
-# important global variable: for saving updating patients'data
-historical_data = None
+# important global variables: patients' data, the journal every update is written to before it is acknowledged,
+# and the snapshotter that periodically saves the data and truncates the journal
+patient_store = None
+patient_journal = None
+patient_snapshotter = None
+pager_dispatcher = None
+shard_workers = None
 
-def saving_csv_for_shutdown(signum, frame):
-    global historical_data
-    print("Received SIGTERM. saving data to csv file")
-    if not os.path.exists('/state'):
-        os.makedirs('/state')
-    historical_data.to_csv('/state/historical_data.csv', index=False)
+def close_journal_for_shutdown(signum, frame):
+    global patient_journal, pager_dispatcher, shard_workers
+    print("Received SIGTERM. flushing journal")
+    if patient_journal is not None:
+        patient_journal.close()
+    # workers only acknowledge durable records, stopping them flushes their journals
+    if shard_workers is not None:
+        sharding.stop_workers(shard_workers)
+    # pages not delivered in time are resent on the next start
+    if pager_dispatcher is not None:
+        pager_dispatcher.close()
     close_connection()
     sys.exit(0)
 
-def reload_csv_from_shutdown():
-    global historical_data
-    file_path = '/state/historical_data.csv'
+def reload_csv_from_shutdown(state_dir='/state'):
+    '''
+    Description:
+        Load the CSV dump written on SIGTERM by earlier versions, if there is one
+    '''
+    global patient_store
+    file_path = os.path.join(state_dir, 'historical_data.csv')
     if os.path.exists(file_path):
         print('load data from saved csv file')
-        historical_data = pd.read_csv(file_path)
+        patient_store = PatientStore.from_dataframe(pd.read_csv(file_path))
         return True
     else:
         return False
@@ -44,8 +70,292 @@ def parse_url(url):
         url = url[8:]
     return url
 
+def parse_stage_buckets(value):
+    '''
+    Description:
+        Parse a --stage_buckets value, a stage name and its histogram bucket upper bounds in seconds
+    input:
+        value: STRING, e.g. predict=0.0001,0.001,0.01
+    output:
+        (stage, bounds): STRING, tuple of FLOAT
+    '''
+    stage, _, bounds = value.partition('=')
+    if stage not in metrics.STAGE_BUCKETS:
+        raise argparse.ArgumentTypeError(f"unknown stage {stage!r}, expected one of {', '.join(metrics.STAGE_BUCKETS)}")
+    try:
+        return stage, tuple(float(bound) for bound in bounds.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'bucket bounds of {stage} must be comma separated seconds, got {bounds!r}')
+
+def prepare_message(message, state):
+    '''
+    Description:
+        Parse one HL7 message and update the patient data. Blood test results are not scored
+        yet, they return the model input to score with score_requests().
+    input:
+        message: bytes
+        state: DIC with the model, prediction rate, input quantiles and recorded predictions,
+            and optionally 'message_time' to age the input window by message time
+    output:
+        processed: BOOL, False if the message could not be parsed and must not be acknowledged
+        request: (mrn, features, prediction_date) for blood test results, None otherwise
+    '''
+    global patient_store, patient_journal, patient_snapshotter
+
+    # between two messages the store is consistent with the journal, snapshot it if due
+    patient_snapshotter.maybe_snapshot()
+
+    # Process the message
+    with metrics.timed('parse'):
+        parsed_data, type = parse_hl7_message(message)
+    if parsed_data is None or type is None:
+        return False, None
+
+    # extract mrn for the user
+    mrn = extract_mrn(parsed_data)
+
+    # if ADT (Admission, Discharge, Transfer), need to update current data
+    if type == "ADT":
+        if parsed_data['message_type'] == 'ADT^A01':
+            patient_journal.append_admit(mrn, parsed_data['date_of_birth'], parsed_data['sex'])
+            with metrics.timed('lookup'):
+                patient_store.add_patient(mrn)
+            with metrics.timed('update'):
+                patient_store.admit(mrn, parsed_data['date_of_birth'], parsed_data['sex'])
+        return True, None
+
+    # if ORU (Observation Result), update the patient's series and feature vector
+    metrics.BLOOD_TEST_RECEIVED.inc()
+    test_time = hl7_to_epoch(parsed_data['test_time'])
+    test_result = float(parsed_data['test_result'])
+    # the input quantile metrics are computed from the window when they are scraped. Replays
+    # set 'message_time' so the window follows the message timestamps instead of the wall clock
+    state['input_quantiles'].add(test_result, test_time if state.get('message_time') else None)
+    patient_journal.append_result(mrn, test_time, test_result)
+    # finding the patient's row reads a history patient from the base layer on its first message
+    with metrics.timed('lookup'):
+        patient_store.add_patient(mrn)
+    # appending the result also shifts it into the patient's feature row
+    with metrics.timed('update'):
+        patient_store.append_result(mrn, test_time, test_result)
+    with metrics.timed('features'):
+        # copy the row, a later message of the same batch may update the patient again
+        features = patient_store.feature_row(mrn).copy()
+    return True, (mrn, features, pd.Timestamp(test_time, unit='s'))
+
+def score_requests(requests, state):
+    '''
+    Description:
+        Predict AKI for prepared blood test results with one model call
+    input:
+        requests: list of (mrn, features, prediction_date) from prepare_message
+        state: DIC
+    output:
+        pages: list with (mrn, prediction_date) if AKI was detected, None otherwise, per request
+    '''
+    features = np.concatenate([request[1] for request in requests])
+    predictions, prediction_latency, state['prediction_rate_dic'] = predict_features(state['model'], features, state['prediction_rate_dic'])
+    metrics.PREDICTION_RATE.set(state['prediction_rate_dic']["rate"])
+    metrics.PREDICTION_LATENCY.set(prediction_latency)
+    metrics.PREDICTION_BATCH_SIZE.set(len(requests))
+    metrics.PREDICTION_BATCHES.inc()
+
+    pages = []
+    for (mrn, _, prediction_date), prediction in zip(requests, predictions):
+        # if detect aki
+        if prediction:
+            state['recorded_predictions'].append({'mrn': mrn, 'prediction_date': prediction_date})
+            pages.append((mrn, prediction_date))
+        else:
+            pages.append(None)
+    return pages
+
+def handle_message(message, state):
+    '''
+    Description:
+        Parse one HL7 message, update the patient data and, for blood test results, predict AKI
+    input:
+        message: bytes
+        state: DIC with the model, prediction rate, input quantiles and recorded predictions
+    output:
+        processed: BOOL, False if the message could not be parsed and must not be acknowledged
+        page: (mrn, prediction_date) if AKI was detected, None otherwise
+    '''
+    processed, request = prepare_message(message, state)
+    if request is None:
+        return processed, None
+    return True, score_requests([request], state)[0]
+
+def handle_batch(messages, state):
+    '''
+    Description:
+        Apply a micro-batch of messages in order and score all their blood test results with one model call
+    output:
+        results: list of (processed, page) per message, as handle_message returns them
+    '''
+    prepared = [prepare_message(message, state) for message in messages]
+    requests = [request for _, request in prepared if request is not None]
+    pages = iter(score_requests(requests, state) if requests else [])
+    return [(processed, next(pages) if request is not None else None) for processed, request in prepared]
+
+def run_serial(state, send_page):
+    '''
+    Description:
+        Original stop-and-wait loop: receive, process, page and acknowledge one message at a time
+    '''
+    while True:
+        message = receive_message()
+
+        # Start the timer
+        start_time = time.time()
+
+        if message is None:
+            print("No message received or connection closed, exiting loop.")
+            break  # Exit the loop if no message is received or connection is closed
+        metrics.MESSAGES_RECEIVED.inc()
+
+        processed, page = handle_message(message, state)
+        if not processed:
+            print("Parsing failed, skipping this message.")
+            continue
+
+        if page is not None:
+            send_page(*page)
+
+        # only acknowledge once the message's journal records are on disk
+        with metrics.timed('persist'):
+            patient_journal.wait_durable()
+        with metrics.timed('ack'):
+            ack_message(control_id(message))
+        metrics.MESSAGES_ACKNOWLEDGED.inc()
+
+        # End the timer
+        end_time = time.time()
+
+        # Calculate the latency
+        overall_latency = end_time - start_time
+        metrics.OVERALL_LATENCY.set(overall_latency)
+        metrics.observe('overall', overall_latency)
+
+def restore_state(history_path, compiled_history, state_dir, commit_interval, snapshot_interval, history_filter=None,
+                  lazy_history=False, cache_patients=DEFAULT_CACHE_PATIENTS, memory_budget=None,
+                  max_results=DEFAULT_MAX_RESULTS, max_age=None):
+    '''
+    Description:
+        Restore the patient store from the newest snapshot, falling back to the csv state of earlier
+        versions and then the history, re-apply the journal behind it and open the journal and snapshotter
+    input:
+        history_path: STRING
+        compiled_history: STRING or None, memory-map the history compiled into this directory
+        state_dir: STRING
+        commit_interval: FLOAT, seconds a journal record waits for its group fsync
+        snapshot_interval: FLOAT, seconds between snapshots
+        history_filter: callable(history arrays) -> history arrays, e.g. to keep one shard of the patients
+        lazy_history: BOOL, only index the history csv and read a patient on its first lookup
+        cache_patients: INT, history patients kept parsed in memory with lazy_history
+        memory_budget: INT bytes or None, resident set size above which lazily read patients are evicted,
+            None for MEMORY_BUDGET_FRACTION of the container memory limit
+        max_results: INT or None, results kept per patient, older ones are dropped
+        max_age: INT seconds or None, results older than this relative to a patient's newest are dropped
+    '''
+    global patient_store, patient_journal, patient_snapshotter
+    restore_start = time.time()
+    base = None
+    if compiled_history:
+        # the shard workers all restore at once, only one of them compiles
+        ensure_compiled(history_path, compiled_history)
+        base = open_history_base(compiled_history)
+    elif lazy_history:
+        base = open_lazy_history(history_path, cache_patients, memory_budget)
+        print(f"indexed {len(base)} patients of {history_path}, memory budget {base.memory_budget or 'none'}")
+    patient_store, first_segment = load_latest_snapshot(state_dir, base=base)
+    if patient_store is None:
+        if base is not None:
+            patient_store = PatientStore(base=base)
+        elif not reload_csv_from_shutdown(state_dir):
+            print("not loading from state")
+            history = load_history_arrays(history_path)
+            if history_filter is not None:
+                history = history_filter(history)
+            patient_store = PatientStore.from_columns(columns_from_history(history))
+    patient_store.set_retention(max_results, max_age)
+    metrics.STARTUP_PHASE_DURATION.labels('history').set(time.time() - restore_start)
+    # re-apply every event acknowledged since the snapshot
+    replay_start = time.time()
+    replayed = replay_journal(state_dir, patient_store, first_segment)
+    metrics.STARTUP_PHASE_DURATION.labels('journal_replay').set(time.time() - replay_start)
+    restore_duration = time.time() - restore_start
+    print(f"replayed {replayed} journal records, state restored in {restore_duration:.2f}s")
+    metrics.JOURNAL_RECORDS_REPLAYED.set(replayed)
+    metrics.STATE_RESTORE_DURATION.set(restore_duration)
+    patient_journal = Journal(state_dir, commit_interval=commit_interval, first_segment=first_segment)
+    patient_snapshotter = Snapshotter(state_dir, patient_store, patient_journal, interval=snapshot_interval)
+
+def detector_state(model_path, threshold, input_window, recorded_predictions):
+    '''
+    Description:
+        Load the model, warmed up before the first message arrives, and set up the detector state
+    output:
+        state: DIC with the model, prediction rate, input quantiles and recorded predictions
+    '''
+    load_start = time.time()
+    model = load_engine(model_path, threshold=threshold)
+    metrics.STARTUP_PHASE_DURATION.labels('model').set(time.time() - load_start)
+
+    input_quantiles = RollingQuantiles(window=input_window)
+    state = {
+        'model': model,
+        # Initialize the prediction rate
+        'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+        # Rolling window of the test results, for input drift monitoring
+        'input_quantiles': input_quantiles,
+        'recorded_predictions': recorded_predictions,
+    }
+
+    def window_quantile(q):
+        # a replay ages the window by message time, so it is read at the newest message instead of the wall clock
+        return input_quantiles.quantile(q, input_quantiles.last_time if state.get('message_time') else None)
+
+    metrics.MEDIAN_INPUT.set_function(lambda: window_quantile(0.5))
+    metrics.INPUT_P5.set_function(lambda: window_quantile(0.05))
+    metrics.INPUT_P95.set_function(lambda: window_quantile(0.95))
+    return state
+
+def run_batch(capture, history_path, compiled_history, output, threshold, local):
+    '''
+    Description:
+        Offline backfill: detect AKI over an MLLP capture file without the MLLP connection, the
+        journal or the pager, and write the predictions as the streaming detector records them
+    input:
+        capture: STRING, MLLP capture file
+        history_path: STRING
+        compiled_history: STRING or None, read the history compiled into this directory instead
+        output: STRING, predictions csv [mrn, prediction_date]
+        threshold: FLOAT
+        local: BOOL, also report the accuracy against /model/aki.csv
+    '''
+    start = time.time()
+    if compiled_history and os.path.exists(compiled_history):
+        base = open_history_base(compiled_history)
+    else:
+        base = HistoryBase(sort_columns(columns_from_history(load_history_arrays(history_path))))
+    model = load_engine('/model/aki_model.json', threshold=threshold)
+    loaded = time.time()
+    predictions, stats = backfill(read_capture(capture), base, model)
+    elapsed = time.time() - loaded
+    predictions.to_csv(output, index=False)
+    print(f"loaded {len(base)} history patients and the model in {loaded - start:.2f}s")
+    print(f"{stats['results']} results of {stats['messages']} messages ({stats['skipped']} skipped) in {elapsed:.2f}s, "
+          f"{stats['messages'] / max(elapsed, 1e-9):,.0f} messages/s: parse {stats['parse']:.2f}s, "
+          f"features {stats['features']:.2f}s, predict {stats['predict']:.2f}s")
+    print(f"{len(predictions)} predictions written to {output}")
+    if local:
+        aki_expected_outcomes = pd.read_csv('/model/aki.csv')
+        accuracy_report = check_aki_detection_accuracy(predictions, aki_expected_outcomes)
+        print("AKI Detection Accuracy Report:", accuracy_report)
+
 def main():
-    global historical_data
+    global pager_dispatcher, shard_workers
     # parameter parsing
     warnings.filterwarnings("ignore", category=FutureWarning)
     parser = argparse.ArgumentParser(description='Description of your program')
@@ -53,7 +363,47 @@ def main():
     parser.add_argument('--local', default=False, help='Show metrics if Local')
     parser.add_argument('--mllp', type=str, default='host.docker.internal:8440', help='mllp address for local')
     parser.add_argument('--pager', type=str, default='host.docker.internal:8441', help='pager address for local')
+    parser.add_argument('--ingestion', type=str, default='serial', choices=['serial', 'async'], help='serial stop-and-wait loop, or pipelined asyncio engine')
+    parser.add_argument('--compiled_history', type=str, default=None, help='memory-map the history compiled by history_compiler.py from this directory (compiled on first start if missing, recompiled when the csv changes) instead of loading it into memory')
+    parser.add_argument('--state_dir', type=str, default='/state', help='directory for the patient journal')
+    parser.add_argument('--journal_commit_ms', type=float, default=DEFAULT_COMMIT_INTERVAL * 1000, help='maximum time a journal record waits for its group fsync')
+    parser.add_argument('--snapshot_interval', type=float, default=DEFAULT_SNAPSHOT_INTERVAL, help='seconds between background snapshots of the patient state')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='AKI probability above which a patient is paged')
+    parser.add_argument('--input_window', type=float, default=DEFAULT_WINDOW, help='seconds of test results the median_input and input quantile metrics cover')
+    parser.add_argument('--queue_size', type=int, default=ingestion.INGESTION_QUEUE_SIZE, help='framed messages buffered ahead of the detector in async mode')
+    parser.add_argument('--batch_size', type=int, default=ingestion.BATCH_SIZE, help='maximum messages scored with one model call in async mode')
+    parser.add_argument('--batch_wait_ms', type=float, default=ingestion.BATCH_WAIT * 1000, help='time a batch waits for more messages in async mode, 0 only batches messages already queued')
+    parser.add_argument('--pager_queue_size', type=int, default=PAGER_QUEUE_SIZE, help='pages waiting for delivery before the detector blocks')
+    parser.add_argument('--pager_timeout_ms', type=float, default=PAGER_TIMEOUT[1] * 1000, help='time a page request waits for the pager response before it is retried')
+    parser.add_argument('--stage_buckets', type=parse_stage_buckets, action='append', default=[], help='bucket upper bounds in seconds of a stage latency histogram, e.g. predict=0.0001,0.001,0.01, repeat for each stage to change')
+    parser.add_argument('--workers', type=int, default=0, help='run the detector in this many worker processes, each owning the patients whose MRN hashes to it; 0 runs it in the listener process')
+    parser.add_argument('--listen', type=str, default=None, help='host:port to accept MLLP connections on instead of connecting to --mllp, to run as a replica behind cluster.py')
+    parser.add_argument('--handoff', type=str, default=None, help='host:port to serve shard handoffs of cluster.py on, with --listen')
+    parser.add_argument('--metrics_port', type=int, default=8000, help='port to serve the metrics on, shard workers use the following ports')
+    parser.add_argument('--lazy_history', action='store_true', help='index the history csv at startup and read each patient on its first message instead of loading them all')
+    parser.add_argument('--history_cache_patients', type=int, default=DEFAULT_CACHE_PATIENTS, help='history patients kept parsed in memory with --lazy_history, least recently used first out')
+    parser.add_argument('--max_results_per_patient', type=int, default=DEFAULT_MAX_RESULTS, help='creatinine results kept per patient, older ones are dropped; the model reads the newest 5, 0 keeps every result')
+    parser.add_argument('--max_result_age_days', type=float, default=None, help='drop results more than this many days older than the patient\'s newest result, the newest 5 are always kept')
+    parser.add_argument('--batch', type=str, default=None, help='detect AKI offline over this MLLP capture file and exit, instead of connecting to --mllp')
+    parser.add_argument('--batch_output', type=str, default='recorded_predictions.csv', help='predictions csv written by --batch')
+    parser.add_argument('--memory_budget_mb', type=float, default=None, help='resident memory above which --lazy_history evicts cold history patients, defaults to 80%% of the container memory limit')
     args = parser.parse_args()
+    if args.lazy_history and args.compiled_history:
+        parser.error('--lazy_history reads the history csv, --compiled_history the compiled history, choose one')
+    if 0 < args.max_results_per_patient < FEATURE_RESULTS:
+        parser.error(f'--max_results_per_patient must keep at least the {FEATURE_RESULTS} results the model reads')
+    if args.listen and not (args.compiled_history or args.lazy_history):
+        parser.error('--listen needs --compiled_history or --lazy_history, so a replica only keeps the history patients it is sent instead of loading the whole csv')
+    if args.listen and args.workers:
+        parser.error('--listen runs a single replica, start one replica per process instead of --workers')
+    if args.handoff and not args.listen:
+        parser.error('--handoff needs --listen')
+    metrics.configure_stage_buckets(dict(args.stage_buckets))
+
+    if args.batch:
+        run_batch(args.batch, '/model/history.csv' if args.local else args.history, args.compiled_history,
+                  args.batch_output, args.threshold, args.local)
+        return
 
     # get address for mllp and pager
     if args.local:
@@ -67,114 +417,137 @@ def main():
         pager = os.getenv('PAGER_ADDRESS')
         pager = parse_url(pager)
 
-    # Start up the server to expose the metrics.
-    start_http_server(8000)
-    print("Prometheus metrics server running on port 8000")
+    # Start up the server to expose the metrics and readiness on /ready, before anything is loaded
+    startup_start = time.time()
+    ready = threading.Event()
+    metrics.start_metrics_server(args.metrics_port, ready.is_set)
+    print(f"Prometheus metrics server running on port {args.metrics_port}")
 
     # local paths for local testing
-    if not reload_csv_from_shutdown():
-        print("not loading from state")
-        if args.local:
-            historical_data = load_and_process_history('/model/history.csv')
-        else:
-            historical_data = load_and_process_history(args.history)
-
-    # load pre-trained model
-    model = load_model('/model/aki_model.json')
-    # expected outcomes
-    aki_expected_outcomes = pd.read_csv('/model/aki.csv')
+    history_path = '/model/history.csv' if args.local else args.history
 
     # Initialize a list to record predictions
     recorded_predictions = []
 
-    # Initialize the prediction rate
-    prediction_rate_dic = {"positive": 0, "negative": 0, "rate": 0.0}
+    workers = None
+    state = None
+    sharding.check_layout(args.state_dir, args.workers)
+
+    memory_budget = int(args.memory_budget_mb * (1 << 20)) if args.memory_budget_mb else default_memory_budget()
+    if memory_budget and args.workers:
+        # each shard worker gets its share
+        memory_budget //= args.workers
+    max_results = args.max_results_per_patient or None
+    max_age = int(args.max_result_age_days * 86400) if args.max_result_age_days else None
+
+    # pages are delivered by a worker thread, pending pages are kept in the state directory
+    pager_dispatcher = PagerDispatcher(pager, args.state_dir, queue_size=args.pager_queue_size,
+                                       timeout=(PAGER_TIMEOUT[0], args.pager_timeout_ms / 1000))
+
+    if not args.workers:
+        # the patient state and the model load in parallel while the MLLP connection is opened
+        loader = ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+        restored = loader.submit(restore_state, history_path, args.compiled_history, args.state_dir,
+                                 args.journal_commit_ms / 1000, args.snapshot_interval, lazy_history=args.lazy_history,
+                                 cache_patients=args.history_cache_patients, memory_budget=memory_budget,
+                                 max_results=max_results, max_age=max_age)
+        loaded = loader.submit(detector_state, '/model/aki_model.json', args.threshold, args.input_window, recorded_predictions)
+        loader.shutdown(wait=False)
 
-    # Initialize the median last hour test data
-    median_last_hour_test_data = 0
+    def mark_ready():
+        ready_duration = time.time() - startup_start
+        metrics.STARTUP_PHASE_DURATION.labels('ready').set(ready_duration)
+        metrics.READY.set(1)
+        ready.set()
+        print(f"ready to process messages {ready_duration:.2f}s after startup")
 
-    # Initialize the last hour test data
-    new_column_order = [
-        'new_creatinine_result',
-        'prediction_time'
-    ]
-    last_hour_test_data = pd.DataFrame(columns = new_column_order)
+    def wait_ready():
+        # blocks until the state and the model are loaded, re-raising a loading error, returns the journal restore_state() opened
+        nonlocal state
+        if not ready.is_set():
+            restored.result()
+            state = loaded.result()
+            mark_ready()
+        return patient_journal
+
+    def send_page(mrn, prediction_date):
+        print("page for mrn: " + str(mrn))
+        if workers is not None:
+            # in-process the detector records its predictions, workers only report their pages
+            recorded_predictions.append({'mrn': mrn, 'prediction_date': prediction_date})
+        pager_dispatcher.submit(mrn, prediction_date)
 
     # start listener for mllp messages. If error thrown, log error, register failure and return to prevent further errors.
+    connect_start = time.time()
     try:
-        start_listener(mllp)
+        if args.listen:
+            server = ingestion.listen(args.listen)
+        elif args.ingestion == 'async' or args.workers:
+            sock = ingestion.connect(mllp)
+        else:
+            start_listener(mllp)
     except Exception as e:
         print('Error in starting MLLP listener:', e)
         metrics.START_MLLP_LISTENER_FAILURE.inc()
         return
+    metrics.STARTUP_PHASE_DURATION.labels('connect').set(time.time() - connect_start)
+
+    if args.workers:
+        # every worker restores and journals its own shard of the patients, in parallel
+        workers = shard_workers = sharding.start_workers(args.workers, {
+            'history': history_path, 'compiled_history': args.compiled_history, 'state_dir': args.state_dir,
+            'commit_interval': args.journal_commit_ms / 1000, 'snapshot_interval': args.snapshot_interval,
+            'model': '/model/aki_model.json', 'threshold': args.threshold, 'input_window': args.input_window,
+            'metrics_port': args.metrics_port + 1, 'lazy_history': args.lazy_history,
+            'cache_patients': args.history_cache_patients, 'memory_budget': memory_budget,
+            'max_results': max_results, 'max_age': max_age,
+        })
+        mark_ready()
 
     try:
         # Register the SIGTERM signal handler
-        signal.signal(signal.SIGTERM, saving_csv_for_shutdown)
-
-        while True:
-            message = receive_message()
-
-            # Start the timer
-            start_time = time.time()
-
-            if message is None:
-                print("No message received or connection closed, exiting loop.")
-                break  # Exit the loop if no message is received or connection is closed
-            metrics.MESSAGES_RECEIVED.inc()
-
-            # Process the message
-            parsed_data, type = parse_hl7_message(message)
-            if parsed_data is None or type is None:
-                print("Parsing failed, skipping this message.")
-                continue
-
-            # extract mrn for the user
-            mrn = extract_mrn(parsed_data)
-
-            # if ADT (Admission, Discharge, Transfer), need to update current data
-            if type == "ADT":
-                historical_data = update_patient_data(mrn, parsed_data, historical_data, type=type)
-            # if ORU (Observation Result), extract all pass history, aggregate and make prediction
-            else:
-                metrics.BLOOD_TEST_RECEIVED.inc()
-                patient_history = get_patient_history(historical_data, mrn)
-
-                combined_data, last_hour_test_data, median_last_hour_test_data = aggregate_data(parsed_data, patient_history, last_hour_test_data)
-                metrics.MEDIAN_INPUT.set(median_last_hour_test_data)
-                historical_data = update_patient_data(mrn, combined_data, historical_data, type=type)
-                prediction, prediction_date, prediction_latency, prediction_rate_dic = predict_aki(model, combined_data, prediction_rate_dic)
-                prediction_rate = prediction_rate_dic["rate"]
-
-                metrics.PREDICTION_RATE.set(prediction_rate)
-                metrics.PREDICTION_LATENCY.set(prediction_latency)
-    
-                # if detect aki
-                if prediction:
-                    print("page for mrn: " + str(mrn))
-                    send_pager_message(mrn, prediction_date, pager)
-                    metrics.PAGES_SENT.inc()
-                    recorded_predictions.append({'mrn': mrn, 'prediction_date': prediction_date})
-
-            ack_message()
-            metrics.MESSAGES_ACKNOWLEDGED.inc()
-
-            # End the timer
-            end_time = time.time()
-    
-            # Calculate the latency
-            overall_latency = end_time - start_time
-            metrics.OVERALL_LATENCY.set(overall_latency)
+        signal.signal(signal.SIGTERM, close_journal_for_shutdown)
+
+        if args.listen:
+            # the router's connections wait in the listen backlog until the handoff server can serve the state
+            wait_ready()
+            if args.handoff:
+                cluster.serve_handoff(args.handoff, patient_store, patient_journal)
+            # a replica serves the router until it is stopped, the router reconnects after a ring change
+            while True:
+                sock, _ = server.accept()
+                sock.setblocking(False)
+                ingestion.run(sock, lambda message: handle_message(message, state), send_page, queue_size=args.queue_size, durability=patient_journal,
+                              handle_batch=lambda messages: handle_batch(messages, state), batch_size=args.batch_size,
+                              batch_wait=args.batch_wait_ms / 1000, reject_failed=True)
+        elif workers is not None:
+            sharding.run(sock, workers, send_page, queue_size=args.queue_size, batch_size=args.batch_size, batch_wait=args.batch_wait_ms / 1000)
+        elif args.ingestion == 'async':
+            # frames are buffered while loading, up to --queue_size
+            ingestion.run(sock, lambda message: handle_message(message, state), send_page, queue_size=args.queue_size,
+                          handle_batch=lambda messages: handle_batch(messages, state), batch_size=args.batch_size,
+                          batch_wait=args.batch_wait_ms / 1000, ready=wait_ready)
+        else:
+            # messages wait in the socket until the detector is ready
+            wait_ready()
+            run_serial(state, send_page)
 
     finally:
         if args.local:
             # metrics calculation for local
             recorded_predictions_df = pd.DataFrame(recorded_predictions)
             recorded_predictions_df.to_csv('recorded_predictions.csv', index=False)
+            # expected outcomes
+            aki_expected_outcomes = pd.read_csv('/model/aki.csv')
             accuracy_report = check_aki_detection_accuracy(recorded_predictions_df, aki_expected_outcomes)
             print("AKI Detection Accuracy Report:", accuracy_report)
 
         print("Cleaning up resources...")
+        if workers is not None:
+            sharding.stop_workers(workers)
+        elif patient_journal is not None:
+            patient_journal.close()
+        pager_dispatcher.close()
         close_connection()
         metrics.CONNECTION_CLOSURE.inc()
 
@@ -0,0 +1,220 @@
+import mmap
+import os
+import time
+from array import array
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from aki_detector import predict_features
+from hl7_processor import parse_hl7_message, extract_mrn
+from listener import MLLP_START_BLOCK, MLLP_FRAME_END
+from patient_store import FEATURE_RESULTS, SEX_CODES, SEX_UNKNOWN, calculate_age, empty_features, hl7_to_epoch
+
+# feature rows scored with one model call
+SCORE_BATCH_ROWS = 65536
+# capture bytes read before the pages behind them are released
+CAPTURE_RELEASE_BYTES = 1 << 24
+
+
+def read_capture(path):
+    '''
+    Description:
+        Stream the MLLP frames of a capture file, e.g. one written by the simulator or recorded off
+        the wire. The file is memory-mapped and the pages already read are released, so memory
+        stays flat for any capture size; bytes outside frames are skipped, as MLLPFramer does.
+    input:
+        path: STRING
+    output:
+        messages: generator of bytes, in capture order
+    '''
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            released = 0
+            while True:
+                start = data.find(MLLP_START_BLOCK, position)
+                end = data.find(MLLP_FRAME_END, start + 1) if start >= 0 else -1
+                if end < 0:
+                    return
+                yield data[start + 1:end]
+                position = end + len(MLLP_FRAME_END)
+                if position - released >= CAPTURE_RELEASE_BYTES:
+                    release = (position - released) // mmap.PAGESIZE * mmap.PAGESIZE
+                    data.madvise(mmap.MADV_DONTNEED, released, release)
+                    released += release
+
+
+def parse_capture(messages, today=None):
+    '''
+    Description:
+        Parse a capture into columns of events: admissions and blood test results. Discharges do not
+        change the patient state and messages that fail to parse are skipped, as the detector does.
+        Messages are consumed one at a time and only the columns are kept.
+    input:
+        messages: iterable of bytes, e.g. read_capture()
+        today: datetime the ages are computed at, default now
+    output:
+        events: DIC of numpy arrays, one entry per event in capture order: mrn, position in the
+            capture, event_time (MSH timestamp as YYYYmmddHHMMSS INT), admit (BOOL), age and sex code
+            of admissions, test_time (epoch seconds) and result of blood test results
+        counts: DIC with the number of messages and of messages that failed to parse (skipped)
+    '''
+    today = today or datetime.now()
+    mrns = []
+    positions, event_times, test_times = array('q'), array('q'), array('q')
+    admits, sexes = array('b'), array('b')
+    ages, results = array('f'), array('f')
+    skipped = 0
+    position = -1
+    for position, message in enumerate(messages):
+        parsed_data, type = parse_hl7_message(message)
+        if parsed_data is None or type is None:
+            skipped += 1
+            continue
+        if type == 'ADT':
+            if parsed_data['message_type'] != 'ADT^A01':
+                continue
+            ages.append(calculate_age(parsed_data['date_of_birth'], today))
+            sexes.append(SEX_CODES.get(parsed_data['sex'], SEX_UNKNOWN))
+            test_times.append(0)
+            results.append(np.nan)
+        elif 'test_time' in parsed_data:
+            ages.append(np.nan)
+            sexes.append(SEX_UNKNOWN)
+            test_times.append(hl7_to_epoch(parsed_data['test_time']))
+            results.append(float(parsed_data['test_result']))
+        else:
+            skipped += 1
+            continue
+        mrns.append(extract_mrn(parsed_data))
+        positions.append(position)
+        event_times.append(int(parsed_data['date_and_time']))
+        admits.append(type == 'ADT')
+    events = {
+        'mrn': np.array(mrns, dtype=np.bytes_) if mrns else np.zeros(0, dtype='S1'),
+        'position': np.frombuffer(positions, dtype=np.int64),
+        'event_time': np.frombuffer(event_times, dtype=np.int64),
+        'admit': np.frombuffer(admits, dtype=np.int8).astype(bool),
+        'age': np.frombuffer(ages, dtype=np.float32),
+        'sex': np.frombuffer(sexes, dtype=np.int8),
+        'test_time': np.frombuffer(test_times, dtype=np.int64),
+        'result': np.frombuffer(results, dtype=np.float32),
+    }
+    return events, {'messages': position + 1, 'skipped': skipped}
+
+
+def _group_starts(codes):
+    # index of the first element of each element's group, for codes sorted into groups
+    return np.searchsorted(codes, codes, side='left')
+
+
+def feature_matrix(events, base):
+    '''
+    Description:
+        Model input of every blood test result of a capture at once. Events are grouped by MRN and
+        ordered by event time, capture order breaking ties, and each result sees the patient as the
+        streaming detector would: the history results from `base`, the earlier results of the capture
+        and the demographics of the latest admission before it.
+    input:
+        events: DIC from parse_capture()
+        base: HistoryBase, the patients' history
+    output:
+        results: INT64 indices into events of the blood test results, in the order of the rows
+        features: float32 numpy array (results, FEATURE_COLUMNS)
+    '''
+    keys, codes = np.unique(events['mrn'], return_inverse=True)
+    order = np.lexsort((events['position'], events['event_time'], codes))
+    codes = codes[order]
+    admit = events['admit'][order]
+
+    # demographics: the latest admission of the same patient before each event, else the history's
+    positions = np.searchsorted(base.mrn_keys, keys) if len(base) else np.zeros(len(keys), dtype=np.int64)
+    positions = np.minimum(positions, max(len(base) - 1, 0))
+    known = (base.mrn_keys[positions] == keys) if len(base) else np.zeros(len(keys), dtype=bool)
+    latest = np.maximum.accumulate(np.where(admit, np.arange(len(order)), -1)) if len(order) else np.zeros(0, dtype=np.int64)
+    admitted = latest >= _group_starts(codes)
+    latest = order[np.maximum(latest, 0)]
+    age = np.where(admitted, events['age'][latest], np.nan).astype(np.float32)
+    sex = np.where(admitted, events['sex'][latest], SEX_UNKNOWN)
+    from_base = ~admitted & known[codes]
+    age[from_base] = base.age[positions[codes[from_base]]]
+    sex[from_base] = base.sex[positions[codes[from_base]]]
+
+    # result stream of every patient: the newest history results the model can still read, then the capture's results
+    results = order[~admit]
+    result_codes = codes[~admit]
+    tail = np.where(known, np.minimum(base.length[positions], FEATURE_RESULTS - 1), 0).astype(np.int64) if len(base) else np.zeros(len(keys), dtype=np.int64)
+    tail[np.setdiff1d(np.arange(len(keys)), result_codes)] = 0
+    history_codes = np.repeat(np.arange(len(keys)), tail)
+    starts = np.cumsum(tail) - tail
+    history_slots = np.repeat(base.offset[positions] + base.length[positions] - tail, tail) + np.arange(int(tail.sum())) - np.repeat(starts, tail) if len(base) else np.zeros(0, dtype=np.int64)
+    stream_codes = np.concatenate([history_codes, result_codes])
+    history = np.concatenate([np.ones(len(history_codes), dtype=bool), np.zeros(len(results), dtype=bool)])
+    # a stable sort by patient keeps the history first and the capture's results in event order
+    stream = np.argsort(stream_codes, kind='stable')
+    stream_codes = stream_codes[stream]
+    history = history[stream]
+    timestamps = np.concatenate([np.asarray(base.timestamps[history_slots], dtype=np.int64) if len(history_slots) else np.zeros(0, dtype=np.int64),
+                                 events['test_time'][results]])[stream]
+    values = np.concatenate([np.asarray(base.results[history_slots], dtype=np.float32) if len(history_slots) else np.zeros(0, dtype=np.float32),
+                             events['result'][results]])[stream]
+
+    # the k-th newest result of each row is k entries back in its patient's stream, as feature_rows() reads them
+    first = _group_starts(stream_codes)
+    index = np.arange(len(stream_codes))
+    features = empty_features(len(stream_codes))
+    for k in range(FEATURE_RESULTS):
+        present = index - k >= first
+        features[present, 2 + 2 * k] = values[index[present] - k]
+        if k:
+            features[present, 3 + 2 * k] = np.abs(timestamps[index[present] - k + 1] - timestamps[index[present] - k])
+    features = features[~history]
+    features[:, 0] = age[~admit]
+    features[:, 1] = np.where(sex[~admit] == SEX_UNKNOWN, np.nan, sex[~admit])
+    return results, features
+
+
+def backfill(messages, base, model, prediction_rate_dic=None, today=None, batch_rows=SCORE_BATCH_ROWS):
+    '''
+    Description:
+        Detect AKI over a whole capture offline: parse it, build every result's feature row
+        vectorized and score them with a few large model calls, instead of replaying the
+        capture through the MLLP connection one message at a time
+    input:
+        messages: iterable of bytes, e.g. read_capture()
+        base: HistoryBase, the patients' history
+        model: InferenceEngine
+        prediction_rate_dic: DIC or None, updated with the predictions
+        today: datetime the ages are computed at, default now
+        batch_rows: INT, feature rows per model call
+    output:
+        predictions: pd DataFrame [mrn, prediction_date] of every result the model flags, in capture
+            order, the layout check_aki_detection_accuracy() reads
+        stats: DIC with the number of messages, skipped messages, results and the seconds spent parsing,
+            building features and scoring
+    '''
+    if prediction_rate_dic is None:
+        prediction_rate_dic = {"positive": 0, "negative": 0, "rate": 0.0}
+    start = time.perf_counter()
+    events, counts = parse_capture(messages, today)
+    parsed = time.perf_counter()
+    results, features = feature_matrix(events, base)
+    built = time.perf_counter()
+    predictions = np.zeros(len(results), dtype=np.int64)
+    for first in range(0, len(results), batch_rows):
+        predictions[first:first + batch_rows], _, prediction_rate_dic = predict_features(model, features[first:first + batch_rows], prediction_rate_dic)
+    scored = time.perf_counter()
+    flagged = np.sort(results[predictions == 1])
+    frame = pd.DataFrame({
+        'mrn': np.char.decode(events['mrn'][flagged]) if len(flagged) else np.zeros(0, dtype=str),
+        'prediction_date': pd.to_datetime(events['test_time'][flagged], unit='s'),
+    })
+    stats = {
+        'messages': counts['messages'], 'skipped': counts['skipped'], 'results': len(results),
+        'parse': parsed - start, 'features': built - parsed, 'predict': scored - built,
+    }
+    return frame, stats
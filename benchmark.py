@@ -0,0 +1,1114 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import app
+import ingestion
+import metrics
+import sharding
+
+from data_processor import get_patient_history, update_patient_data
+from listener import MLLPFramer
+from patient_store import PatientStore, HistoryBase, history_columns, hl7_to_epoch, columns_from_history, sort_columns
+from rolling_quantiles import RollingQuantiles, DEFAULT_WINDOW
+from simulator import read_hl7_messages, stream_hl7_messages, generate_hl7_messages, to_mllp_frame
+from journal import Journal, replay as replay_journal, DEFAULT_COMMIT_INTERVAL
+from snapshot import Snapshotter, load_latest_snapshot
+from data_processor import load_and_process_history, load_history_arrays
+from history_compiler import compile_history, open_history_base
+from history_index import open_lazy_history
+from backfill import read_capture, backfill
+from hl7_processor import parse_hl7_message
+from aki_detector import load_model, load_engine, aggregate_data, predict_aki, predict_features, DEFAULT_THRESHOLD
+
+"""
+    Micro-benchmarks for the AKI detection service. Each benchmark is a sub-command:
+        python benchmark.py mllp
+        python benchmark.py store --sizes 10000,100000,1000000
+        python benchmark.py journal --directory /state/bench
+        python benchmark.py snapshot --sizes 100000,1000000
+        python benchmark.py history --patients 200000
+        python benchmark.py history_loader --sizes 200000,1000000
+        python benchmark.py inference --predictions 5000
+        python benchmark.py batch --sizes 1,8,32,128
+        python benchmark.py window --sizes 1000,10000,100000,1000000
+        python benchmark.py hl7 --messages 20000
+        python benchmark.py pipeline --messages messages.mllp --output pipeline.json
+        python benchmark.py capture --messages 20000000 --directory /state/bench
+        python benchmark.py ack_window --windows 1,2,4,8,16,32 --rtt_ms 2
+        python benchmark.py shards --workers 1,2,4,8 --messages 20000
+        python benchmark.py startup --patients 1000000
+        python benchmark.py retention --sizes 1000,10000,100000
+        python benchmark.py backfill --messages 200000
+"""
+
+ORU_R01 = (
+    b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201800||ORU^R01|||2.5\r"
+    b"PID|1||478237423\r"
+    b"OBR|1||||||202401202243\r"
+    b"OBX|1|SN|CREATININE||103.4\r"
+)
+
+
+def to_mllp(message):
+    return b'\x0b' + message + b'\x1c\x0d'
+
+
+class ChunkSocket:
+    '''
+    Description:
+        Socket stand-in that returns pre-split chunks from recv_into, so the framer
+        can be measured without kernel or network noise
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.position = 0
+
+    def recv_into(self, view):
+        if self.position == len(self.chunks):
+            return 0
+        chunk = self.chunks[self.position]
+        self.position += 1
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def run_framer(chunks):
+    framer = MLLPFramer()
+    sock = ChunkSocket(chunks)
+    frames = 0
+    size = sum(len(chunk) for chunk in chunks)
+    start = time.perf_counter()
+    while framer.read_from(sock):
+        for _ in framer:
+            frames += 1
+    return frames, size, time.perf_counter() - start
+
+
+def bench_mllp(flags):
+    frame = to_mllp(ORU_R01)
+    # oversized frames: pad the OBX segment well past the old 1 KiB read size
+    oversized = to_mllp(ORU_R01 + b"NTE|1||" + b"x" * flags.oversized_bytes + b"\r")
+    half = len(frame) // 2
+    scenarios = {
+        # every frame split across two reads, as simulator.py --short_messages does
+        'split': [part for _ in range(flags.frames) for part in (frame[:half], frame[half:])],
+        # many frames delivered by a single read
+        'coalesced': [frame * 64 for _ in range(flags.frames // 64)],
+        # frames larger than the receive buffer, delivered in 1 KiB segments
+        'oversized': [oversized[i:i + 1024] for _ in range(flags.frames // 100) for i in range(0, len(oversized), 1024)],
+    }
+    for name, chunks in scenarios.items():
+        frames, size, elapsed = run_framer(chunks)
+        print(f"mllp {name:>10}: {frames} frames in {elapsed:.3f}s, {frames / elapsed:,.0f} frames/s, {size / elapsed / 2**20:,.1f} MiB/s")
+
+
+def synthetic_history(patients, results_per_patient=5):
+    '''wide history DataFrame in the layout of load_and_process_history'''
+    data = np.full((patients, len(history_columns())), np.nan, dtype=object)
+    data[:, 0] = [str(100000 + i) for i in range(patients)]
+    dates = [f'2024-01-{day:02d} 06:12:00' for day in range(1, results_per_patient + 1)]
+    for i in range(results_per_patient):
+        data[:, 3 + 2 * i] = dates[i]
+        data[:, 4 + 2 * i] = '68.58'
+    return pd.DataFrame(data, columns=history_columns())
+
+
+def time_per_call(function, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - start) / calls
+
+
+def bench_store(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    adt = {'message_type': 'ADT^A01', 'date_of_birth': '19840203', 'sex': 'F'}
+    for patients in [int(size) for size in flags.sizes.split(',')]:
+        historical_data = synthetic_history(patients)
+        start = time.perf_counter()
+        store = PatientStore.from_dataframe(historical_data)
+        build = time.perf_counter() - start
+        mrns = [str(100000 + (i * 7919) % patients) for i in range(flags.operations)]
+        combined = get_patient_history(historical_data, mrns[0])
+
+        def frame_update(i):
+            update_patient_data(mrns[i], combined, historical_data, type='ORU')
+
+        def frame_admit(i):
+            nonlocal historical_data
+            historical_data = update_patient_data(f'new{i}', adt, historical_data, type='ADT')
+
+        timings = {
+            'lookup': (time_per_call(lambda i: get_patient_history(historical_data, mrns[i]), flags.operations),
+                       time_per_call(lambda i: store.series(mrns[i]), flags.operations)),
+            'adapter': (None, time_per_call(lambda i: store.history_frame(mrns[i]), flags.operations)),
+            'append': (time_per_call(frame_update, flags.operations),
+                       time_per_call(lambda i: store.append_result(mrns[i], hl7_to_epoch('20240201120000'), 70.5), flags.operations)),
+            'admit': (time_per_call(frame_admit, flags.operations),
+                      time_per_call(lambda i: store.admit(f'new{i}', '19840203', 'F'), flags.operations)),
+        }
+        print(f"store {patients:>8} patients: built in {build:.2f}s, "
+              f"DataFrame {historical_data.memory_usage(deep=False).sum() / 2**20:,.0f} MiB (excluding strings), "
+              f"store {store.nbytes() / 2**20:,.1f} MiB")
+        for name, (current, columnar) in timings.items():
+            current = f"{current * 1e6:>12,.1f}us" if current is not None else f"{'-':>14}"
+            print(f"    {name:>8}: DataFrame {current}, store {columnar * 1e6:>9,.2f}us")
+
+
+def bench_journal(flags):
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        for writers in [int(count) for count in flags.writers.split(',')]:
+            # every writer waits for durability before its next record, like an ACK per message
+            journal = Journal(directory, commit_interval=flags.commit_ms / 1000)
+            per_writer = flags.records // writers
+            def write():
+                for i in range(per_writer):
+                    journal.wait_durable(journal.append_result(str(100000 + i), 1704067200 + i, 68.58))
+            threads = [threading.Thread(target=write) for _ in range(writers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            journal.close()
+            print(f"journal {writers:>3} waiting writers: {per_writer * writers / elapsed:>10,.0f} records/s "
+                  f"({elapsed / per_writer * 1e3:.3f}ms per acknowledged record)")
+
+        # pipelined: append without waiting, as the async ACK stage allows
+        journal = Journal(directory, commit_interval=flags.commit_ms / 1000)
+        start = time.perf_counter()
+        for i in range(flags.records):
+            journal.append_result(str(100000 + i % 10000), 1704067200 + i, 68.58)
+        journal.wait_durable()
+        elapsed = time.perf_counter() - start
+        journal.close()
+        print(f"journal   pipelined writer: {flags.records / elapsed:>10,.0f} records/s")
+
+        store = PatientStore()
+        start = time.perf_counter()
+        count = replay_journal(directory, store)
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"journal replay: {count} records ({size / 2**20:.1f} MiB) in {elapsed:.2f}s, {count / elapsed:,.0f} records/s")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_snapshot(flags):
+    for patients in [int(size) for size in flags.sizes.split(',')]:
+        directory = tempfile.mkdtemp(dir=flags.directory)
+        try:
+            store = PatientStore.from_dataframe(synthetic_history(patients))
+            csv_path = os.path.join(directory, 'historical_data.csv')
+            store.to_dataframe().to_csv(csv_path, index=False)
+            start = time.perf_counter()
+            PatientStore.from_dataframe(pd.read_csv(csv_path))
+            csv_restore = time.perf_counter() - start
+
+            journal = Journal(directory)
+            for i in range(flags.tail):
+                journal.append_result(str(100000 + i % patients), 1704067200 + i, 68.58)
+            start = time.perf_counter()
+            writer = Snapshotter(directory, store, journal).snapshot()
+            pause = time.perf_counter() - start
+            writer.join()
+            write = time.perf_counter() - start
+            # journal tail written after the snapshot, replayed on restart
+            for i in range(flags.tail):
+                journal.append_result(str(100000 + i % patients), 1704067200 + i, 68.58)
+            journal.close()
+
+            start = time.perf_counter()
+            restored, first_segment = load_latest_snapshot(directory)
+            replayed = replay_journal(directory, restored, first_segment)
+            restore = time.perf_counter() - start
+            print(f"snapshot {patients:>8} patients: capture pause {pause * 1e3:.1f}ms, background write {write:.2f}s, "
+                  f"restart {restore:.2f}s (replayed {replayed} records) vs csv reload {csv_restore:.2f}s")
+        finally:
+            shutil.rmtree(directory)
+
+
+def write_synthetic_history_csv(path, patients, max_results=27, seed=0):
+    '''ragged history csv in the format of history.csv, with 1 to max_results results per patient'''
+    rng = random.Random(seed)
+    header = ['mrn'] + [f'creatinine_{kind}_{i}' for i in range(max_results) for kind in ('date', 'result')]
+    start = 1704067200
+    with open(path, 'w') as file:
+        file.write(','.join(header) + '\n')
+        for i in range(patients):
+            count = rng.randint(1, max_results)
+            time_ = start + rng.randint(0, 86400 * 30)
+            fields = [str(100000 + i)]
+            for _ in range(count):
+                time_ += rng.randint(3600, 86400 * 5)
+                fields.append(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time_ - time_ % 60)))
+                fields.append(f'{rng.uniform(40, 400):.2f}')
+            fields.extend([''] * (2 * (max_results - count)))
+            file.write(','.join(fields) + '\n')
+
+
+def peak_memory():
+    # peak and current resident set size of this process, in MiB
+    status = {}
+    with open('/proc/self/status') as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    return int(status['VmHWM'].split()[0]) / 1024, int(status['VmRSS'].split()[0]) / 1024
+
+
+def measure_history_load(mode, path, lookups, results):
+    # runs in a fresh process so peak RSS only reflects this loader
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    before, _ = peak_memory()
+    start = time.perf_counter()
+    if mode == 'dataframe':
+        store = PatientStore.from_dataframe(load_and_process_history(path))
+    elif mode == 'arrays':
+        store = PatientStore.from_columns(columns_from_history(load_history_arrays(path)))
+    elif mode == 'lazy':
+        store = PatientStore(base=open_lazy_history(path))
+    else:
+        store = PatientStore(base=open_history_base(path))
+    ready = time.perf_counter() - start
+    # a working set of touched patients, as message traffic would produce
+    mrns = [str(100000 + i * 7919 % lookups) for i in range(lookups)]
+    for mrn in mrns:
+        store.append_result(mrn, 1714564800, 70.5)
+    peak, current = peak_memory()
+    results.put((mode, ready, peak - before, current))
+
+
+def bench_history(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        csv_path = os.path.join(directory, 'history.csv')
+        write_synthetic_history_csv(csv_path, flags.patients)
+        compiled_path = os.path.join(directory, 'history.compiled')
+        start = time.perf_counter()
+        compile_history(csv_path, compiled_path)
+        print(f"history {flags.patients} patients: csv {os.path.getsize(csv_path) / 2**20:.0f} MiB, compiled once in {time.perf_counter() - start:.2f}s")
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        for mode, path in (('dataframe', csv_path), ('arrays', csv_path), ('lazy', csv_path), ('compiled', compiled_path)):
+            process = context.Process(target=measure_history_load, args=(mode, path, flags.lookups, results))
+            process.start()
+            mode, ready, peak, current = results.get()
+            process.join()
+            print(f"history {mode:>10}: ready in {ready:.2f}s, peak RSS +{peak:,.0f} MiB over imports, RSS {current:,.0f} MiB after {flags.lookups} patients touched")
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_load_history(path):
+    # the csv.reader row loop load_and_process_history used before the vectorized loader, kept as the baseline
+    with open(path, mode='r') as file:
+        reader = csv.reader(file)
+        historical_data = []
+        next(reader, None)
+        for row in reader:
+            row = [item for item in row if item]
+            mrn = row[0]
+            data = row[1:]
+            data += [None] * (100 - len(data))
+            historical_data.append([mrn, None, None] + data)
+    processed_df = pd.DataFrame(historical_data, columns=history_columns())
+    return processed_df.fillna(np.nan)
+
+
+def measure_history_loader(mode, path, chunk_bytes, results):
+    # runs in a fresh process so peak RSS only reflects this loader
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    before, _ = peak_memory()
+    start = time.perf_counter()
+    if mode == 'csv.reader':
+        history = legacy_load_history(path)
+    else:
+        history = load_history_arrays(path, chunk_bytes=chunk_bytes)
+    elapsed = time.perf_counter() - start
+    peak, current = peak_memory()
+    results.put((elapsed, peak - before, current - before))
+
+
+def bench_history_loader(flags):
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    try:
+        for rows in (int(size) for size in flags.sizes.split(',')):
+            path = os.path.join(directory, f'history-{rows}.csv')
+            write_synthetic_history_csv(path, rows)
+            print(f"history_loader {rows:>8} rows: csv {os.path.getsize(path) / 2**20:,.0f} MiB")
+            modes = [('vectorized', flags.chunk_bytes), ('single chunk', os.path.getsize(path))]
+            # the row loop builds a wide frame of python objects, only run it where it fits in memory
+            if rows <= flags.legacy_rows:
+                modes.insert(0, ('csv.reader', None))
+            for mode, chunk_bytes in modes:
+                process = context.Process(target=measure_history_loader, args=(mode, path, chunk_bytes, results))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    print(f"history_loader {mode:>12}: failed with exit code {process.exitcode}, e.g. killed out of memory")
+                    continue
+                elapsed, peak, retained = results.get()
+                print(f"history_loader {mode:>12}: {elapsed:6.2f}s, {rows / elapsed:,.0f} rows/s, "
+                      f"peak RSS +{peak:,.0f} MiB, result +{retained:,.0f} MiB")
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def measure_inference(mode, predictions, results):
+    # runs in a fresh process so the first prediction shows any cold-start cost
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    store = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+    mrns = store.mrns()
+    rate = {'positive': 0, 'negative': 0, 'rate': 0.0}
+    input_quantiles = RollingQuantiles()
+    model = load_engine('aki_model.json') if mode == 'booster inplace' else load_model('aki_model.json')
+    latencies = []
+    for i in range(predictions):
+        mrn = mrns[i % len(mrns)]
+        # the latency PREDICTION_LATENCY reports for each path
+        if mode == 'predict_aki':
+            new_data = {'test_time': '20240610093000', 'test_result': '120.5'}
+            combined_data, input_quantiles, _ = aggregate_data(new_data, store.history_frame(mrn), input_quantiles)
+            _, _, latency, rate = predict_aki(model, combined_data, rate)
+        else:
+            _, latency, rate = predict_features(model, store.feature_row(mrn), rate)
+        latencies.append(latency)
+    results.put((latencies[0], np.percentile(latencies[1:], 50), np.percentile(latencies[1:], 99)))
+
+
+def bench_inference(flags):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    for mode in ('predict_aki', 'classifier row', 'booster inplace'):
+        process = context.Process(target=measure_inference, args=(mode, flags.predictions, results))
+        process.start()
+        first, p50, p99 = results.get()
+        process.join()
+        print(f"inference {mode:>15}: first {first * 1e6:8.0f}us, p50 {p50 * 1e6:6.0f}us, p99 {p99 * 1e6:6.0f}us")
+
+
+def oru_message(mrn, test_time, result):
+    return (f'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{test_time}||ORU^R01|||2.5\r'
+            f'PID|1||{mrn}\rOBR|1||||||{test_time}\rOBX|1|SN|CREATININE||{result:.2f}\r').encode()
+
+
+def bench_batch(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    historical_data = load_and_process_history('history.csv')
+    mrns = historical_data['mrn'].tolist()
+    rng = random.Random(0)
+    messages = [oru_message(mrns[i % len(mrns)], f'202406{10 + i // 40000:02d}{i // 3600 % 10:02d}{i // 60 % 60:02d}{i % 60:02d}', rng.uniform(40, 400))
+                for i in range(flags.messages)]
+    engine = load_engine('aki_model.json')
+    rows = np.random.default_rng(0).uniform(0, 400, size=(max(int(size) for size in flags.sizes.split(',')), 12)).astype(np.float32)
+    for batch_size in (int(size) for size in flags.sizes.split(',')):
+        directory = tempfile.mkdtemp(dir=flags.directory)
+        try:
+            app.patient_store = PatientStore.from_dataframe(historical_data.copy())
+            app.patient_journal = Journal(directory, fsync=False)
+            app.patient_snapshotter = Snapshotter(directory, app.patient_store, app.patient_journal, interval=3600)
+            state = {'model': engine, 'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+                     'input_quantiles': RollingQuantiles(),
+                     'recorded_predictions': []}
+            start = time.perf_counter()
+            for i in range(0, len(messages), batch_size):
+                app.handle_batch(messages[i:i + batch_size], state)
+            elapsed = time.perf_counter() - start
+            app.patient_journal.close()
+        finally:
+            shutil.rmtree(directory)
+        model_call = time_per_call(lambda i: engine.predict(rows[:batch_size]), 200)
+        print(f"batch {batch_size:>4}: {len(messages) / elapsed:8,.0f} ORU messages/s end to end, "
+              f"model call {model_call * 1e6:7.0f}us = {model_call / batch_size * 1e6:6.1f}us per row")
+
+
+def legacy_update_last_hour(test_result, last_hour_test_data, current_time):
+    # the DataFrame median aggregate_data computed per result before RollingQuantiles, kept as the baseline
+    last_hour_test_data.loc[len(last_hour_test_data)] = [test_result, current_time]
+    last_hour_test_data = last_hour_test_data[last_hour_test_data['prediction_time'] > (current_time - pd.Timedelta(hours=1))]
+    return last_hour_test_data, last_hour_test_data.iloc[:, :1].median().values[0]
+
+
+def bench_window(flags):
+    rng = np.random.default_rng(0)
+    for size in (int(size) for size in flags.sizes.split(',')):
+        # results arrive evenly, so the window holds `size` values in steady state
+        step = 3600.0 / size
+        values = rng.normal(100, 30, size + flags.operations)
+        window = RollingQuantiles(window=3600)
+        for i in range(size):
+            window.add(values[i], i * step)
+        start = time.perf_counter()
+        for i in range(size, size + flags.operations):
+            window.add(values[i], i * step)
+        add = (time.perf_counter() - start) / flags.operations
+        now = (size + flags.operations) * step
+        scrape = time_per_call(lambda i: [window.quantile(q, now) for q in (0.05, 0.5, 0.95)], 20)
+        line = f"window {size:>8} values: add {add * 1e6:6.1f}us per result, p5/median/p95 scrape {scrape * 1e3:6.2f}ms"
+        if size <= flags.legacy_size:
+            epoch = datetime(2024, 1, 1)
+            frame = pd.DataFrame({'new_creatinine_result': values[:size],
+                                  'prediction_time': epoch + pd.to_timedelta(np.arange(size) * step, unit='s')})
+            start = time.perf_counter()
+            for i in range(size, size + flags.legacy_operations):
+                frame, _ = legacy_update_last_hour(values[i], frame, epoch + pd.Timedelta(seconds=i * step))
+            line += f", DataFrame median {(time.perf_counter() - start) / flags.legacy_operations * 1e6:8.0f}us per result"
+        print(line)
+
+
+def parse_hl7_message_regex(message):
+    '''
+    The regex parser hl7_processor.parse_hl7_message replaced, kept as the reference for bench_hl7
+    and the parity tests
+    '''
+    def parse_adt_a01(message):
+        pid_match = pid_pattern_long.search(message)
+        if pid_match:
+            return {
+                'pid': pid_match.group(2),
+                'name': pid_match.group(3),
+                'date_of_birth': pid_match.group(4),
+                'sex': pid_match.group(5)
+            }
+        else:
+            return None
+
+    def parse_adt_a03_or_oru(message, message_type):
+        pid_match = pid_pattern_short.search(message)
+        if not pid_match:
+            return None
+
+        extracted_info = {'pid': pid_match.group(2)}
+        if message_type == 'ORU^R01':
+            obr_match = obr_pattern.search(message)
+            obx_match = obx_pattern.search(message)
+            if obr_match and obx_match:
+                extracted_info.update({
+                    'test_time': obr_match.group(2),
+                    'test_type': obx_match.group(3),
+                    'test_result': obx_match.group(4)
+                })
+        return extracted_info
+
+    message = message.decode('utf-8')
+
+    # Define regular expressions for extracting information
+    msh_pattern = re.compile(r'MSH\|.*?\|.*?\|.*?\|.*?\|.*?\|(\d{14})\|.*?(\bADT\^A01\b|\bADT\^A03\b|\bORU\^R01\b).*?\|(\d+\.\d+)\r*')
+    pid_pattern_long = re.compile(r'PID\|(\d+)\|\|(\d+)\|\|([^|]+)\|\|(\d{8})\|([MF])')
+    pid_pattern_short = re.compile(r'PID\|(\d+)\|\|(\d+)')
+    obr_pattern = re.compile(r'OBR\|(\d+)\|\|\|\|\|\|(\d{14})')
+    obx_pattern = re.compile(r'OBX\|(\d+)\|([^|]+)\|([^|]+)\|\|([.\d]+)')
+
+    # Extract MSH information
+    msh_match = msh_pattern.search(message)
+    if not msh_match:
+        metrics.MESSAGES_PARSED_FAILED.inc()
+        return None, "Invalid Message Format"
+
+    message_type = msh_match.group(2)
+    extracted_info = {'date_and_time': msh_match.group(1), 'message_type': message_type}
+    message_type_str = 'ADT' if 'ADT' in message_type else 'ORU'
+
+    if message_type in ['ADT^A01', 'ADT^A03']:
+        extracted_info.update(
+            parse_adt_a01(message) if message_type == 'ADT^A01' else parse_adt_a03_or_oru(message, message_type))
+    elif message_type == 'ORU^R01':
+        extracted_info.update(parse_adt_a03_or_oru(message, message_type))
+
+    if not extracted_info:
+        metrics.MESSAGES_PARSED_FAILED.inc()
+        return None, message_type_str
+
+    metrics.MESSAGES_PARSED.inc()
+    return extracted_info, message_type_str
+
+
+def bench_hl7(flags):
+    messages = {
+        'ADT^A01': (b'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240401100000||ADT^A01|||2.5\r'
+                    b'PID|1||822825||JOHN DOE||19500203|M\rNK1|1|X|PARTNER\r'),
+        'ADT^A03': b'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240401100000||ADT^A03|||2.5\rPID|1||822825\r',
+        'ORU^R01': oru_message('822825', '20240401100000', 85.69),
+        # the regex parser backtracks through every field split when MSH-7 is not a timestamp
+        'bad MSH-7': oru_message('822825', '202404011000', 85.69),
+    }
+    for name, message in messages.items():
+        parsed, expected = parse_hl7_message(message)[0], parse_hl7_message_regex(message)[0]
+        assert (parsed and {key: value for key, value in parsed.items() if key != 'observations'}) == expected
+        # best of five runs, single parses are short enough for scheduler noise to dominate the mean
+        calls = max(flags.messages // (1000 if name == 'bad MSH-7' else 1), 10)
+        regex = min(time_per_call(lambda i: parse_hl7_message_regex(message), calls) for _ in range(5))
+        tokenizer = min(time_per_call(lambda i: parse_hl7_message(message), flags.messages) for _ in range(5))
+        print(f"hl7 {name:>10}: regex {regex * 1e6:9.1f}us, byte tokenizer {tokenizer * 1e6:6.1f}us per message, {regex / tokenizer:7.1f}x")
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1e6
+    return {'count': len(samples), 'p50_us': float(np.percentile(samples, 50)), 'p95_us': float(np.percentile(samples, 95)),
+            'p99_us': float(np.percentile(samples, 99)), 'max_us': float(samples.max())}
+
+
+def bench_pipeline(flags):
+    # in-process replay of an MLLP capture through parse -> lookup -> features -> predict, without sockets or ACKs
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    messages = read_hl7_messages(flags.messages)
+    start = time.perf_counter()
+    if flags.compiled_history:
+        if not os.path.exists(flags.compiled_history):
+            compile_history(flags.history, flags.compiled_history)
+        store = PatientStore(base=open_history_base(flags.compiled_history))
+    else:
+        store = PatientStore.from_columns(columns_from_history(load_history_arrays(flags.history)))
+    load = time.perf_counter() - start
+    _, rss_after_load = peak_memory()
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        app.patient_store = store
+        app.patient_journal = Journal(directory, fsync=flags.fsync)
+        # no snapshot is due during a replay
+        app.patient_snapshotter = Snapshotter(directory, store, app.patient_journal, interval=float('inf'))
+        state = {'model': load_engine(flags.model), 'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+                 'input_quantiles': RollingQuantiles(), 'recorded_predictions': [], 'message_time': True}
+        samples = metrics.collect_stage_samples()
+        per_message = []
+        start = time.perf_counter()
+        for i in range(0, len(messages), flags.batch_size):
+            batch = messages[i:i + flags.batch_size]
+            batch_start = time.perf_counter()
+            app.handle_batch(batch, state)
+            per_message.extend([(time.perf_counter() - batch_start) / len(batch)] * len(batch))
+        elapsed = time.perf_counter() - start
+        metrics.collect_stage_samples(False)
+        app.patient_journal.close()
+    finally:
+        shutil.rmtree(directory)
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    peak_rss, rss = peak_memory()
+    report = {
+        'commit': commit,
+        'messages_file': flags.messages,
+        'messages': len(messages),
+        # one feature row is taken per blood test result, one model call per batch
+        'blood_tests': len(samples['features']),
+        'model_calls': len(samples['predict']),
+        'pages': len(state['recorded_predictions']),
+        'batch_size': flags.batch_size,
+        'history_load_seconds': load,
+        'elapsed_seconds': elapsed,
+        'messages_per_second': len(messages) / elapsed,
+        'stages': {stage: percentiles(durations) for stage, durations in sorted(samples.items())},
+        'message': percentiles(per_message),
+        'rss_after_load_mib': rss_after_load,
+        'rss_mib': rss,
+        'peak_rss_mib': peak_rss,
+    }
+    output = json.dumps(report, indent=2)
+    if flags.output:
+        with open(flags.output, 'w') as file:
+            file.write(output + '\n')
+    print(output)
+
+
+def legacy_parse_mllp_messages(buffer, source):
+    # the byte-at-a-time state machine simulator.py used before the bytes.find codec, kept as the baseline
+    i = 0
+    messages = []
+    consumed = 0
+    expect = 0x0b
+    while i < len(buffer):
+        if expect is not None:
+            if buffer[i] != expect:
+                raise Exception(f"{source}: bad MLLP encoding: want {hex(expect)}, found {hex(buffer[i])}")
+            if expect == 0x0b:
+                expect = None
+                consumed = i
+            elif expect == 0x0d:
+                messages.append(buffer[consumed+1:i-1])
+                expect = 0x0b
+                consumed = i + 1
+        else:
+            if buffer[i] == 0x1c:
+                expect = 0x0d
+        i += 1
+    return messages, buffer[consumed:]
+
+
+def write_synthetic_capture(path, messages, seed=0):
+    with open(path, 'wb') as file:
+        for message in generate_hl7_messages(max(1, messages // 20), seed=seed):
+            if messages == 0:
+                break
+            file.write(to_mllp_frame(message))
+            messages -= 1
+
+
+def measure_capture(mode, path, results):
+    # runs in a fresh process so peak RSS only reflects this reader
+    before, _ = peak_memory()
+    start = time.perf_counter()
+    first = None
+    count = 0
+    if mode == 'byte loop':
+        with open(path, 'rb') as file:
+            messages, remaining = legacy_parse_mllp_messages(file.read(), path)
+        assert not remaining
+        count = len(messages)
+    elif mode == 'find':
+        count = len(read_hl7_messages(path))
+    else:
+        for _ in stream_hl7_messages(path):
+            if first is None:
+                first = time.perf_counter() - start
+            count += 1
+    elapsed = time.perf_counter() - start
+    peak, _ = peak_memory()
+    results.put((count, elapsed, first if first is not None else elapsed, peak - before))
+
+
+def bench_capture(flags):
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    try:
+        path = os.path.join(directory, 'capture.mllp')
+        write_synthetic_capture(path, flags.messages)
+        size = os.path.getsize(path) / 2**20
+        print(f"capture {flags.messages:,} messages: {size:,.0f} MiB")
+        modes = ['find', 'mmap stream']
+        # the byte loop takes minutes per gigabyte, only run it on captures of a sensible size
+        if flags.messages <= flags.legacy_messages:
+            modes.insert(0, 'byte loop')
+        for mode in modes:
+            process = context.Process(target=measure_capture, args=(mode, path, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"capture {mode:>11}: failed with exit code {process.exitcode}, e.g. killed out of memory")
+                continue
+            count, elapsed, first, peak = results.get()
+            print(f"capture {mode:>11}: {count:,} frames in {elapsed:6.2f}s, {size / elapsed:,.0f} MiB/s, "
+                  f"first frame after {first * 1000:,.1f} ms, peak RSS +{peak:,.0f} MiB")
+    finally:
+        shutil.rmtree(directory)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+async def delay_stream(reader, writer, delay):
+    # forward everything read `delay` seconds later, in order, then close
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    async def forward():
+        while True:
+            due, data = await chunks.get()
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            if not data:
+                writer.close()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    forwarder = asyncio.create_task(forward())
+    while True:
+        data = await reader.read(65536)
+        await chunks.put((loop.time() + delay, data))
+        if not data:
+            break
+    await forwarder
+
+
+def run_delay_proxy(port, target_port, delay):
+    # TCP proxy adding `delay` seconds each way, to emulate the network round trip on loopback
+    async def connection(reader, writer):
+        target_reader, target_writer = await asyncio.open_connection('localhost', target_port)
+        await asyncio.gather(delay_stream(reader, target_writer, delay), delay_stream(target_reader, writer, delay))
+
+    listening = threading.Event()
+
+    async def serve():
+        server = await asyncio.start_server(connection, 'localhost', port)
+        listening.set()
+        await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    listening.wait()
+
+
+def replay_through_simulator(capture, window, rtt, run_client):
+    # the simulator replays the capture with `window` messages in flight to run_client(sock)
+    mllp_port, pager_port = free_port(), free_port()
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulator.py'),
+                                  f'--messages={capture}', f'--mllp={mllp_port}', f'--pager={pager_port}', f'--window={window}'],
+                                 stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                urllib.request.urlopen(f'http://localhost:{pager_port}/healthy')
+                break
+            except OSError:
+                time.sleep(0.1)
+        port = mllp_port
+        if rtt:
+            port = free_port()
+            run_delay_proxy(port, mllp_port, rtt / 2)
+        acknowledged = metrics.MESSAGES_ACKNOWLEDGED._value.get()
+        start = time.perf_counter()
+        run_client(ingestion.connect(f'localhost:{port}'))
+        elapsed = time.perf_counter() - start
+        return int(metrics.MESSAGES_ACKNOWLEDGED._value.get() - acknowledged), elapsed
+    finally:
+        urllib.request.urlopen(f'http://localhost:{pager_port}/shutdown')
+        simulator.wait()
+
+
+def replay_with_window(capture, window, rtt, model, directory, fsync=False):
+    # the async ingestion engine with the detector in this process
+    store = PatientStore()
+    app.patient_store = store
+    app.patient_journal = Journal(directory, fsync=fsync)
+    app.patient_snapshotter = Snapshotter(directory, store, app.patient_journal, interval=float('inf'))
+    state = {'model': model, 'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+             'input_quantiles': RollingQuantiles(), 'recorded_predictions': [], 'message_time': True}
+    try:
+        return replay_through_simulator(capture, window, rtt, lambda sock: ingestion.run(
+            sock, None, lambda mrn, date: None, durability=app.patient_journal, handle_batch=lambda messages: app.handle_batch(messages, state)))
+    finally:
+        app.patient_journal.close()
+
+
+def bench_ack_window(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        capture = os.path.join(directory, 'capture.mllp')
+        write_synthetic_capture(capture, flags.messages)
+        model = load_engine(flags.model)
+        baseline = None
+        for window in (int(size) for size in flags.windows.split(',')):
+            journal_directory = os.path.join(directory, f'state-{window}')
+            acknowledged, elapsed = replay_with_window(capture, window, flags.rtt_ms / 1000, model, journal_directory)
+            throughput = acknowledged / elapsed
+            baseline = baseline or throughput
+            print(f"ack_window {window:>4}: {acknowledged} messages acknowledged in {elapsed:6.2f}s, "
+                  f"{throughput:8,.0f} messages/s, {throughput / baseline:5.1f}x stop-and-wait")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_shards(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        capture = os.path.join(directory, 'capture.mllp')
+        write_synthetic_capture(capture, flags.messages)
+        print(f"shards: {os.cpu_count()} CPUs, {flags.messages} messages, window {flags.window}")
+        model = load_engine(flags.model)
+        # the workers fsync their journals, so does the baseline
+        acknowledged, elapsed = replay_with_window(capture, flags.window, 0, model, os.path.join(directory, 'state'), fsync=True)
+        baseline = acknowledged / elapsed
+        print(f"shards in-process: {acknowledged} messages acknowledged in {elapsed:6.2f}s, {baseline:8,.0f} messages/s")
+        for workers in (int(size) for size in flags.workers.split(',')):
+            start = time.perf_counter()
+            shard_workers = sharding.start_workers(workers, {
+                'history': flags.history, 'state_dir': os.path.join(directory, f'state-{workers}'),
+                'commit_interval': DEFAULT_COMMIT_INTERVAL, 'snapshot_interval': float('inf'),
+                'model': flags.model, 'threshold': DEFAULT_THRESHOLD, 'input_window': DEFAULT_WINDOW, 'message_time': True,
+            })
+            ready = time.perf_counter() - start
+            try:
+                acknowledged, elapsed = replay_through_simulator(capture, flags.window, 0, lambda sock: sharding.run(
+                    sock, shard_workers, lambda mrn, date: None))
+            finally:
+                sharding.stop_workers(shard_workers)
+            throughput = acknowledged / elapsed
+            print(f"shards {workers:>2} workers: {acknowledged} messages acknowledged in {elapsed:6.2f}s, {throughput:8,.0f} messages/s, "
+                  f"{throughput / baseline:5.2f}x in-process, workers ready in {ready:.1f}s")
+    finally:
+        shutil.rmtree(directory)
+
+
+def scrape(url):
+    # samples of a Prometheus text exposition, by name with labels
+    samples = {}
+    with urllib.request.urlopen(url) as response:
+        for line in response.read().decode().splitlines():
+            if line and not line.startswith('#'):
+                name, _, value = line.rpartition(' ')
+                samples[name] = float(value)
+    return samples
+
+
+def bench_startup(flags):
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        history = os.path.join(directory, 'history.csv')
+        write_synthetic_history_csv(history, flags.patients)
+        server = socket.create_server(('localhost', 0))
+        metrics_port = free_port()
+        environment = dict(os.environ, MLLP_ADDRESS=f'localhost:{server.getsockname()[1]}', PAGER_ADDRESS=f'localhost:{free_port()}')
+        start = time.perf_counter()
+        service = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py'),
+                                    '--ingestion=async', f'--history={history}', f'--state_dir={os.path.join(directory, "state")}',
+                                    f'--metrics_port={metrics_port}'], env=environment, stdout=subprocess.DEVNULL)
+        try:
+            sock, _ = server.accept()
+            connected = time.perf_counter() - start
+            # the first message is sent as soon as the connection is up, as the simulator does
+            sock.sendall(to_mllp(oru_message('100000', '20240501120000', 70.5)))
+            ready = None
+            while ready is None:
+                try:
+                    urllib.request.urlopen(f'http://localhost:{metrics_port}/ready')
+                    ready = time.perf_counter() - start
+                except OSError:
+                    # 503 while loading, or the metrics server is not up yet
+                    time.sleep(0.005)
+            sock.recv(4096)
+            acknowledged = time.perf_counter() - start
+            phases = scrape(f'http://localhost:{metrics_port}/metrics')
+            sock.close()
+            service.wait()
+        finally:
+            if service.poll() is None:
+                service.kill()
+            server.close()
+        phase = lambda name: phases[f'startup_phase_seconds{{phase="{name}"}}']
+        print(f"startup {flags.patients} patients: connected after {connected:.2f}s, ready after {ready:.2f}s, first ACK after {acknowledged:.2f}s")
+        print(f"startup phases: history {phase('history'):.2f}s, journal_replay {phase('journal_replay'):.2f}s, model {phase('model'):.2f}s "
+              f"loaded in parallel, connect {phase('connect'):.3f}s, ready {phase('ready'):.2f}s after main() started, "
+              f"{phases['startup_buffered_messages']:.0f} messages buffered while loading")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_retention(flags):
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    historical_data = synthetic_history(flags.patients)
+    start = hl7_to_epoch('20240201120000')
+    for results in [int(size) for size in flags.sizes.split(',')]:
+        line = f"retention {results:>7} results of one patient:"
+        for label, max_results in (('unbounded', None), (f'max {flags.max_results}', flags.max_results)):
+            store = PatientStore.from_dataframe(historical_data)
+            store.set_retention(max_results)
+            mrn = store.mrns()[0]
+            for i in range(results - flags.timed):
+                store.append_result(mrn, start + 3600 * i, 70.5)
+            began = time.perf_counter()
+            for i in range(results - flags.timed, results):
+                store.append_result(mrn, start + 3600 * i, 70.5)
+            per_result = (time.perf_counter() - began) / flags.timed
+            line += f" {label} {per_result * 1e6:,.2f}us/ORU {store.nbytes() / 2**20:,.1f} MiB,"
+        print(line.rstrip(','))
+    # the DataFrame path keeps the width of the history layout however many results arrive
+    mrn = historical_data['mrn'].iloc[0]
+    width = historical_data.shape[1]
+    input_quantiles = RollingQuantiles()
+    began = time.perf_counter()
+    for i in range(flags.frame_results):
+        new_data = {'test_time': datetime.utcfromtimestamp(start + 3600 * i).strftime('%Y%m%d%H%M%S'), 'test_result': '70.5'}
+        combined, input_quantiles, _ = aggregate_data(new_data, get_patient_history(historical_data, mrn), input_quantiles)
+        update_patient_data(mrn, combined, historical_data, type='ORU')
+    per_result = (time.perf_counter() - began) / flags.frame_results
+    print(f"retention DataFrame {flags.frame_results} results of one patient: {per_result * 1e3:,.2f}ms/ORU, "
+          f"{width} columns before, {historical_data.shape[1]} after")
+
+
+def bench_backfill(flags):
+    # offline backfill of a generated capture against the in-process streaming detector, which replaying through app.py bounds from above
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    directory = tempfile.mkdtemp(dir=flags.directory)
+    try:
+        capture = os.path.join(directory, 'messages.mllp')
+        with open(capture, 'wb') as file:
+            for message in itertools.islice(generate_hl7_messages(flags.patients, seed=1), flags.messages):
+                file.write(to_mllp_frame(message))
+        columns = columns_from_history(load_history_arrays(flags.history))
+        model = load_engine(flags.model)
+
+        start = time.perf_counter()
+        predictions, stats = backfill(read_capture(capture), HistoryBase(sort_columns(columns)), model)
+        batch = time.perf_counter() - start
+        start = time.perf_counter()
+        messages = list(read_capture(capture))
+        read = time.perf_counter() - start
+
+        app.patient_store = PatientStore.from_columns(columns)
+        app.patient_journal = Journal(os.path.join(directory, 'state'), fsync=False)
+        app.patient_snapshotter = Snapshotter(os.path.join(directory, 'state'), app.patient_store, app.patient_journal, interval=float('inf'))
+        state = {'model': model, 'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+                 'input_quantiles': RollingQuantiles(), 'recorded_predictions': [], 'message_time': True}
+        start = time.perf_counter()
+        for i in range(0, len(messages), flags.batch_size):
+            app.handle_batch(messages[i:i + flags.batch_size], state)
+        streaming = time.perf_counter() - start
+        app.patient_journal.close()
+    finally:
+        shutil.rmtree(directory)
+    same = predictions.to_dict('records') == state['recorded_predictions']
+    print(f"backfill {len(messages)} messages, {stats['results']} results: capture read in {read:.2f}s for the streaming replay")
+    print(f"    streaming (handle_batch of {flags.batch_size}, no fsync): {streaming:.2f}s, {len(messages) / streaming:>9,.0f} messages/s")
+    print(f"    batch: {batch:.2f}s, {len(messages) / batch:>9,.0f} messages/s (parse {stats['parse']:.2f}s, "
+          f"features {stats['features']:.2f}s, predict {stats['predict']:.2f}s)")
+    print(f"    {len(predictions)} predictions, {'identical to' if same else 'DIFFERENT from'} streaming")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the AKI detection service')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    mllp = subparsers.add_parser('mllp', help='MLLP framer throughput for split, coalesced and oversized frames')
+    mllp.add_argument('--frames', type=int, default=200000, help='number of frames per scenario')
+    mllp.add_argument('--oversized_bytes', type=int, default=256 * 1024, help='payload size of oversized frames')
+    mllp.set_defaults(run=bench_mllp)
+
+    store = subparsers.add_parser('store', help='DataFrame patient functions against the MRN-indexed PatientStore')
+    store.add_argument('--sizes', default='10000,100000,1000000', help='comma separated patient counts')
+    store.add_argument('--operations', type=int, default=20, help='operations timed per size')
+    store.set_defaults(run=bench_store)
+
+    journal = subparsers.add_parser('journal', help='journal group commit throughput and replay speed')
+    journal.add_argument('--directory', default=None, help='parent directory for the test journal, use the state volume to measure its fsync cost')
+    journal.add_argument('--records', type=int, default=20000, help='records written per scenario')
+    journal.add_argument('--writers', default='1,8,32', help='comma separated numbers of concurrent waiting writers')
+    journal.add_argument('--commit_ms', type=float, default=1.0, help='group commit latency bound')
+    journal.set_defaults(run=bench_journal)
+
+    snapshot = subparsers.add_parser('snapshot', help='snapshot capture pause, write time and restart time against the csv reload')
+    snapshot.add_argument('--sizes', default='100000,1000000', help='comma separated patient counts')
+    snapshot.add_argument('--tail', type=int, default=10000, help='journal records written before and after the snapshot')
+    snapshot.add_argument('--directory', default=None, help='parent directory for the test state')
+    snapshot.set_defaults(run=bench_snapshot)
+
+    history = subparsers.add_parser('history', help='startup time and resident memory: csv DataFrame and typed array loads against the lazily read csv and the memory-mapped compiled history')
+    history.add_argument('--patients', type=int, default=200000, help='patients in the synthetic history')
+    history.add_argument('--lookups', type=int, default=10000, help='patients written to after startup')
+    history.add_argument('--directory', default=None, help='parent directory for the test files')
+    history.set_defaults(run=bench_history)
+
+    history_loader = subparsers.add_parser('history_loader', help='history csv parse time and peak memory: csv.reader row loop against the chunked vectorized loader')
+    history_loader.add_argument('--sizes', default='200000,1000000', help='comma separated row counts of the synthetic history')
+    history_loader.add_argument('--chunk_bytes', type=int, default=1 << 20, help='bytes parsed per chunk by the vectorized loader')
+    history_loader.add_argument('--legacy_rows', type=int, default=200000, help='largest history the csv.reader baseline is run on')
+    history_loader.add_argument('--directory', default=None, help='parent directory for the test files')
+    history_loader.set_defaults(run=bench_history_loader)
+
+    inference = subparsers.add_parser('inference', help='per-prediction latency: predict_aki DataFrame path, XGBClassifier on a feature row and the in-place Booster engine')
+    inference.add_argument('--predictions', type=int, default=5000, help='predictions timed per path')
+    inference.set_defaults(run=bench_inference)
+
+    batch = subparsers.add_parser('batch', help='ORU throughput when the detector scores micro-batches of messages with one model call')
+    batch.add_argument('--sizes', default='1,8,32,128', help='comma separated batch sizes')
+    batch.add_argument('--messages', type=int, default=5000, help='ORU messages applied per batch size')
+    batch.add_argument('--directory', default=None, help='parent directory for the test journal')
+    batch.set_defaults(run=bench_batch)
+
+    window = subparsers.add_parser('window', help='per-result cost of the rolling input quantiles against the DataFrame last-hour median')
+    window.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma separated numbers of results held in the window')
+    window.add_argument('--operations', type=int, default=100000, help='results added per size')
+    window.add_argument('--legacy_size', type=int, default=100000, help='largest window the DataFrame baseline is run on')
+    window.add_argument('--legacy_operations', type=int, default=200, help='results added per size to the DataFrame baseline')
+    window.set_defaults(run=bench_window)
+
+    hl7 = subparsers.add_parser('hl7', help='per-message HL7 parse time: regex parser against the byte-level tokenizer')
+    hl7.add_argument('--messages', type=int, default=20000, help='parses per message type')
+    hl7.set_defaults(run=bench_hl7)
+
+    pipeline = subparsers.add_parser('pipeline', help='in-process replay of an MLLP capture: messages/s, per-stage latency percentiles and peak RSS as JSON')
+    pipeline.add_argument('--messages', default='messages.mllp', help='MLLP capture to replay, as simulator.py reads it')
+    pipeline.add_argument('--history', default='history.csv', help='history csv the patient store starts from')
+    pipeline.add_argument('--compiled_history', default=None, help='start from this compiled history instead, compiled first if missing')
+    pipeline.add_argument('--model', default='aki_model.json', help='model file')
+    pipeline.add_argument('--batch_size', type=int, default=1, help='messages per handle_batch call, 1 scores every blood test on its own')
+    pipeline.add_argument('--fsync', action='store_true', help='fsync the journal, off by default to measure the pipeline alone')
+    pipeline.add_argument('--directory', default=None, help='parent directory for the test journal')
+    pipeline.add_argument('--output', default=None, help='also write the JSON report to this file')
+    pipeline.set_defaults(run=bench_pipeline)
+
+    capture = subparsers.add_parser('capture', help='simulator capture reading: byte loop parser against the bytes.find codec, whole file and streamed from mmap')
+    capture.add_argument('--messages', type=int, default=1000000, help='messages in the synthetic capture')
+    capture.add_argument('--legacy_messages', type=int, default=1000000, help='largest capture the byte loop parser is run on')
+    capture.add_argument('--directory', default=None, help='parent directory for the capture file')
+    capture.set_defaults(run=bench_capture)
+
+    ack_window = subparsers.add_parser('ack_window', help='simulator to async ingestion throughput with up to N unacknowledged messages in flight')
+    ack_window.add_argument('--windows', default='1,2,4,8,16,32', help='comma separated window sizes, 1 is stop-and-wait')
+    ack_window.add_argument('--messages', type=int, default=5000, help='messages in the synthetic capture')
+    ack_window.add_argument('--rtt_ms', type=float, default=2.0, help='network round trip emulated by a delaying proxy, 0 connects directly')
+    ack_window.add_argument('--model', default='aki_model.json', help='model file')
+    ack_window.add_argument('--directory', default=None, help='parent directory for the capture and test journals')
+    ack_window.set_defaults(run=bench_ack_window)
+
+    shards = subparsers.add_parser('shards', help='throughput of the detector in 1, 2, 4 and 8 MRN-sharded worker processes against the in-process engine')
+    shards.add_argument('--workers', default='1,2,4,8', help='comma separated numbers of worker processes')
+    shards.add_argument('--messages', type=int, default=20000, help='messages in the synthetic capture')
+    shards.add_argument('--window', type=int, default=64, help='messages the simulator keeps in flight')
+    shards.add_argument('--history', default='history.csv', help='history csv each worker loads its shard of')
+    shards.add_argument('--model', default='aki_model.json', help='model file')
+    shards.add_argument('--directory', default=None, help='parent directory for the capture and worker state')
+    shards.set_defaults(run=bench_shards)
+
+    startup = subparsers.add_parser('startup', help='app.py startup: time to the MLLP connection, to /ready and to the first ACK, and the startup phase metrics')
+    startup.add_argument('--patients', type=int, default=1000000, help='patients in the synthetic history csv')
+    startup.add_argument('--directory', default=None, help='parent directory for the history and the state')
+    startup.set_defaults(run=bench_startup)
+
+    retention = subparsers.add_parser('retention', help='per-ORU cost and store memory as one patient\'s history grows, unbounded against per-patient retention')
+    retention.add_argument('--sizes', default='1000,10000,100000', help='comma separated result counts of the busy patient')
+    retention.add_argument('--patients', type=int, default=100000, help='patients in the synthetic history')
+    retention.add_argument('--max_results', type=int, default=50, help='results kept per patient')
+    retention.add_argument('--timed', type=int, default=1000, help='last results of each size that are timed')
+    retention.add_argument('--frame_results', type=int, default=200, help='results appended through the DataFrame functions')
+    retention.set_defaults(run=bench_retention)
+
+    backfill_parser = subparsers.add_parser('backfill', help='app.py --batch over a generated capture against the in-process streaming detector')
+    backfill_parser.add_argument('--messages', type=int, default=200000, help='messages in the generated capture')
+    backfill_parser.add_argument('--patients', type=int, default=20000, help='patients the generated messages are about')
+    backfill_parser.add_argument('--batch_size', type=int, default=64, help='micro-batch size of the streaming detector')
+    backfill_parser.add_argument('--history', default='history.csv', help='history csv')
+    backfill_parser.add_argument('--model', default='aki_model.json', help='model file')
+    backfill_parser.add_argument('--directory', default=None, help='parent directory for the capture and the streaming journal')
+    backfill_parser.set_defaults(run=bench_backfill)
+
+    flags = parser.parse_args()
+    flags.run(flags)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import bisect
+import hashlib
+import http.server
+import json
+import socket
+import struct
+import threading
+import time
+
+from prometheus_client import start_http_server
+
+import ingestion
+import metrics
+from journal import decode, encode_patient, RECORD_PATIENT
+from listener import MLLPFramer, MLLP_START_BLOCK, MLLP_FRAME_END
+from sharding import message_mrn
+
+# points every replica owns on the ring
+RING_VNODES = 64
+# messages routed to the replicas and not acknowledged upstream yet before the router stops reading
+ROUTER_IN_FLIGHT = 1000
+# handoff stream framing: target name length (0 ends an export), record length (0 ends an import)
+NAME = struct.Struct('<H')
+RECORD = struct.Struct('<I')
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+
+class HashRing:
+    '''
+    Description:
+        Consistent-hash ring of replicas. Every replica owns `vnodes` points and a patient
+        belongs to the replica of the first point at or after the hash of its MRN, so adding
+        or removing one of N replicas only moves about 1/N of the patients.
+    '''
+
+    def __init__(self, nodes, vnodes=RING_VNODES):
+        self.nodes = sorted(set(nodes))
+        self.vnodes = vnodes
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, mrn):
+        if not self._owners:
+            raise ValueError('the ring has no replicas')
+        i = bisect.bisect_left(self._hashes, ring_hash(mrn))
+        return self._owners[i % len(self._owners)]
+
+
+def read_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ConnectionError('handoff stream ended early')
+    return data
+
+
+def send_request(sock, request):
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+
+def export_patients(store, old_ring, ring, name):
+    '''
+    Description:
+        Patients this replica owns on `old_ring` that `ring` assigns to another replica, as
+        journal records of their whole state. Copies left behind by earlier handoffs are stale
+        and never exported. With a compiled history base only the overlay is exported, every
+        replica memory-maps the same base.
+    output:
+        generator of (target replica, record)
+    '''
+    for mrn in store.overlay_mrns():
+        if old_ring.owner(mrn) != name:
+            continue
+        target = ring.owner(mrn)
+        if target != name:
+            yield target, encode_patient(mrn, *store.patient_state(mrn))
+
+
+def import_patients(file, store, journal):
+    '''
+    Description:
+        Apply a stream of handed over patients: each replaces what the store held for the patient
+        and is journaled, so it survives a restart. Returns once every record is durable.
+    output:
+        count: INT
+    '''
+    count = 0
+    while True:
+        length, = RECORD.unpack(read_exactly(file, RECORD.size))
+        if not length:
+            break
+        payload = read_exactly(file, length)
+        record_type, mrn, state = decode(payload)
+        if record_type != RECORD_PATIENT:
+            raise ValueError(f'unexpected record type {record_type} in a handoff')
+        journal.append_patient(mrn, *state)
+        store.replace_patient(mrn, *state)
+        count += 1
+    journal.wait_durable()
+    return count
+
+
+def serve_handoff_connection(connection, store, journal):
+    with connection, connection.makefile('rb') as file:
+        request = json.loads(file.readline())
+        if request['op'] == 'export':
+            old_ring = HashRing(request['old'], request['vnodes'])
+            ring = HashRing(request['ring'], request['vnodes'])
+            count = 0
+            for target, record in export_patients(store, old_ring, ring, request['self']):
+                target = target.encode()
+                connection.sendall(NAME.pack(len(target)) + target + RECORD.pack(len(record)) + record)
+                count += 1
+            connection.sendall(NAME.pack(0))
+            print(f"handoff: exported {count} patients")
+        elif request['op'] == 'import':
+            count = import_patients(file, store, journal)
+            connection.sendall(json.dumps({'imported': count}).encode() + b'\n')
+            print(f"handoff: imported {count} patients")
+
+
+def serve_handoff(url, store, journal):
+    '''
+    Description:
+        Serve shard handoff requests of the router on a background thread. The router stops
+        routing messages to the replicas before a handoff, so the store is not written
+        concurrently by the detector.
+    input:
+        url: STRING host:port
+        store: PatientStore
+        journal: Journal
+    '''
+    host_name, port = url.split(':')
+    server = socket.create_server((host_name, int(port)))
+
+    def accept_loop():
+        while True:
+            connection, _ = server.accept()
+            try:
+                serve_handoff_connection(connection, store, journal)
+            except (OSError, ValueError) as e:
+                print(f"handoff: {e}")
+
+    threading.Thread(target=accept_loop, name='handoff', daemon=True).start()
+    print(f'Serving shard handoffs on {host_name}:{port}')
+    return server
+
+
+def hand_off(source, handoff_urls, old_ring, ring):
+    '''
+    Description:
+        Stream the patients `source` owns on `old_ring` that `ring` assigns elsewhere to their new owners
+    input:
+        source: STRING replica name
+        handoff_urls: DIC replica name -> host:port of its handoff server
+        old_ring, ring: HashRing, the current and the new ring
+    output:
+        moved: INT
+    '''
+    targets = {}
+    moved = 0
+    host_name, port = handoff_urls[source].split(':')
+    with socket.create_connection((host_name, int(port))) as sock, sock.makefile('rb') as file:
+        send_request(sock, {'op': 'export', 'old': old_ring.nodes, 'ring': ring.nodes, 'vnodes': ring.vnodes, 'self': source})
+        while True:
+            length, = NAME.unpack(read_exactly(file, NAME.size))
+            if not length:
+                break
+            target = read_exactly(file, length).decode()
+            size, = RECORD.unpack(read_exactly(file, RECORD.size))
+            record = read_exactly(file, size)
+            if target not in targets:
+                host_name, port = handoff_urls[target].split(':')
+                targets[target] = socket.create_connection((host_name, int(port)))
+                send_request(targets[target], {'op': 'import'})
+            targets[target].sendall(RECORD.pack(size) + record)
+            moved += 1
+    for target, connection in targets.items():
+        with connection, connection.makefile('rb') as file:
+            connection.sendall(RECORD.pack(0))
+            # the new owner answers once the patients are durable
+            reply = file.readline()
+            if not reply:
+                raise ConnectionError(f'{target} closed the handoff before confirming it')
+    return moved
+
+
+class Router:
+    '''
+    Description:
+        Forwards the frames of one upstream MLLP connection to the replica owning each
+        message's MRN on the hash ring, and the replicas' ACKs upstream in message order.
+        resize() changes the ring: routing pauses, the acknowledged messages drain, every
+        patient whose owner changes is streamed to its new owner, then routing resumes.
+    '''
+
+    def __init__(self, replicas, vnodes=RING_VNODES):
+        # replica name -> (MLLP host:port, handoff host:port)
+        self.replicas = dict(replicas)
+        self.ring = HashRing(self.replicas, vnodes)
+        self.connections = {}
+        self.acks = {}
+        self.outstanding = 0
+        self.loop = None
+        self._routing = None
+        self._drained = None
+        self._readers = {}
+
+    async def _connect(self, name):
+        sock = ingestion.connect(self.replicas[name][0])
+        self.connections[name] = sock
+        self.acks[name] = asyncio.Queue()
+        self._readers[name] = asyncio.ensure_future(self._read_acks(name, sock))
+
+    async def _read_acks(self, name, sock):
+        framer = MLLPFramer()
+        try:
+            while True:
+                received = await self.loop.sock_recv_into(sock, framer.receive_buffer())
+                if received == 0:
+                    raise ConnectionError(f'replica {name} closed the connection')
+                framer.commit(received)
+                for ack in framer:
+                    self.acks[name].put_nowait(ack)
+        except (OSError, ConnectionError) as e:
+            self.acks[name].put_nowait(e)
+
+    async def _disconnect(self, name):
+        self._readers.pop(name).cancel()
+        self.connections.pop(name).close()
+        self.acks.pop(name)
+
+    async def _route(self, frames, in_flight):
+        try:
+            while True:
+                item = await frames.get()
+                if item is None:
+                    break
+                message, start_time = item
+                async with self._routing:
+                    owner = self.ring.owner(message_mrn(message))
+                    self.outstanding += 1
+                    self._drained.clear()
+                    await in_flight.put((owner, start_time))
+                    await self.loop.sock_sendall(self.connections[owner], MLLP_START_BLOCK + message + MLLP_FRAME_END)
+        finally:
+            await in_flight.put(None)
+
+    async def _forward_acks(self, upstream, in_flight):
+        while True:
+            item = await in_flight.get()
+            if item is None:
+                break
+            owner, start_time = item
+            ack = await self.acks[owner].get()
+            if isinstance(ack, Exception):
+                raise ack
+            if b'MSA|AR' in ack:
+                # the replica could not parse the message, the sender gets no ACK as from a single service
+                metrics.MESSAGES_REJECTED.inc()
+            else:
+                await self.loop.sock_sendall(upstream, MLLP_START_BLOCK + ack + MLLP_FRAME_END)
+                metrics.MESSAGES_ACKNOWLEDGED.inc()
+                metrics.observe('overall', time.time() - start_time)
+            self.outstanding -= 1
+            if not self.outstanding:
+                self._drained.set()
+
+    async def resize(self, replicas):
+        '''
+        Description:
+            Move to a ring of `replicas` (name -> (MLLP host:port, handoff host:port)), handing
+            over the patients whose owner changes
+        output:
+            moved: INT, patients streamed to a new owner
+        '''
+        start = time.time()
+        async with self._routing:
+            await self._drained.wait()
+            addresses = dict(self.replicas)
+            addresses.update(replicas)
+            handoff_urls = {name: address[1] for name, address in addresses.items()}
+            ring = HashRing(replicas, self.ring.vnodes)
+            moved = 0
+            for source in self.ring.nodes:
+                moved += await self.loop.run_in_executor(None, hand_off, source, handoff_urls, self.ring, ring)
+            self.replicas = dict(replicas)
+            for name in ring.nodes:
+                if name not in self.connections:
+                    await self._connect(name)
+            for name in list(self.connections):
+                if name not in self.replicas:
+                    await self._disconnect(name)
+            self.ring = ring
+        metrics.HANDOFF_PATIENTS.inc(moved)
+        metrics.HANDOFF_DURATION.set(time.time() - start)
+        print(f"router: ring {', '.join(ring.nodes)}, {moved} patients handed over in {time.time() - start:.2f}s")
+        return moved
+
+    async def run(self, upstream):
+        self.loop = asyncio.get_running_loop()
+        self._routing = asyncio.Lock()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        for name in self.ring.nodes:
+            await self._connect(name)
+        frames = asyncio.Queue(maxsize=ROUTER_IN_FLIGHT)
+        in_flight = asyncio.Queue(maxsize=ROUTER_IN_FLIGHT)
+        try:
+            await asyncio.gather(
+                ingestion.read_frames(self.loop, upstream, frames),
+                self._route(frames, in_flight),
+                self._forward_acks(upstream, in_flight),
+            )
+        finally:
+            for name in list(self.connections):
+                await self._disconnect(name)
+            upstream.close()
+
+
+def parse_replica(value):
+    '''
+    Description:
+        Parse a --replica value: name=MLLP host:port,handoff host:port
+    output:
+        (name, (mllp, handoff))
+    '''
+    name, _, addresses = value.partition('=')
+    mllp, _, handoff = addresses.partition(',')
+    if not name or not mllp or not handoff:
+        raise argparse.ArgumentTypeError(f'expected name=mllp_host:port,handoff_host:port, got {value!r}')
+    return name, (mllp, handoff)
+
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+    # GET /ring returns the replicas, POST /ring with {"name": ["mllp", "handoff"], ...} resizes the ring
+
+    def __init__(self, router, *args, **kwargs):
+        self.router = router
+        super().__init__(*args, **kwargs)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode() + b'\n')
+
+    def do_GET(self):
+        if self.path != '/ring':
+            return self.reply(404, {'error': 'not /ring'})
+        self.reply(200, {'replicas': self.router.replicas})
+
+    def do_POST(self):
+        if self.path != '/ring':
+            return self.reply(404, {'error': 'not /ring'})
+        try:
+            replicas = {name: tuple(address) for name, address in json.loads(self.rfile.read(int(self.headers['Content-Length']))).items()}
+        except (ValueError, TypeError, KeyError) as e:
+            return self.reply(400, {'error': f'bad ring: {e}'})
+        if not replicas or self.router.loop is None:
+            return self.reply(400, {'error': 'no replicas, or the router is not running'})
+        start = time.time()
+        moved = asyncio.run_coroutine_threadsafe(self.router.resize(replicas), self.router.loop).result()
+        self.reply(200, {'replicas': self.router.replicas, 'moved': moved, 'seconds': time.time() - start})
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Route an MLLP feed to the replicas owning each MRN on a consistent-hash ring')
+    parser.add_argument('--mllp', default='localhost:8440', help='upstream MLLP address to read messages from')
+    parser.add_argument('--replica', type=parse_replica, action='append', required=True,
+                        help='name=mllp_host:port,handoff_host:port of a replica started with app.py --listen and --handoff, repeat for each')
+    parser.add_argument('--control', type=int, default=8450, help='port of the HTTP API to read and change the ring at /ring')
+    parser.add_argument('--metrics_port', type=int, default=8010, help='port to serve the router metrics on')
+    parser.add_argument('--vnodes', type=int, default=RING_VNODES, help='points per replica on the ring')
+    flags = parser.parse_args()
+    start_http_server(flags.metrics_port)
+    router = Router(dict(flags.replica), flags.vnodes)
+    control = http.server.ThreadingHTTPServer(('0.0.0.0', flags.control), lambda *args: ControlHandler(router, *args))
+    threading.Thread(target=control.serve_forever, daemon=True).start()
+    asyncio.run(router.run(ingestion.connect(flags.mllp)))
+    control.shutdown()
+
+if __name__ == "__main__":
+    main()
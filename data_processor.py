@@ -1,50 +1,210 @@
 import pandas as pd
-import csv
 import numpy as np
 from datetime import datetime
 
-def load_and_process_history(file_path):
+from patient_store import HISTORY_COLUMN_PAIRS
+
+# bytes of the history csv parsed at a time, bounds the memory used while parsing
+HISTORY_CHUNK_BYTES = 1 << 20
+# dates are written as YYYY-mm-dd HH:MM:SS, separator position -> byte
+HISTORY_DATE_SEPARATORS = {4: '-', 7: '-', 10: ' ', 13: ':', 16: ':'}
+
+def fixed_width_fields(data, starts, lengths):
+    # copy variable length fields into a zero padded (fields x width) byte matrix
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    columns = np.arange(width)
+    fields = data[np.minimum(starts[:, None] + columns, len(data) - 1)]
+    fields[columns >= lengths[:, None]] = 0
+    return fields
+
+def _parse_results(data, starts, lengths):
     '''
     Description:
-        This function reads the historical data from the csv file and processes it,
-        adds 'age' and 'sex' columns to the data, fills any empty values with None
+        This function parses plain decimal fields (digits and at most one point) with integer arithmetic,
+        the exact integer divided by a power of ten rounds the same way as float(). Any other field is
+        handed to numpy's float conversion.
+    '''
+    fields = fixed_width_fields(data, starts, lengths)
+    digits = fields.astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_point = fields == ord('.')
+    used = np.arange(fields.shape[1]) < lengths[:, None]
+    plain = ((is_digit | is_point) == used).all(axis=1) & (is_point.sum(axis=1) <= 1) & (lengths <= 15)
+    value = np.zeros(len(starts), dtype=np.int64)
+    for k in range(fields.shape[1]):
+        value = np.where(is_digit[:, k], value * 10 + digits[:, k], value)
+    point = np.where(is_point.any(axis=1), is_point.argmax(axis=1), lengths)
+    results = value / 10.0 ** np.maximum(lengths - point - 1, 0)
+    if not plain.all():
+        other = fields[~plain].view(f'S{fields.shape[1]}').ravel()
+        results[~plain] = pd.to_numeric(pd.Series(other.astype(str)), errors='coerce').to_numpy(dtype=np.float64)
+    return results
+
+def _parse_timestamps(data, starts, lengths):
+    '''
+    Description:
+        This function converts date fields to epoch seconds with integer arithmetic on the digits,
+        fields in any other format are handed to pd.to_datetime
+    '''
+    matches = lengths == 19
+    for position, separator in HISTORY_DATE_SEPARATORS.items():
+        matches &= data[np.minimum(starts + position, len(data) - 1)] == ord(separator)
+
+    def number(position, width):
+        nonlocal matches
+        value = np.zeros(len(starts), dtype=np.int64)
+        for k in range(position, position + width):
+            # bytes below '0' wrap around, so one comparison rejects every non-digit
+            digit = data[np.minimum(starts + k, len(data) - 1)] - np.uint8(ord('0'))
+            matches &= digit <= 9
+            value = value * 10 + digit
+        return value
+    year, month, day = number(0, 4), number(5, 2), number(8, 2)
+    hour, minute, second = number(11, 2), number(14, 2), number(17, 2)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month - 1, 0, 11)] + (leap & (month == 2))
+    matches &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days) & (hour <= 23) & (minute <= 59) & (second <= 59)
+    # days since 1970-01-01 of a proleptic gregorian date, counting years from March
+    shifted = year - (month <= 2)
+    era = shifted // 400
+    year_of_era = shifted - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    days = era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year - 719468
+    timestamps = (days * 86400 + hour * 3600 + minute * 60 + second).astype('datetime64[s]')
+
+    if not matches.all():
+        fields = fixed_width_fields(data, starts[~matches], lengths[~matches])
+        other = fields.view(f'S{fields.shape[1]}').ravel().astype(str)
+        timestamps[~matches] = pd.to_datetime(pd.Series(other), format='mixed', errors='coerce').to_numpy(dtype='datetime64[s]')
+    return timestamps
+
+def parse_history_block(block):
+    '''
+    Description:
+        This function tokenizes a block of complete csv lines with numpy: every comma and newline ends a field,
+        a non-empty date field followed by a non-empty result field on the same line is one pair
     input:
-        file_path: STRING
+        block: BYTES ending with a newline
     output:
-        processed_data: pd DataFrame with the following columns:
-        [mrn, age, sex, creatinine_date_0, creatinine_result_0, ..., creatinine_date_49, creatinine_result_49]
+        mrns: numpy array of bytes, lengths, timestamps, results
     '''
-    # Read csv file
-    with open(file_path, mode='r') as file:
-        reader = csv.reader(file)
-        historical_data = []
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero((data == ord(',')) | (data == ord('\n')))
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts
+    line_ends = np.flatnonzero(data[ends] == ord('\n'))
+    line_starts = np.empty(len(line_ends), dtype=np.int64)
+    line_starts[0] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    field_numbers = np.arange(len(ends)) - np.repeat(line_starts, line_ends + 1 - line_starts)
 
-        # Skip the header
-        next(reader, None)
+    # field 0 is the mrn, then date and result fields alternate
+    dates = np.flatnonzero(field_numbers[:-1] % 2 == 1)
+    dates = dates[(lengths[dates] > 0) & (field_numbers[dates + 1] == field_numbers[dates] + 1) & (lengths[dates + 1] > 0)]
+    timestamps = _parse_timestamps(data, starts[dates], lengths[dates])
+    results = _parse_results(data, starts[dates + 1], lengths[dates + 1])
+    valid = ~np.isnat(timestamps) & ~np.isnan(results)
+    lines = np.searchsorted(line_ends, dates[valid])
+    counts = np.bincount(lines, minlength=len(line_ends)).astype(np.int32)
 
-        for row in reader:
-            # Remove empty values
-            row = [item for item in row if item]
+    # skip blank lines
+    rows = lengths[line_starts] > 0
+    mrns = fixed_width_fields(data, starts[line_starts[rows]], lengths[line_starts[rows]])
+    mrns = mrns.view(f'S{mrns.shape[1]}').ravel()
+    return mrns, counts[rows], timestamps[valid], results[valid]
 
-            # Adding the first columns (mrn) back, and adding the second and the third columns as None to keep the same length
-            processed_row = row[:1] + [None] + [None] + row[1:] + [None] * (101 - len(row))
+def history_blocks(file_path, chunk_bytes=HISTORY_CHUNK_BYTES):
+    '''
+    Description:
+        This function reads the history csv after its header in blocks of about chunk_bytes complete lines,
+        a last line without a newline gets one
+    input:
+        file_path: STRING
+        chunk_bytes: INT
+    output:
+        generator of (position, block): byte offset of the block in the file, BYTES of complete lines
+    '''
+    with open(file_path, mode='rb') as file:
+        # Skip the header
+        position = len(file.readline())
+        remainder = b''
+        while True:
+            data = file.read(chunk_bytes)
+            block = remainder + data
+            if data:
+                cut = block.rfind(b'\n') + 1
+                block, remainder = block[:cut], block[cut:]
+            elif block and not block.endswith(b'\n'):
+                block += b'\n'
+            if block:
+                yield position, block
+                position += len(block)
+            if not data:
+                break
 
-            historical_data.append(processed_row)
+def load_history_arrays(file_path, chunk_bytes=HISTORY_CHUNK_BYTES):
+    '''
+    Description:
+        This function reads the ragged history csv in blocks of about chunk_bytes complete lines and parses
+        the date/result pairs of every block straight into typed arrays. Empty pairs are skipped, so each
+        patient's results are packed in the order of the file.
+    input:
+        file_path: STRING
+        chunk_bytes: INT
+    output:
+        history: DIC with the following numpy arrays:
+        mrns: STRING per patient
+        length: INT32 number of results per patient
+        timestamps: DATETIME64[s] of every result, patient after patient
+        results: FLOAT64 of every result, patient after patient
+    '''
+    mrns, lengths, timestamps, results = [], [], [], []
+    for _, block in history_blocks(file_path, chunk_bytes):
+        parsed = parse_history_block(block.replace(b'\r', b''))
+        for column, values in zip((mrns, lengths, timestamps, results), parsed):
+            column.append(values)
 
-    # fixed column names for the processed DataFrame
-    processed_column_names = ['mrn', 'age', 'sex']
+    return {
+        'mrns': np.char.decode(np.concatenate(mrns)) if mrns else np.zeros(0, dtype=str),
+        'length': np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int32),
+        'timestamps': np.concatenate(timestamps) if timestamps else np.zeros(0, dtype='datetime64[s]'),
+        'results': np.concatenate(results) if results else np.zeros(0, dtype=np.float64),
+    }
 
-    # add the creatinine date and result columns to the column names
-    for i in range(50):
-        processed_column_names.append(f'creatinine_date_{i}')
-        processed_column_names.append(f'creatinine_result_{i}')
 
-    processed_df = pd.DataFrame(historical_data, columns=processed_column_names)
+def load_and_process_history(file_path):
+    '''
+    Description:
+        This function reads the historical data from the csv file and processes it,
+        adds 'age' and 'sex' columns to the data, fills any empty values with None
+    input:
+        file_path: STRING
+    output:
+        processed_data: pd DataFrame with the following columns:
+        [mrn, age, sex, creatinine_date_0, creatinine_result_0, ..., creatinine_date_49, creatinine_result_49]
+    '''
+    history = load_history_arrays(file_path)
+    lengths = history['length']
+    count = len(lengths)
+    pairs = max(HISTORY_COLUMN_PAIRS, int(lengths.max()) if count else 0)
 
-    # convert None to np.nan for consistency
-    processed_df = processed_df.fillna(np.nan)
+    # scatter the packed results into a patients x pairs grid
+    rows = np.repeat(np.arange(count), lengths)
+    starts = np.zeros(count, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    positions = np.arange(len(rows)) - np.repeat(starts, lengths)
+    dates = np.full((count, pairs), np.datetime64('NaT'), dtype='datetime64[s]')
+    results = np.full((count, pairs), np.nan)
+    dates[rows, positions] = history['timestamps']
+    results[rows, positions] = history['results']
 
-    return processed_df
+    columns = {'mrn': history['mrns'].astype(object), 'age': np.full(count, np.nan), 'sex': np.full(count, np.nan)}
+    for i in range(pairs):
+        columns[f'creatinine_date_{i}'] = dates[:, i]
+        columns[f'creatinine_result_{i}'] = results[:, i]
+    return pd.DataFrame(columns)
 
 
 def update_patient_data(mrn, parsed_data, historical_data, type):
@@ -89,18 +249,19 @@ def update_patient_data(mrn, parsed_data, historical_data, type):
     elif type == 'ORU':
         combined_data = parsed_data
 
+        values = combined_data.values
         # Check if combined_data has more columns than historical_data
         num_extra_columns = (combined_data.shape[1] + 1) - historical_data.shape[1]
         if num_extra_columns > 0:
-            # Calculate the next index for the new columns based on existing column count
-            next_index = (historical_data.shape[1] - 3) // 2
-            new_date_col_name = f'creatinine_date_{next_index}'
-            new_result_col_name = f'creatinine_result_{next_index}'
-            # Add the new pair of columns with  None values
-            historical_data[new_date_col_name] = None
-            historical_data[new_result_col_name] = None
+            # keep the patient's newest results instead of widening every patient's row
+            pairs = values[0, 2:].reshape(-1, 2)
+            pairs = pairs[~pd.isna(pairs[:, 1])][-((historical_data.shape[1] - 3) // 2):]
+            row = np.full(historical_data.shape[1] - 1, np.nan, dtype=object)
+            row[:2] = values[0, :2]
+            row[2:2 + pairs.size] = pairs.ravel()
+            values = row[np.newaxis]
         # replace the whole row with the new data
-        historical_data.loc[historical_data['mrn'] == mrn, historical_data.columns[1:]] = combined_data.values
+        historical_data.loc[historical_data['mrn'] == mrn, historical_data.columns[1:]] = values
 
     return historical_data
 
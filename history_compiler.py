@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from data_processor import load_history_arrays
+from patient_store import HistoryBase, columns_from_history, sort_columns
+from snapshot import write_columns, load_columns
+
+"""
+    Compiles history.csv once into a memory-mappable columnar layout: a sorted MRN index,
+    per-patient offsets and lengths, and the packed int64 timestamps and float32 results.
+        python history_compiler.py history.csv history.compiled
+    The app maps the output read-only with --compiled_history and keeps only an overlay in memory.
+"""
+
+# size, modification time and hash of the csv a compiled history was compiled from, next to its columns
+SOURCE_FILE = 'source.json'
+# bytes of the csv hashed at a time
+HASH_CHUNK_BYTES = 1 << 20
+
+def compile_history(csv_path, output_path):
+    '''
+    Description:
+        Parse the history csv and write it in the compiled layout
+    input:
+        csv_path: STRING
+        output_path: STRING, directory of .npy columns to create or replace
+    output:
+        patients: INT
+    '''
+    # taken before parsing, so a csv replaced while compiling is seen as changed on the next start
+    source = source_fingerprint(csv_path)
+    columns = sort_columns(columns_from_history(load_history_arrays(csv_path)))
+    write_columns(output_path, columns)
+    write_source(output_path, source)
+    return len(columns['mrns'])
+
+def source_fingerprint(csv_path):
+    '''
+    Description:
+        Identify the content of a history csv
+    output:
+        source: DIC with size, mtime_ns and blake2b hex digest of the file
+    '''
+    stat = os.stat(csv_path)
+    digest = hashlib.blake2b()
+    with open(csv_path, 'rb') as file:
+        while True:
+            chunk = file.read(HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blake2b': digest.hexdigest()}
+
+def write_source(output_path, source):
+    # replaced atomically, a compiled history without it is compiled again
+    temporary = os.path.join(output_path, SOURCE_FILE + '.tmp')
+    with open(temporary, 'w') as file:
+        json.dump(source, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(temporary, os.path.join(output_path, SOURCE_FILE))
+
+def is_current(csv_path, output_path):
+    '''
+    Description:
+        Whether the compiled history at output_path was compiled from the csv as it is now. The csv
+        is only hashed when its size matches and its modification time does not, e.g. the same file
+        copied into a new image; the new modification time is then recorded.
+    output:
+        current: BOOL
+    '''
+    try:
+        with open(os.path.join(output_path, SOURCE_FILE)) as file:
+            source = json.load(file)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(csv_path)
+    if stat.st_size != source.get('size'):
+        return False
+    if stat.st_mtime_ns == source.get('mtime_ns'):
+        return True
+    fingerprint = source_fingerprint(csv_path)
+    if fingerprint['blake2b'] != source.get('blake2b'):
+        return False
+    write_source(output_path, fingerprint)
+    return True
+
+def ensure_compiled(csv_path, output_path):
+    '''
+    Description:
+        Compile the history unless output_path already holds it, compiled from the csv as it is
+        now; a compiled history of an older csv is replaced. Processes starting together on
+        the same volume, e.g. the shard workers or cluster replicas, hold a lock file next to the
+        output while they check, so only the first compiles and the others map its result.
+    input:
+        csv_path: STRING
+        output_path: STRING, directory of the compiled history
+    output:
+        compiled: BOOL, the history was compiled by this call
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(output_path):
+            if is_current(csv_path, output_path):
+                return False
+            print(f"{csv_path} changed since {output_path} was compiled, recompiling")
+        else:
+            print(f"compiling {csv_path} into {output_path}")
+        compile_history(csv_path, output_path)
+        return True
+
+def open_history_base(path):
+    '''
+    Description:
+        Memory-map a compiled history as a read-only base layer
+    output:
+        base: HistoryBase
+    '''
+    return HistoryBase(load_columns(path, mmap=True))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile history.csv into the memory-mapped base layout')
+    parser.add_argument('history', help='path of the history csv')
+    parser.add_argument('output', help='directory to write the compiled history to')
+    flags = parser.parse_args()
+    start = time.time()
+    patients = compile_history(flags.history, flags.output)
+    print(f"compiled {patients} patients into {flags.output} in {time.time() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from data_processor import HISTORY_CHUNK_BYTES, fixed_width_fields, history_blocks, parse_history_block
+from patient_store import HistoryBase, SEX_UNKNOWN
+
+# parsed patients kept in the working set
+DEFAULT_CACHE_PATIENTS = 100000
+# share of the container memory limit the process may use before cold patients are evicted
+MEMORY_BUDGET_FRACTION = 0.8
+# cache misses between two reads of the resident set size
+RSS_CHECK_INTERVAL = 256
+# cgroup v2 and v1 memory limit files
+CGROUP_MEMORY_LIMITS = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+# cgroup v1 reports no limit as a page-rounded 2**63
+UNLIMITED = 1 << 60
+
+
+def container_memory_limit():
+    '''
+    Description:
+        Memory limit of the container from its cgroup
+    output:
+        limit: INT bytes, None without a limit
+    '''
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < UNLIMITED:
+            return int(value)
+        return None
+    return None
+
+
+def default_memory_budget():
+    '''MEMORY_BUDGET_FRACTION of the container memory limit, None without a limit'''
+    limit = container_memory_limit()
+    return int(limit * MEMORY_BUDGET_FRACTION) if limit else None
+
+
+def resident_memory():
+    '''resident set size of this process, in bytes'''
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def build_index(path, chunk_bytes=HISTORY_CHUNK_BYTES):
+    '''
+    Description:
+        MRN -> byte range of every patient line of the history csv, in one pass that only looks
+        for the newlines and the first comma of each line; nothing else of the line is parsed
+    input:
+        path: STRING
+        chunk_bytes: INT, bytes read at a time
+    output:
+        keys: sorted numpy bytes array of MRNs
+        offsets: INT64 byte offset of each patient's line, in key order
+        lengths: INT32 byte length of each patient's line, in key order
+    '''
+    keys, offsets, lengths = [], [], []
+    for position, block in history_blocks(path, chunk_bytes):
+        array = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(array == ord('\n'))
+        starts = np.empty(len(ends), dtype=np.int64)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        commas = np.flatnonzero(array == ord(','))
+        first_comma = commas[np.minimum(np.searchsorted(commas, starts), len(commas) - 1)] if len(commas) else ends
+        mrn_ends = np.where(first_comma > starts, np.minimum(first_comma, ends), ends)
+        mrn_ends -= (mrn_ends == ends) & (array[np.maximum(ends - 1, 0)] == ord('\r'))
+        # skip blank lines
+        rows = mrn_ends > starts
+        fields = fixed_width_fields(array, starts[rows], mrn_ends[rows] - starts[rows])
+        keys.append(fields.view(f'S{fields.shape[1]}').ravel())
+        offsets.append(position + starts[rows])
+        lengths.append((ends - starts + 1)[rows].astype(np.int32))
+    if not keys:
+        return np.zeros(0, dtype='S1'), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    keys = np.concatenate(keys)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], np.concatenate(offsets)[order], np.concatenate(lengths)[order]
+
+
+class LazyHistory(HistoryBase):
+    '''
+    Description:
+        Read-only patient layer over the history csv itself: only an MRN -> byte offset index
+        is built at startup, a patient's line is read and parsed the first time the patient is
+        looked up. Parsed patients are kept in an LRU working set of at most `cache_patients`,
+        and when the resident set size of the process exceeds `memory_budget` the least
+        recently used half of the working set is evicted. Patients written to are copied into
+        the PatientStore overlay, so the working set only holds clean copies of the csv and
+        evicting them loses nothing.
+    '''
+
+    def __init__(self, path, cache_patients=DEFAULT_CACHE_PATIENTS, memory_budget=None):
+        self.path = path
+        self.mrn_keys, self._line_offset, self._line_length = build_index(path)
+        count = len(self.mrn_keys)
+        # history.csv has no demographics, they come with the ADT^A01 admission
+        self.age = np.full(count, np.nan, dtype=np.float32)
+        self.sex = np.full(count, SEX_UNKNOWN, dtype=np.int8)
+        self.cache_patients = cache_patients
+        self.memory_budget = memory_budget
+        self._mrns = None
+        self._fd = os.open(path, os.O_RDONLY)
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._misses = 0
+        # patients are looked up by the detector thread and the handoff server
+        self._lock = threading.Lock()
+        metrics.MEMORY_BUDGET.set(memory_budget or 0)
+        metrics.HISTORY_CACHE_PATIENTS.set_function(lambda: len(self._cache))
+        metrics.HISTORY_CACHE_BYTES.set_function(lambda: self._cache_bytes)
+
+    def series(self, position):
+        with self._lock:
+            cached = self._cache.get(position)
+            if cached is not None:
+                self._cache.move_to_end(position)
+                metrics.HISTORY_CACHE_HITS.inc()
+                return cached
+            metrics.HISTORY_CACHE_MISSES.inc()
+            _, timestamps, results = self._parse([self._line(position)])
+            timestamps.flags.writeable = False
+            results.flags.writeable = False
+            self._cache[position] = (timestamps, results)
+            self._cache_bytes += timestamps.nbytes + results.nbytes
+            while len(self._cache) > self.cache_patients:
+                self._evict()
+            self._misses += 1
+            if self.memory_budget and self._misses % RSS_CHECK_INTERVAL == 0 and resident_memory() > self.memory_budget:
+                target = self._cache_bytes // 2
+                while self._cache and self._cache_bytes > target:
+                    self._evict()
+            return timestamps, results
+
+    def _evict(self):
+        timestamps, results = self._cache.popitem(last=False)[1]
+        self._cache_bytes -= timestamps.nbytes + results.nbytes
+        metrics.HISTORY_CACHE_EVICTIONS.inc()
+
+    def _line(self, position):
+        line = os.pread(self._fd, int(self._line_length[position]), int(self._line_offset[position]))
+        return line.rstrip(b'\r\n').replace(b'\r', b'') + b'\n'
+
+    def _parse(self, lines):
+        # lengths, timestamps and results of complete csv lines, parsed together
+        _, lengths, timestamps, results = parse_history_block(b''.join(lines))
+        return lengths, timestamps.astype('datetime64[s]').view(np.int64), results.astype(np.float32)
+
+    def gather(self, positions):
+        '''
+        Description:
+            The series of the patients at `positions`, for exports of the whole store such as
+            PatientStore.columns(). Lines are read through the index and parsed about
+            HISTORY_CHUNK_BYTES at a time, past the working set, so an export neither holds the
+            csv in memory nor evicts the patients the detector is using.
+        output:
+            (offsets, lengths, timestamps, results): numpy arrays
+        '''
+        parsed = []
+        lines, size = [], 0
+        for position in positions:
+            lines.append(self._line(position))
+            size += len(lines[-1])
+            if size >= HISTORY_CHUNK_BYTES:
+                parsed.append(self._parse(lines))
+                lines, size = [], 0
+        if lines:
+            parsed.append(self._parse(lines))
+        if not parsed:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        lengths, timestamps, results = (np.concatenate(column) for column in zip(*parsed))
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        return offsets, lengths, timestamps, results
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_lazy_history(path, cache_patients=DEFAULT_CACHE_PATIENTS, memory_budget=None):
+    '''
+    Description:
+        Index the history csv as a lazily loaded base layer
+    input:
+        path: STRING
+        cache_patients: INT, parsed patients kept in the working set
+        memory_budget: INT bytes or None, defaults to MEMORY_BUDGET_FRACTION of the container memory limit
+    output:
+        base: LazyHistory
+    '''
+    return LazyHistory(path, cache_patients, memory_budget if memory_budget is not None else default_memory_budget())
@@ -1,75 +1,147 @@
-import re
 import metrics
 
+MESSAGE_TYPES = {b'ADT^A01': 'ADT^A01', b'ADT^A03': 'ADT^A03', b'ORU^R01': 'ORU^R01'}
+DIGITS = b'0123456789'
+DECIMAL = b'0123456789.'
+# OBR-2 to OBR-6, which the simulator leaves empty
+EMPTY_OBR_FIELDS = [b''] * 5
+# bytes \w matches, the characters that do not end a word for \b
+WORD = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'
+
+
+def _leading(field, characters):
+    '''prefix of field made of the given characters'''
+    return field[:len(field) - len(field.lstrip(characters))]
+
+
+def _is_version(field):
+    major, dot, minor = field.partition(b'.')
+    return bool(dot) and major.isdigit() and minor[:1].isdigit()
+
+
+def _parse_msh(segment):
+    # MSH-1 is the field separator itself, so fields[k] is MSH-(k + 1)
+    fields = segment.split(b'|')
+    if len(fields) < 10:
+        return None
+    date_and_time = fields[6]
+    if len(date_and_time) != 14 or not date_and_time.isdigit():
+        return None
+    message_type = MESSAGE_TYPES.get(fields[8])
+    if message_type is None:
+        # a trigger event followed by more components, e.g. ADT^A01^ADT_A01
+        message_type = MESSAGE_TYPES.get(fields[8][:7])
+        if message_type is None or fields[8][7:8] in WORD:
+            return None
+    # the version is MSH-12, but the regex parser accepted it in any later field
+    if not (len(fields) > 11 and _is_version(fields[11])) and not any(_is_version(field) for field in fields[9:]):
+        return None
+    return date_and_time.decode(), message_type
+
+
+def _parse_pid(segment, long):
+    fields = segment.split(b'|', 9)
+    if len(fields) < 4 or fields[2] or not fields[1].isdigit():
+        return None
+    if not long:
+        pid = _leading(fields[3], DIGITS)
+        return {'pid': pid.decode()} if pid else None
+    if len(fields) < 9 or fields[4] or fields[6] or not fields[5] or not fields[3].isdigit():
+        return None
+    if len(fields[7]) != 8 or not fields[7].isdigit():
+        return None
+    sex = fields[8][:1]
+    if sex != b'M' and sex != b'F':
+        return None
+    return {'pid': fields[3].decode(), 'name': fields[5].decode(), 'date_of_birth': fields[7].decode(), 'sex': sex.decode()}
+
+
+def _parse_obr(segment):
+    fields = segment.split(b'|', 8)
+    if len(fields) < 8 or fields[2:7] != EMPTY_OBR_FIELDS or not fields[1].isdigit():
+        return None
+    test_time = fields[7][:14]
+    return test_time.decode() if len(test_time) == 14 and test_time.isdigit() else None
+
+
+def _parse_obx(segment):
+    fields = segment.split(b'|', 6)
+    if len(fields) < 6 or fields[4] or not (fields[1].isdigit() and fields[2] and fields[3]):
+        return None
+    test_result = _leading(fields[5], DECIMAL)
+    return (fields[3].decode(), test_result.decode()) if test_result else None
+
+
 def parse_hl7_message(message):
     '''
     Parses an HL7 message into a dictionary based on message type.
 
+    The raw bytes are split into segments on \\r and only the MSH, PID, OBR and OBX segments
+    are split into fields on |; only the fields the detector uses are decoded to str.
+    Every OBX of an ORU is parsed: test_type and test_result come from the first one,
+    as before, and 'observations' lists (test_type, test_result) for all of them.
+
     Parameters:
-    - message: bytes, the HL7 message.
+    - message: bytes, bytearray or memoryview, the HL7 message.
 
     Returns:
     - Tuple (extracted_info, message_type_str): Where extracted_info is a dictionary containing parsed data, and message_type_str is a string indicating the message type ("ADT" or "ORU").
     '''
-
-    def parse_adt_a01(message):
-        pid_match = pid_pattern_long.search(message)
-        if pid_match:
-            return {
-                'pid': pid_match.group(2),
-                'name': pid_match.group(3),
-                'date_of_birth': pid_match.group(4),
-                'sex': pid_match.group(5)
-            }
-        else:
-            return None
-
-    def parse_adt_a03_or_oru(message, message_type):
-        pid_match = pid_pattern_short.search(message)
-        if not pid_match:
-            return None
-
-        extracted_info = {'pid': pid_match.group(2)}
-        if message_type == 'ORU^R01':
-            obr_match = obr_pattern.search(message)
-            obx_match = obx_pattern.search(message)
-            if obr_match and obx_match:
-                extracted_info.update({
-                    'test_time': obr_match.group(2),
-                    'test_type': obx_match.group(3),
-                    'test_result': obx_match.group(4)
-                })
-        return extracted_info
-
-    message = message.decode('utf-8')
-
-    # Define regular expressions for extracting information
-    msh_pattern = re.compile(r'MSH\|.*?\|.*?\|.*?\|.*?\|.*?\|(\d{14})\|.*?(\bADT\^A01\b|\bADT\^A03\b|\bORU\^R01\b).*?\|(\d+\.\d+)\r*')
-    pid_pattern_long = re.compile(r'PID\|(\d+)\|\|(\d+)\|\|([^|]+)\|\|(\d{8})\|([MF])')
-    pid_pattern_short = re.compile(r'PID\|(\d+)\|\|(\d+)')
-    obr_pattern = re.compile(r'OBR\|(\d+)\|\|\|\|\|\|(\d{14})')
-    obx_pattern = re.compile(r'OBX\|(\d+)\|([^|]+)\|([^|]+)\|\|([.\d]+)')
-
-    # Extract MSH information
-    msh_match = msh_pattern.search(message)
-    if not msh_match:
+    if isinstance(message, memoryview):
+        message = message.tobytes()
+
+    if b'\n' in message:
+        # \r\n or \n segment terminators, the empty segments this leaves are skipped
+        message = message.replace(b'\n', b'\r')
+
+    header = None
+    pids, obrs, obxs = [], [], []
+    for segment in message.split(b'\r'):
+        tag = segment[:4]
+        if tag == b'MSH|':
+            if header is None:
+                header = _parse_msh(segment)
+        elif tag == b'PID|':
+            pids.append(segment)
+        elif tag == b'OBR|':
+            obrs.append(segment)
+        elif tag == b'OBX|':
+            obxs.append(segment)
+
+    if header is None:
         metrics.MESSAGES_PARSED_FAILED.inc()
         return None, "Invalid Message Format"
 
-    message_type = msh_match.group(2)
-    extracted_info = {'date_and_time': msh_match.group(1), 'message_type': message_type}
-    message_type_str = 'ADT' if 'ADT' in message_type else 'ORU'
-
-    if message_type in ['ADT^A01', 'ADT^A03']:
-        extracted_info.update(
-            parse_adt_a01(message) if message_type == 'ADT^A01' else parse_adt_a03_or_oru(message, message_type))
-    elif message_type == 'ORU^R01':
-        extracted_info.update(parse_adt_a03_or_oru(message, message_type))
-
-    if not extracted_info:
+    date_and_time, message_type = header
+    extracted_info = {'date_and_time': date_and_time, 'message_type': message_type}
+    message_type_str = 'ORU' if message_type == 'ORU^R01' else 'ADT'
+
+    # like the regex search, the first PID, OBR and OBX segments that have the expected fields are used
+    for segment in pids:
+        patient = _parse_pid(segment, message_type == 'ADT^A01')
+        if patient is not None:
+            extracted_info.update(patient)
+            break
+    else:
         metrics.MESSAGES_PARSED_FAILED.inc()
         return None, message_type_str
 
+    if message_type_str == 'ORU':
+        test_time = None
+        for segment in obrs:
+            test_time = _parse_obr(segment)
+            if test_time is not None:
+                break
+        observations = []
+        for segment in obxs:
+            observation = _parse_obx(segment)
+            if observation is not None:
+                observations.append(observation)
+        if test_time is not None and observations:
+            extracted_info['test_time'] = test_time
+            extracted_info['test_type'], extracted_info['test_result'] = observations[0]
+            extracted_info['observations'] = observations
+
     metrics.MESSAGES_PARSED.inc()
     return extracted_info, message_type_str
 
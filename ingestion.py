@@ -0,0 +1,224 @@
+import asyncio
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from listener import MLLPFramer, build_ack, control_id
+
+# frames buffered between the reader and the detector before reading pauses
+INGESTION_QUEUE_SIZE = 1000
+# messages handed to the detector in one batch, and how long a batch waits to fill up.
+# With no wait only messages that are already queued are batched, which adds no latency.
+BATCH_SIZE = 64
+BATCH_WAIT = 0.0
+
+
+def connect(url):
+    '''
+    Description:
+        Open a non-blocking MLLP connection for the asyncio ingestion engine
+    input:
+        url: STRING host:port
+    output:
+        sock: socket
+    '''
+    host_name, port = url.split(':')
+    sock = socket.create_connection((host_name, int(port)))
+    sock.setblocking(False)
+    print(f'Connected to {host_name}:{port}')
+    return sock
+
+
+def listen(url):
+    '''
+    Description:
+        Listen for MLLP connections instead of connecting out, e.g. for a cluster replica fed by the router
+    input:
+        url: STRING host:port
+    output:
+        server: listening socket, accept() connections and make them non-blocking for run()
+    '''
+    host_name, port = url.split(':')
+    server = socket.create_server((host_name, int(port)))
+    print(f'Listening for MLLP connections on {host_name}:{port}')
+    return server
+
+
+async def read_frames(loop, sock, frames):
+    '''
+    Description:
+        Reader stage: frame MLLP messages from the socket into the bounded queue.
+        When the queue is full the reader stops reading, which pushes back on the sender.
+    '''
+    framer = MLLPFramer()
+    try:
+        while True:
+            received = await loop.sock_recv_into(sock, framer.receive_buffer())
+            if received == 0:
+                print("Connection closed by the server.")
+                break
+            with metrics.timed('frame'):
+                framer.commit(received)
+                messages = list(framer)
+            for message in messages:
+                metrics.MESSAGES_RECEIVED.inc()
+                await frames.put((message, time.time()))
+    except OSError as e:
+        print(f"An error occurred: {e}")
+    finally:
+        await frames.put(None)
+
+
+async def collect_batch(loop, frames, batch_size, batch_wait):
+    '''
+    Description:
+        Take up to batch_size frames from the queue: every frame already queued, then
+        whatever arrives within batch_wait seconds of the first one
+    output:
+        batch: list of (message, start_time)
+        closed: BOOL, the reader has finished
+    '''
+    item = await frames.get()
+    if item is None:
+        return [], True
+    batch = [item]
+    started = loop.time()
+    deadline = started + batch_wait
+    while len(batch) < batch_size:
+        if not frames.empty():
+            item = frames.get_nowait()
+        else:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(frames.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    metrics.BATCH_WAIT.set(loop.time() - started)
+    return batch, False
+
+
+def detect_and_page(handle_batch, send_page, messages):
+    # the batch's pages are recorded before any of its ACKs is queued, so the page of an
+    # acknowledged message survives a crash, as in the serial loop
+    results = handle_batch(messages)
+    for processed, page in results:
+        if processed and page is not None:
+            send_page(*page)
+    return results
+
+
+async def process_frames(loop, frames, acks, handle_batch, send_page, executor, durability, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT,
+                         reject_failed=False):
+    '''
+    Description:
+        Processing stage: run the detector on micro-batches of messages, in arrival order,
+        record their pages and hand each processed message to the ACK stage.
+        A single stage per connection keeps the ACKs in the same order as the messages.
+        Messages that fail to parse are not acknowledged, or rejected with an AR ACK with reject_failed.
+    '''
+    try:
+        closed = False
+        while not closed:
+            batch, closed = await collect_batch(loop, frames, batch_size, batch_wait)
+            if not batch:
+                break
+            results = await loop.run_in_executor(executor, detect_and_page, handle_batch, send_page, [message for message, _ in batch])
+            # everything journaled so far, including this batch's records, must be durable before its ACKs
+            sequence = durability.barrier() if durability is not None else None
+            for (processed, _), (message, start_time) in zip(results, batch):
+                if not processed:
+                    print("Parsing failed, skipping this message.")
+                    if reject_failed:
+                        await acks.put((None, control_id(message), None))
+                    continue
+                await acks.put((sequence, control_id(message), start_time))
+    finally:
+        await acks.put(None)
+
+
+async def send_acks(loop, sock, acks, durability, executor):
+    '''
+    Description:
+        ACK stage: acknowledge messages in order once their journal records are durable,
+        so the detector can carry on with the next messages while a group commit is in flight.
+        Each ACK echoes its message's control ID, so a sender may keep several messages in flight.
+    '''
+    while True:
+        item = await acks.get()
+        if item is None:
+            break
+        sequence, message_control_id, start_time = item
+        if start_time is None:
+            # a rejected message, nothing was journaled for it
+            await loop.sock_sendall(sock, build_ack(message_control_id, accepted=False))
+            continue
+        if durability is not None and not durability.is_durable(sequence):
+            waited = time.perf_counter()
+            await loop.run_in_executor(executor, durability.wait_durable, sequence)
+            metrics.observe('persist', time.perf_counter() - waited)
+        sent = time.perf_counter()
+        await loop.sock_sendall(sock, build_ack(message_control_id))
+        metrics.observe('ack', time.perf_counter() - sent)
+        metrics.MESSAGES_ACKNOWLEDGED.inc()
+        overall_latency = time.time() - start_time
+        metrics.OVERALL_LATENCY.set(overall_latency)
+        metrics.observe('overall', overall_latency)
+
+
+async def run_pipeline(sock, handle_batch, send_page, queue_size, durability, batch_size, batch_wait, reject_failed, ready):
+    loop = asyncio.get_running_loop()
+    frames = asyncio.Queue(maxsize=queue_size)
+    acks = asyncio.Queue(maxsize=queue_size)
+    reader = asyncio.ensure_future(read_frames(loop, sock, frames))
+    if ready is not None:
+        # the reader buffers frames while the detector loads
+        try:
+            durability = await loop.run_in_executor(None, ready)
+        except BaseException:
+            reader.cancel()
+            raise
+        metrics.STARTUP_BUFFERED_MESSAGES.set(frames.qsize())
+    # one thread each, so messages, pages and ACKs keep their order
+    with ThreadPoolExecutor(max_workers=1) as detector, ThreadPoolExecutor(max_workers=1) as acker:
+        await asyncio.gather(
+            reader,
+            process_frames(loop, frames, acks, handle_batch, send_page, detector, durability, batch_size, batch_wait, reject_failed),
+            send_acks(loop, sock, acks, durability, acker),
+        )
+
+
+def run(sock, handle_message, send_page, queue_size=INGESTION_QUEUE_SIZE, durability=None,
+        handle_batch=None, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT, reject_failed=False, ready=None):
+    '''
+    Description:
+        Run the pipelined ingestion engine until the MLLP connection closes
+    input:
+        sock: socket from connect()
+        handle_message: callable(message) -> (processed: BOOL, page: (mrn, prediction_date) or None)
+        send_page: callable(mrn, prediction_date), called on the detector thread before the message's
+            ACK is queued; it should only record the page, e.g. PagerDispatcher.submit(), and leave
+            the delivery to another thread
+        queue_size: INT, maximum number of framed messages waiting for the detector
+        durability: Journal or None, ACKs wait until the records written for a message are durable
+        handle_batch: callable(messages) -> list of handle_message results in message order,
+            e.g. to score the batch with one model call. Defaults to handle_message per message.
+        batch_size: INT, maximum number of messages per batch
+        batch_wait: FLOAT, seconds a batch waits for more messages after the first one
+        reject_failed: BOOL, answer messages that fail to parse with an AR ACK instead of no ACK,
+            for a sender that waits for an answer to every message, e.g. the cluster router
+        ready: callable() -> durability, blocking until the detector is loaded and returning the journal
+            it opened, instead of `durability`. Messages received while loading are buffered, up to
+            queue_size, then the sender is pushed back.
+    '''
+    if handle_batch is None:
+        handle_batch = lambda messages: [handle_message(message) for message in messages]
+    try:
+        asyncio.run(run_pipeline(sock, handle_batch, send_page, queue_size, durability, batch_size, batch_wait, reject_failed, ready))
+    finally:
+        sock.close()
@@ -0,0 +1,330 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from snapshot import fsync_path
+
+# record header: payload length and crc32 of the payload
+HEADER = struct.Struct('<II')
+# payload prefix: record type and MRN length, followed by the MRN bytes and the record body
+PREFIX = struct.Struct('<BH')
+ADMIT_BODY = struct.Struct('<8sc')   # date of birth YYYYmmdd, sex
+RESULT_BODY = struct.Struct('<qd')   # epoch seconds, creatinine result
+PATIENT_BODY = struct.Struct('<fbI')  # age, sex code, number of results, followed by the int64 timestamps and float32 results
+
+RECORD_ADMIT = 1
+RECORD_RESULT = 2
+# a patient's whole state, replacing what the store held, e.g. handed over from another shard
+RECORD_PATIENT = 3
+
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.log'
+
+# default upper bound on how long a record waits before the fsync of its group starts
+DEFAULT_COMMIT_INTERVAL = 0.001
+
+# marker queued between records by Journal.rotate()
+ROTATE = None
+
+
+class JournalCorruptError(Exception):
+    pass
+
+
+def segment_name(number):
+    return f'{SEGMENT_PREFIX}{number:08d}{SEGMENT_SUFFIX}'
+
+
+def list_segments(directory):
+    '''
+    Description:
+        Journal segments in the directory, oldest first
+    output:
+        segments: list of (number, path)
+    '''
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            number = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            segments.append((number, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def encode_admit(mrn, date_of_birth, sex):
+    mrn = mrn.encode()
+    return PREFIX.pack(RECORD_ADMIT, len(mrn)) + mrn + ADMIT_BODY.pack(date_of_birth.encode(), sex.encode())
+
+
+def encode_result(mrn, timestamp, result):
+    mrn = mrn.encode()
+    return PREFIX.pack(RECORD_RESULT, len(mrn)) + mrn + RESULT_BODY.pack(timestamp, result)
+
+
+def encode_patient(mrn, age, sex, timestamps, results):
+    mrn = mrn.encode()
+    return (PREFIX.pack(RECORD_PATIENT, len(mrn)) + mrn + PATIENT_BODY.pack(age, sex, len(results))
+            + np.asarray(timestamps, dtype='<i8').tobytes() + np.asarray(results, dtype='<f4').tobytes())
+
+
+def decode(payload):
+    '''
+    Description:
+        Decode one record payload
+    output:
+        (RECORD_ADMIT, mrn, date_of_birth, sex), (RECORD_RESULT, mrn, timestamp, result)
+        or (RECORD_PATIENT, mrn, (age, sex, timestamps, results))
+    '''
+    record_type, mrn_length = PREFIX.unpack_from(payload)
+    body = PREFIX.size + mrn_length
+    mrn = payload[PREFIX.size:body].decode()
+    if record_type == RECORD_ADMIT:
+        date_of_birth, sex = ADMIT_BODY.unpack_from(payload, body)
+        return RECORD_ADMIT, mrn, date_of_birth.decode(), sex.decode()
+    if record_type == RECORD_RESULT:
+        timestamp, result = RESULT_BODY.unpack_from(payload, body)
+        return RECORD_RESULT, mrn, timestamp, result
+    if record_type == RECORD_PATIENT:
+        age, sex, count = PATIENT_BODY.unpack_from(payload, body)
+        series = body + PATIENT_BODY.size
+        timestamps = np.frombuffer(payload, dtype='<i8', count=count, offset=series)
+        results = np.frombuffer(payload, dtype='<f4', count=count, offset=series + 8 * count)
+        return RECORD_PATIENT, mrn, (age, sex, timestamps, results)
+    raise JournalCorruptError(f'unknown record type {record_type}')
+
+
+def read_segment(path):
+    '''
+    Description:
+        Decode every complete record of a segment
+    output:
+        records: list of decoded records
+        valid_bytes: INT, length of the segment up to the last complete record
+    '''
+    with open(path, 'rb') as file:
+        data = file.read()
+    records = []
+    position = 0
+    while position + HEADER.size <= len(data):
+        length, checksum = HEADER.unpack_from(data, position)
+        end = position + HEADER.size + length
+        if end > len(data):
+            break
+        payload = data[position + HEADER.size:end]
+        if zlib.crc32(payload) != checksum:
+            break
+        records.append(decode(payload))
+        position = end
+    return records, position
+
+
+def replay(directory, store, first_segment=0):
+    '''
+    Description:
+        Apply every journaled event to the patient store, oldest segment first.
+        A torn record at the end of the newest segment (crash during a write) is truncated away.
+    input:
+        directory: STRING
+        store: PatientStore
+        first_segment: INT, segments older than this are already contained in a snapshot
+    output:
+        count: INT, number of records applied
+    '''
+    segments = [(number, path) for number, path in list_segments(directory) if number >= first_segment]
+    count = 0
+    for i, (_, path) in enumerate(segments):
+        records, valid_bytes = read_segment(path)
+        if valid_bytes != os.path.getsize(path):
+            if i != len(segments) - 1:
+                raise JournalCorruptError(f'{path}: corrupt record at byte {valid_bytes}')
+            print(f'journal: truncating torn record at byte {valid_bytes} of {path}')
+            with open(path, 'r+b') as file:
+                file.truncate(valid_bytes)
+        for record in records:
+            apply(store, record)
+        count += len(records)
+    return count
+
+
+def apply(store, record):
+    if record[0] == RECORD_ADMIT:
+        _, mrn, date_of_birth, sex = record
+        store.admit(mrn, date_of_birth, sex)
+    elif record[0] == RECORD_PATIENT:
+        _, mrn, state = record
+        store.replace_patient(mrn, *state)
+    else:
+        _, mrn, timestamp, result = record
+        store.append_result(mrn, timestamp, result)
+
+
+class Journal:
+    '''
+    Description:
+        Append-only binary journal of applied ADT/ORU events. Appends only copy the
+        encoded record into memory; a background thread writes and fsyncs everything
+        appended so far as one group, at most `commit_interval` seconds after the oldest
+        pending record arrived. Callers acknowledge a message only after
+        wait_durable() returns for the sequence number of its last record.
+    '''
+
+    def __init__(self, directory, commit_interval=DEFAULT_COMMIT_INTERVAL, fsync=True, first_segment=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.fsync = fsync
+        segments = list_segments(directory)
+        # never write below the segment a snapshot starts replaying from
+        self.segment = max(segments[-1][0] if segments else 1, first_segment)
+        self._fd = self._open_segment(self.segment)
+        # segment the flusher is writing to, can lag behind self.segment until queued rotations are written
+        self._fd_segment = self.segment
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._pending = []
+        self._pending_since = None
+        self._appended = 0
+        self._durable = 0
+        self._error = None
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name='journal-flusher', daemon=True)
+        self._flusher.start()
+
+    def _open_segment(self, number):
+        path = os.path.join(self.directory, segment_name(number))
+        created = not os.path.exists(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if created and self.fsync:
+            # the directory entry of a new segment must be on disk before any record in it is durable
+            fsync_path(self.directory)
+        return fd
+
+    def _append(self, payload):
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._closed:
+                raise ValueError('journal is closed')
+            if not self._pending:
+                self._pending_since = time.monotonic()
+                self._condition.notify_all()
+            self._pending.append(record)
+            self._appended += 1
+            return self._appended
+
+    def append_admit(self, mrn, date_of_birth, sex):
+        '''journal an ADT^A01 admission, returns its sequence number'''
+        return self._append(encode_admit(mrn, date_of_birth, sex))
+
+    def append_result(self, mrn, timestamp, result):
+        '''journal an ORU creatinine result, returns its sequence number'''
+        return self._append(encode_result(mrn, timestamp, result))
+
+    def append_patient(self, mrn, age, sex, timestamps, results):
+        '''journal a patient's whole state handed over from another shard, returns its sequence number'''
+        return self._append(encode_patient(mrn, age, sex, timestamps, results))
+
+    def rotate(self):
+        '''
+        Description:
+            Start a new segment: records appended after this call go to the new segment
+        output:
+            segment: INT, number of the new segment
+            sequence: INT, sequence number of the last record of the previous segments
+        '''
+        with self._lock:
+            self.segment += 1
+            if not self._pending:
+                self._pending_since = time.monotonic()
+                self._condition.notify_all()
+            self._pending.append(ROTATE)
+            return self.segment, self._appended
+
+    def remove_segments(self, before):
+        '''delete segments older than `before`, once a snapshot contains their records'''
+        for number, path in list_segments(self.directory):
+            if number < before:
+                os.remove(path)
+
+    def barrier(self):
+        '''sequence number of the last appended record'''
+        with self._lock:
+            return self._appended
+
+    def is_durable(self, sequence):
+        return self._durable >= sequence
+
+    def wait_durable(self, sequence=None, timeout=None):
+        '''
+        Description:
+            Block until every record up to `sequence` (default: all appended so far) is fsynced
+        '''
+        with self._lock:
+            if sequence is None:
+                sequence = self._appended
+            if not self._condition.wait_for(lambda: self._durable >= sequence or self._error is not None, timeout):
+                raise TimeoutError(f'journal record {sequence} not durable after {timeout}s')
+            if self._error is not None:
+                raise self._error
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending and self._closed:
+                    return
+                # group commit: let more records join until the oldest one reaches the latency bound
+                deadline = self._pending_since + self.commit_interval
+                while not self._closed and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch, self._pending = self._pending, []
+                sequence = self._appended
+            try:
+                self._write(batch)
+            except OSError as e:
+                with self._lock:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._lock:
+                self._durable = sequence
+                self._condition.notify_all()
+
+    def _write(self, batch):
+        # write and sync the batch, switching segments at every rotation marker
+        records = []
+        segment = self._fd_segment
+        for record in batch:
+            if record is not ROTATE:
+                records.append(record)
+                continue
+            self._sync(records)
+            records = []
+            os.close(self._fd)
+            segment += 1
+            self._fd = self._open_segment(segment)
+        self._sync(records)
+        self._fd_segment = segment
+
+    def _sync(self, records):
+        if records:
+            data = memoryview(b''.join(records))
+            # os.write may write less than asked for, e.g. a large group commit or a signal
+            while data:
+                data = data[os.write(self._fd, data):]
+            if self.fsync:
+                os.fdatasync(self._fd)
+
+    def close(self):
+        '''flush and fsync everything appended so far, then stop the flusher'''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        os.close(self._fd)
@@ -1,48 +1,206 @@
 import socket
+import time
 from datetime import datetime
 
+import metrics
+
 MLLP_START_BLOCK = b'\x0b'  # Start of block
 MLLP_END_BLOCK = b'\x1c'    # End of block
 MLLP_CARRIAGE_RETURN = b'\x0d'  # Carriage return
+MLLP_FRAME_END = MLLP_END_BLOCK + MLLP_CARRIAGE_RETURN
+
+# initial size of the reusable receive buffer, grows for oversized frames
+MLLP_BUFFER_SIZE = 64 * 1024
+# minimum free space before reading, smaller gaps are compacted first
+MLLP_MIN_READ_SIZE = 4096
+
+s = None
+framer = None
+
+
+class MLLPFramer:
+    '''
+    Description:
+        Streaming MLLP frame decoder. Reads from a socket with recv_into into a
+        reusable bytearray and yields complete <0x0b> payload <0x1c><0x0d> frames.
+        Data is only moved when a partial frame has to be compacted to the front
+        of the buffer, or when a frame is larger than the buffer.
+    '''
+
+    def __init__(self, buffer_size=MLLP_BUFFER_SIZE):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # unconsumed data lives in [_start, _end), end markers are searched from _scan
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+        self.discarded_bytes = 0
+
+    def pending(self):
+        '''number of buffered bytes that do not form a complete frame yet'''
+        return self._end - self._start
+
+    def _reserve(self, size):
+        # make room for at least `size` bytes after _end without touching consumed data
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # oversized frame: grow the buffer, copying only the pending bytes
+            new_size = len(self._buffer)
+            while pending + size > new_size:
+                new_size *= 2
+            buffer = bytearray(new_size)
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        else:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+
+    def receive_buffer(self):
+        '''writable view of the free tail of the buffer, pass the byte count read into it to commit()'''
+        self._reserve(MLLP_MIN_READ_SIZE)
+        return self._view[self._end:]
+
+    def commit(self, received):
+        self._end += received
+
+    def read_from(self, sock):
+        '''
+        Description:
+            Receive directly into the free tail of the buffer
+        input:
+            sock: socket
+        output:
+            received: INT, number of bytes read, 0 if the peer closed the connection
+        '''
+        received = sock.recv_into(self.receive_buffer())
+        self.commit(received)
+        return received
+
+    def feed(self, data):
+        '''
+        Description:
+            Append bytes that were received elsewhere (used by tests and benchmarks)
+        input:
+            data: bytes-like
+        '''
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self):
+        '''
+        Description:
+            Return the next complete frame, bytes that are not inside a frame are skipped
+        output:
+            payload: bytes without MLLP framing, or None if no complete frame is buffered
+        '''
+        if self._start == self._end:
+            return None
+        if self._buffer[self._start] != MLLP_START_BLOCK[0]:
+            # resynchronise on the next start block
+            start = self._buffer.find(MLLP_START_BLOCK, self._start, self._end)
+            if start < 0:
+                start = self._end
+            self.discarded_bytes += start - self._start
+            self._start = start
+            if start == self._end:
+                self._start = self._end = self._scan = 0
+                return None
+        end = self._buffer.find(MLLP_FRAME_END, max(self._scan, self._start + 1), self._end)
+        if end < 0:
+            # keep the last byte in the search window in case 0x1c arrived without 0x0d
+            self._scan = max(self._end - 1, self._start + 1)
+            return None
+        payload = bytes(self._view[self._start + 1:end])
+        self._start = end + len(MLLP_FRAME_END)
+        self._scan = self._start
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        return payload
+
+    def __iter__(self):
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
+
 
 def start_listener(url):
     host_name, port = url.split(':')
     # Set up socket connection to listen for HL7 messages
-    global s
+    global s, framer
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = (host_name, int(port))
     s.connect(server_address)
+    framer = MLLPFramer()
     print(f'Connected to {host_name}:{port}')
 
 def receive_message():
-    global s
+    '''
+    Description:
+        Receive the next complete HL7 message, reading from the socket until a full MLLP frame is buffered
+    output:
+        message: bytes without MLLP framing, None if the connection was closed or failed
+    '''
+    global s, framer
     try:
-        data = s.recv(1024)  # Attempt to receive data from the socket
-        if data == b'':  # Check if the connection was closed
-            print("Connection closed by the server.")
-            s.close()  # Close the socket
-            return None
-        return data
+        # time spent framing, not waiting for the socket, as the async reader records it
+        framing = 0.0
+        while True:
+            started = time.perf_counter()
+            message = framer.next_frame()
+            framing += time.perf_counter() - started
+            if message is not None:
+                metrics.observe('frame', framing)
+                return message
+            if framer.read_from(s) == 0:  # Check if the connection was closed
+                print("Connection closed by the server.")
+                s.close()  # Close the socket
+                return None
     except Exception as e:
         print(f"An error occurred: {e}")
-        s.close()  # Ensure the socket is closed to avoid resource leakage
+        if s is not None:
+            s.close()  # Ensure the socket is closed to avoid resource leakage
         return None
 
-def ack_message():
-    global s
+def control_id(message):
+    '''
+    Description:
+        MSH-10 message control ID of an HL7 message, echoed in the ACK so a sender with several
+        messages in flight can match each ACK to its message
+    output:
+        control_id: bytes, empty if the message has none
+    '''
+    end = message.find(b'\r')
+    fields = message[:end if end >= 0 else len(message)].split(b'|', 10)
+    if fields[0] != b'MSH' or len(fields) < 10:
+        return b''
+    return fields[9]
+
+def build_ack(control_id=b'', accepted=True):
     current_timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
 
     ack_message = (
             b'\x0b'  # MLLP start block
             + f"MSH|^~\\&|||||{current_timestamp}||ACK|||2.5\r".encode()  # MSH segment with current timestamp and version 2.5
-            + "MSA|AA\r".encode()  # MSA segment with acknowledgment type AA
+            + (b"MSA|AA" if accepted else b"MSA|AR") + (b"|" + control_id if control_id else b"") + b"\r"  # MSA segment with acknowledgment type AA (AR: rejected) and the acknowledged message's control ID
             + b'\x1c'  # MLLP end block
             + b'\x0d'  # MLLP carriage return
     )
+    return ack_message
 
-    s.send(ack_message)
+def ack_message(control_id=b''):
+    global s
+    s.send(build_ack(control_id))
 
 def close_connection():
     # to properly close the connection
     global s
-    s.close()
\ No newline at end of file
+    if s is not None:
+        s.close()
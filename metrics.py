@@ -1,4 +1,11 @@
-from prometheus_client import Counter, Gauge
+import time
+from collections import defaultdict
+from functools import wraps
+
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+from prometheus_client import Counter, Gauge, Histogram, MetricsHandler
 
 # metrics for prometheus
 MESSAGES_RECEIVED = Counter('messages_received_total', 'Total HTTP Requests (count)')
@@ -7,6 +14,8 @@ PREDICTION_LATENCY = Gauge('prediction_latency', 'Prediction latency')
 OVERALL_LATENCY = Gauge('overall_latency', 'Overall latency')
 PREDICTION_RATE = Gauge('prediction_rate', 'Prediction rate')
 MEDIAN_INPUT = Gauge('median_input', 'Median input')
+INPUT_P5 = Gauge('input_p5', '5th percentile of the test results in the input window')
+INPUT_P95 = Gauge('input_p95', '95th percentile of the test results in the input window')
 MESSAGES_PARSED = Counter('messages_parsed_total', 'Total Parsed hl7 messages (count)')
 MESSAGES_PARSED_FAILED = Counter('messages_parsed_failed_total', 'Total Parsed failed hl7 messages (count)')
 PAGES_FAILED = Counter('pages_sent_failed_total', 'Total failed pages (count)')
@@ -14,3 +23,163 @@ BLOOD_TEST_RECEIVED = Counter('blood_test_messages_received_total', 'Total recei
 MESSAGES_ACKNOWLEDGED = Counter('messages_acknowledged_total', 'Total Messages acknowledged upon resolution (count)')
 CONNECTION_CLOSURE = Counter('connection_closure', 'Smooth Connection Closure (count)')
 START_MLLP_LISTENER_FAILURE = Counter('start_mllp_listener_failure', 'Start MLLP Listener Failures (count)')
+STATE_RESTORE_DURATION = Gauge('state_restore_seconds', 'Time to restore patient state on startup: snapshot or history load plus journal replay (seconds)')
+JOURNAL_RECORDS_REPLAYED = Gauge('journal_records_replayed', 'Journal records replayed on startup (count)')
+SNAPSHOT_DURATION = Gauge('snapshot_duration_seconds', 'Time to pack and write the last snapshot in the background (seconds)')
+SNAPSHOT_CAPTURE_PAUSE = Gauge('snapshot_capture_pause_seconds', 'Time message processing paused to capture the last snapshot (seconds)')
+SNAPSHOT_FAILED = Counter('snapshot_failed_total', 'Total failed snapshots (count)')
+PREDICTION_BATCH_SIZE = Gauge('prediction_batch_size', 'Feature rows scored by the last batched model call (count)')
+PREDICTION_BATCHES = Counter('prediction_batches_total', 'Total batched model calls (count)')
+BATCH_WAIT = Gauge('batch_wait_seconds', 'Time the last micro-batch waited for more messages after its first one (seconds)')
+PAGER_QUEUE_DEPTH = Gauge('pager_queue_depth', 'Pages submitted and not yet delivered or given up (count)')
+PAGE_DELIVERY_LATENCY = Gauge('page_delivery_latency_seconds', 'Time from submitting the last delivered page to the pager accepting it, including retries (seconds)')
+PAGE_RETRIES = Counter('page_retries_total', 'Total page requests retried after a connection error, timeout, 429 or 5xx response (count)')
+HANDOFF_PATIENTS = Counter('handoff_patients_total', 'Total patients streamed to a new owner when the replica ring changed (count)')
+HANDOFF_DURATION = Gauge('handoff_duration_seconds', 'Time routing paused for the last replica ring change, including the state handoff (seconds)')
+MESSAGES_REJECTED = Counter('messages_rejected_total', 'Total messages a replica rejected because they could not be parsed (count)')
+STARTUP_PHASE_DURATION = Gauge('startup_phase_seconds', 'Time spent in each startup phase: connect, history, journal_replay, model, and ready from the start of main() (seconds)', ['phase'])
+READY = Gauge('ready', '1 once the patient state and the model are loaded and messages are processed, 0 while loading (bool)')
+STARTUP_BUFFERED_MESSAGES = Gauge('startup_buffered_messages', 'Messages received while loading and processed once ready (count)')
+HISTORY_CACHE_HITS = Counter('history_cache_hits_total', 'Total lookups of a history patient already in the working set (count)')
+HISTORY_CACHE_MISSES = Counter('history_cache_misses_total', 'Total history patients read from the csv on their first lookup or after eviction (count)')
+HISTORY_CACHE_EVICTIONS = Counter('history_cache_evictions_total', 'Total clean history patients evicted from the working set (count)')
+HISTORY_CACHE_PATIENTS = Gauge('history_cache_patients', 'History patients in the working set (count)')
+HISTORY_CACHE_BYTES = Gauge('history_cache_bytes', 'Memory used by the series of the history patients in the working set (bytes)')
+MEMORY_BUDGET = Gauge('memory_budget_bytes', 'Resident set size above which the history working set is evicted, 0 without a budget; compare with process_resident_memory_bytes (bytes)')
+
+# latency buckets (seconds) of the per-stage histograms: in-process stages take microseconds,
+# stages that wait for the disk, the network or the pager take milliseconds to seconds
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+SLOW_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+# bucket set of each pipeline stage: 'lookup' finds the patient's row, reading it from the history
+# on its first message, 'update' applies the admission or result to it (aggregate_data() on the
+# DataFrame path), 'overall' is a message from being received to its ACK and 'delivery' a page
+# from being submitted to the pager accepting it, including retries
+STAGE_BUCKETS = {
+    'frame': FAST_BUCKETS,
+    'parse': FAST_BUCKETS,
+    'lookup': FAST_BUCKETS,
+    'update': FAST_BUCKETS,
+    'features': FAST_BUCKETS,
+    'predict': FAST_BUCKETS,
+    'page': SLOW_BUCKETS,
+    'ack': SLOW_BUCKETS,
+    'persist': SLOW_BUCKETS,
+    'overall': SLOW_BUCKETS,
+    'delivery': SLOW_BUCKETS + (30.0, 60.0, 300.0),
+}
+# histograms are registered on their first observation, with the bucket set configured at that point
+_stage_histograms = {}
+# stage -> list of durations while a benchmark collects them, see collect_stage_samples()
+_stage_samples = None
+
+
+def configure_stage_buckets(buckets):
+    '''
+    Description:
+        Change the bucket sets of stage histograms, before the stages are first observed
+    input:
+        buckets: DIC stage -> sequence of upper bounds in seconds
+    '''
+    for stage, bounds in buckets.items():
+        if stage in _stage_histograms:
+            raise ValueError(f'stage {stage} was already observed with buckets {STAGE_BUCKETS[stage]}')
+        STAGE_BUCKETS[stage] = tuple(sorted(bounds))
+
+
+def stage_histogram(stage):
+    histogram = _stage_histograms.get(stage)
+    if histogram is None:
+        histogram = _stage_histograms[stage] = Histogram(f'stage_{stage}_latency_seconds', f'Time spent in the {stage} stage (seconds)',
+                                                         buckets=STAGE_BUCKETS[stage])
+    return histogram
+
+
+def observe(stage, seconds):
+    '''record a duration measured by the caller, e.g. across awaits'''
+    stage_histogram(stage).observe(seconds)
+    if _stage_samples is not None:
+        _stage_samples[stage].append(seconds)
+
+
+def collect_stage_samples(enabled=True):
+    '''
+    Description:
+        Also keep every stage duration in memory from now on, for exact percentiles in benchmarks
+    input:
+        enabled: BOOL, False stops collecting
+    output:
+        samples: DIC stage -> list of seconds, filled as stages are observed
+    '''
+    global _stage_samples
+    _stage_samples = defaultdict(list) if enabled else None
+    return _stage_samples
+
+
+class StageTimer:
+    '''
+    Description:
+        Records the time spent in a block or a function in the histogram of a stage. Only
+        reads the clock twice and observes once, so it can wrap per-message calls.
+    '''
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start)
+
+    def __call__(self, function):
+        stage = self.stage
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - start)
+        return timed_function
+
+
+def timed(stage):
+    '''
+    Description:
+        Time a pipeline stage, as a context manager
+            with metrics.timed('parse'):
+        or as a decorator
+            @metrics.timed('lookup')
+    '''
+    return StageTimer(stage)
+
+
+def start_metrics_server(port, ready):
+    '''
+    Description:
+        Serve the metrics like prometheus_client.start_http_server, and readiness on /ready:
+        200 once ready() is true, 503 while the service is still loading
+    input:
+        port: INT
+        ready: callable() -> BOOL
+    output:
+        server: ThreadingHTTPServer, serving on a daemon thread
+    '''
+    class Handler(MetricsHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/ready':
+                return super().do_GET()
+            is_ready = ready()
+            self.send_response(200 if is_ready else 503)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(b'ready\n' if is_ready else b'loading\n')
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
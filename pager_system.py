@@ -1,6 +1,41 @@
+import os
+import queue
+import random
+import threading
+import time
 import requests
 import datetime
 import metrics
+from snapshot import fsync_path
+
+PAGES_FILE = 'pages.log'
+# pages waiting for the pager before submit() blocks
+PAGER_QUEUE_SIZE = 1024
+# seconds to open the connection and to wait for the response
+PAGER_TIMEOUT = (1.0, 2.0)
+# first retry delay and upper bound of the backoff, in seconds
+PAGER_BACKOFF = 0.1
+PAGER_MAX_BACKOFF = 30.0
+# seconds close() waits for queued pages to be delivered
+PAGER_DRAIN_TIMEOUT = 5.0
+# size of the pages file above which it is rewritten with only the pending pages
+PAGES_COMPACT_BYTES = 1 << 20
+
+# queued after the last page by close()
+STOP = None
+
+
+def page_body(mrn, prediction_date):
+    '''
+    Description:
+        Body of a page request: the MRN and the prediction time as YYYYmmddHHMMSS
+    input:
+        mrn: String
+        prediction_date: String : 2024-04-29 05:41:00
+    '''
+    datetime_obj = datetime.datetime.strptime(str(prediction_date), "%Y-%m-%d %H:%M:%S")
+    return str(mrn) + ',' + datetime_obj.strftime("%Y%m%d%H%M%S")
+
 
 def send_pager_message(mrn, prediction_date, url):
     '''
@@ -14,11 +49,8 @@ def send_pager_message(mrn, prediction_date, url):
 
         url = 'http://' + url + '/page'
         headers = {'Content-type': 'text/plain'}
-       
-        datetime_obj = datetime.datetime.strptime(str(prediction_date), "%Y-%m-%d %H:%M:%S")
-        date = datetime_obj.strftime("%Y%m%d%H%M%S")
 
-        data = str(mrn) + ',' + date
+        data = page_body(mrn, prediction_date)
 
         response = requests.post(url, headers=headers, data=data)
         response.raise_for_status()
@@ -26,3 +58,213 @@ def send_pager_message(mrn, prediction_date, url):
     except requests.exceptions.RequestException as e:
         print(f"Error sending page: {e}")
         metrics.PAGES_FAILED.inc()
+
+
+def read_pending_pages(path):
+    '''
+    Description:
+        Pages recorded in the pages file that were not delivered or given up, oldest first.
+        Records are "+<id> <body>" when a page is submitted and "-<id>" when it is done;
+        a torn last line (crash during a write) is ignored.
+    output:
+        pages: list of (id, body)
+    '''
+    if not os.path.exists(path):
+        return []
+    pending = {}
+    with open(path, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            record = line[:-1].decode()
+            if record.startswith('+'):
+                page_id, body = record[1:].split(' ', 1)
+                pending[int(page_id)] = body
+            elif record.startswith('-'):
+                pending.pop(int(record[1:]), None)
+    return list(pending.items())
+
+
+class PagerDispatcher:
+    '''
+    Description:
+        Delivers pages on a worker thread so a slow or unreachable pager never holds up
+        the MLLP loop. Pages are recorded in `directory` before submit() returns and
+        removed once the pager accepted them, so pages still pending at a crash or
+        shutdown are sent again on the next start (at least once, in submission order).
+        Requests reuse one keep-alive connection with strict timeouts; connection errors,
+        timeouts, 429 and 5xx responses are retried with exponential backoff and full
+        jitter, other 4xx responses are given up.
+    '''
+
+    def __init__(self, url, directory, queue_size=PAGER_QUEUE_SIZE, timeout=PAGER_TIMEOUT,
+                 backoff=PAGER_BACKOFF, max_backoff=PAGER_MAX_BACKOFF, fsync=True, compact_bytes=PAGES_COMPACT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.url = 'http://' + url + '/page'
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self.path = os.path.join(directory, PAGES_FILE)
+        self._session = requests.Session()
+        self._session.headers.update({'Content-type': 'text/plain'})
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._closed = False
+        # pages submitted and not done yet, by id, with their submission time and body
+        self._pending = {}
+        recovered = read_pending_pages(self.path)
+        self._next_id = recovered[-1][0] + 1 if recovered else 1
+        self._fd = None
+        self._compact(recovered)
+        self._worker = threading.Thread(target=self._deliver_loop, name='pager-dispatcher', daemon=True)
+        self._worker.start()
+        if recovered:
+            print(f"pager: resending {len(recovered)} pages pending from the last run")
+        with self._lock:
+            for page_id, body in recovered:
+                self._track(page_id, body)
+        for page_id, body in recovered:
+            self._queue.put((page_id, body))
+
+    def _compact(self, pages):
+        # rewrite the pages file with only the pending pages, then keep appending to it. The
+        # directory is synced so records appended to the new file are not lost with the rename.
+        temporary = self.path + '.tmp'
+        data = b''.join(f'+{page_id} {body}\n'.encode() for page_id, body in pages)
+        with open(temporary, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(temporary, self.path)
+        if self.fsync:
+            fsync_path(os.path.dirname(os.path.abspath(self.path)))
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._size = len(data)
+        # a long pager outage can leave many pages pending, compact again once the file has doubled
+        self._compact_at = max(self.compact_bytes, 2 * self._size)
+
+    def _record(self, line, sync):
+        data = line.encode()
+        os.write(self._fd, data)
+        self._size += len(data)
+        if sync and self.fsync:
+            os.fdatasync(self._fd)
+
+    def _maybe_compact(self):
+        # called with the lock held, once the page just recorded or done is in self._pending or out of it
+        if self._size >= self._compact_at:
+            self._compact([(page_id, body) for page_id, (_, body) in self._pending.items()])
+
+    def _track(self, page_id, body):
+        # called with the lock held, in the critical section that recorded the page, so _done()
+        # never sees the pages file without pending pages while this page's record is in it
+        self._pending[page_id] = (time.time(), body)
+        metrics.PAGER_QUEUE_DEPTH.set(len(self._pending))
+
+    def submit(self, mrn, prediction_date):
+        '''
+        Description:
+            Record a page on disk and queue it for delivery
+        input:
+            mrn: String
+            prediction_date: String : 2024-04-29 05:41:00
+        '''
+        body = page_body(mrn, prediction_date)
+        with self._lock:
+            if self._closed:
+                raise ValueError('pager dispatcher is closed')
+            page_id = self._next_id
+            self._next_id += 1
+            self._record(f'+{page_id} {body}\n', sync=True)
+            self._track(page_id, body)
+            self._maybe_compact()
+        # blocks while queue_size pages are waiting, the page is already on disk
+        self._queue.put((page_id, body))
+
+    def _done(self, page_id):
+        with self._lock:
+            submitted, _ = self._pending.pop(page_id)
+            # a lost done record only means the page is sent once more after a restart
+            self._record(f'-{page_id}\n', sync=False)
+            if not self._pending:
+                os.ftruncate(self._fd, 0)
+                self._size = 0
+            else:
+                self._maybe_compact()
+            metrics.PAGER_QUEUE_DEPTH.set(len(self._pending))
+            self._condition.notify_all()
+        return submitted
+
+    def _deliver_loop(self):
+        while not self._stopping.is_set():
+            item = self._queue.get()
+            if item is STOP:
+                break
+            self._deliver(*item)
+
+    def _deliver(self, page_id, body):
+        attempt = 0
+        while True:
+            try:
+                with metrics.timed('page'):
+                    response = self._session.post(self.url, data=body, timeout=self.timeout)
+                if response.status_code < 400:
+                    metrics.PAGES_SENT.inc()
+                    delivery_latency = time.time() - self._done(page_id)
+                    metrics.PAGE_DELIVERY_LATENCY.set(delivery_latency)
+                    metrics.observe('delivery', delivery_latency)
+                    return
+                error = f'{response.status_code} response'
+                retry = response.status_code == 429 or response.status_code >= 500
+            except requests.exceptions.RequestException as e:
+                error = e
+                retry = True
+            if not retry:
+                print(f"Error sending page {body}, giving up: {error}")
+                metrics.PAGES_FAILED.inc()
+                self._done(page_id)
+                return
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            attempt += 1
+            print(f"Error sending page {body}, retry {attempt} in {delay:.2f}s: {error}")
+            metrics.PAGE_RETRIES.inc()
+            if self._stopping.wait(delay):
+                # shutting down, the page stays in the pages file for the next start
+                return
+
+    def wait_delivered(self, timeout=None):
+        '''
+        Description:
+            Block until every submitted page was delivered or given up
+        output:
+            delivered: BOOL, False if pages were still pending after `timeout` seconds
+        '''
+        with self._lock:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=PAGER_DRAIN_TIMEOUT):
+        '''
+        Description:
+            Give queued pages up to `timeout` seconds to be delivered, then stop the worker.
+            Pages still pending are sent on the next start.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if not self.wait_delivered(timeout):
+            print(f"pager: {len(self._pending)} pages left for the next start")
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(STOP)
+        except queue.Full:
+            pass
+        self._worker.join()
+        self._session.close()
+        os.close(self._fd)
@@ -0,0 +1,741 @@
+import calendar
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# sex is stored as the flag the model expects, -1 when unknown
+SEX_CODES = {'M': 0, 'F': 1}
+SEX_LABELS = {0: 'M', 1: 'F'}
+SEX_UNKNOWN = -1
+
+# creatinine date/result pairs of the wide DataFrame layout produced by
+# data_processor.load_and_process_history, also the default retention limit
+HISTORY_COLUMN_PAIRS = 50
+
+INITIAL_PATIENT_CAPACITY = 1024
+INITIAL_ARENA_CAPACITY = 16 * 1024
+# result slots given to a patient the first time its series has to grow
+INITIAL_SERIES_CAPACITY = 8
+# results kept per patient unless configured otherwise, the width of the wide history layout
+DEFAULT_MAX_RESULTS = HISTORY_COLUMN_PAIRS
+# the arenas are compacted once more than this share of their slots is no longer owned by a patient
+COMPACT_FREE_FRACTION = 0.5
+
+# model input, in the column order of the model: age, sex, then the result and the gap in
+# seconds to the next more recent result for the 5 most recent results (gap 0 for the newest)
+FEATURE_RESULTS = 5
+FEATURE_COLUMNS = 2 + 2 * FEATURE_RESULTS
+
+
+def hl7_to_epoch(value):
+    '''
+    Description:
+        Convert an HL7 YYYYmmddHHMMSS timestamp to epoch seconds
+    input:
+        value: STRING
+    output:
+        seconds: INT
+    '''
+    return calendar.timegm((int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                            int(value[8:10]), int(value[10:12]), int(value[12:14]), 0, 0, 0))
+
+
+def calculate_age(date_of_birth, today=None):
+    '''
+    Description:
+        Age in whole years from an HL7 YYYYmmdd date of birth, as update_patient_data computes it
+    '''
+    today = today or datetime.now()
+    dob = datetime.strptime(date_of_birth, '%Y%m%d')
+    age = today.year - dob.year
+    if (today.month, today.day) < (dob.month, dob.day):
+        age -= 1
+    return age
+
+
+class PatientStore:
+    '''
+    Description:
+        Patient state keyed by MRN through a hash index. Demographics are kept in
+        columnar arrays (one row per patient) and every patient's creatinine series
+        is a slice of two shared arenas: int64 epoch-second timestamps and float32
+        results. Appending to a full slice moves it to the end of the arena with
+        double the capacity, so appends are amortised O(1) and lookups are O(1).
+        Written slots are never modified in place, the arenas only grow or are
+        replaced by compact().
+
+        With set_retention() every series is bounded: the oldest results beyond the
+        limits are dropped from the front of the slice as new ones arrive, and the
+        arenas are compacted once most of their slots are free, so one patient with
+        a long history costs no more per result than any other.
+
+        With a read-only `base` (the memory-mapped compiled history) the arrays only
+        hold an overlay: patients admitted or given results since the base was compiled.
+        A base patient is copied into the overlay the first time it is written to.
+
+        Every overlay patient also keeps its model feature vector as a float32 row of
+        `features`, updated in O(1) by admit() and append_result().
+    '''
+
+    def __init__(self, patient_capacity=INITIAL_PATIENT_CAPACITY, arena_capacity=INITIAL_ARENA_CAPACITY, base=None):
+        self.base = base
+        # overlay patients that shadow a base patient
+        self._shadowed = 0
+        self._index = {}
+        self._mrns = []
+        self.age = np.full(patient_capacity, np.nan, dtype=np.float32)
+        self.sex = np.full(patient_capacity, SEX_UNKNOWN, dtype=np.int8)
+        self.offset = np.zeros(patient_capacity, dtype=np.int64)
+        self.length = np.zeros(patient_capacity, dtype=np.int32)
+        self.capacity = np.zeros(patient_capacity, dtype=np.int32)
+        self.features = empty_features(patient_capacity)
+        self.timestamps = np.zeros(arena_capacity, dtype=np.int64)
+        self.results = np.zeros(arena_capacity, dtype=np.float32)
+        self.arena_end = 0
+        # arena slots no longer owned by any patient, reclaimed by compact()
+        self.free_slots = 0
+        # retention limits of every series, see set_retention()
+        self.max_results = None
+        self.max_age = None
+
+    def __len__(self):
+        if self.base is None:
+            return len(self._mrns)
+        return len(self._mrns) + len(self.base) - self._shadowed
+
+    def __contains__(self, mrn):
+        return mrn in self._index or (self.base is not None and self.base.find(mrn) is not None)
+
+    def mrns(self):
+        if self.base is None:
+            return list(self._mrns)
+        return [mrn for mrn in self.base.mrns() if mrn not in self._index] + self._mrns
+
+    def row(self, mrn):
+        '''row of the patient in the overlay columns, None if unknown or only in the base'''
+        return self._index.get(mrn)
+
+    def _grow_rows(self, needed):
+        size = len(self.age)
+        if needed <= size:
+            return
+        while size < needed:
+            size *= 2
+        for name, fill in (('age', np.nan), ('sex', SEX_UNKNOWN), ('offset', 0), ('length', 0), ('capacity', 0)):
+            column = getattr(self, name)
+            grown = np.full(size, fill, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+        features = empty_features(size)
+        features[:len(self.features)] = self.features
+        self.features = features
+
+    def _reserve_arena(self, slots):
+        # returns the offset of `slots` free arena slots at the end of the arena
+        needed = self.arena_end + slots
+        if needed > len(self.timestamps):
+            size = max(len(self.timestamps), 1)
+            while size < needed:
+                size *= 2
+            timestamps = np.zeros(size, dtype=np.int64)
+            results = np.zeros(size, dtype=np.float32)
+            timestamps[:self.arena_end] = self.timestamps[:self.arena_end]
+            results[:self.arena_end] = self.results[:self.arena_end]
+            self.timestamps, self.results = timestamps, results
+        offset = self.arena_end
+        self.arena_end = needed
+        return offset
+
+    def add_patient(self, mrn):
+        '''
+        Description:
+            Return the row of the patient, adding an empty patient if the MRN is new
+        '''
+        row = self._index.get(mrn)
+        if row is None:
+            row = len(self._mrns)
+            self._grow_rows(row + 1)
+            self._index[mrn] = row
+            self._mrns.append(mrn)
+            if self.base is not None:
+                self._copy_from_base(row, mrn)
+        return row
+
+    def _copy_from_base(self, row, mrn):
+        # copy-on-write: the first write to a base patient copies it into the overlay
+        position = self.base.find(mrn)
+        if position is None:
+            return
+        self._shadowed += 1
+        self.age[row], self.sex[row] = self.base.age[position], self.base.sex[position]
+        timestamps, results = self.base.series(position)
+        # only the results the retention limits keep are copied
+        start = self._excess(timestamps)
+        length = len(results) - start
+        if length:
+            offset = self._reserve_arena(length)
+            self.timestamps[offset:offset + length] = timestamps[start:]
+            self.results[offset:offset + length] = results[start:]
+            self.offset[row] = offset
+            self.length[row] = length
+            self.capacity[row] = length
+        self.features[row] = feature_rows(self.age[row:row + 1], self.sex[row:row + 1], self.timestamps, self.results,
+                                          self.offset[row:row + 1], self.length[row:row + 1])[0]
+
+    def set_demographics(self, mrn, age, sex):
+        row = self.add_patient(mrn)
+        self.age[row] = np.nan if age is None else age
+        self.sex[row] = SEX_CODES.get(sex, SEX_UNKNOWN)
+        self.features[row, 0] = self.age[row]
+        self.features[row, 1] = np.nan if self.sex[row] == SEX_UNKNOWN else self.sex[row]
+
+    def admit(self, mrn, date_of_birth, sex, today=None):
+        '''
+        Description:
+            Apply an ADT^A01 admission: add the patient if needed and update age and sex
+        input:
+            mrn: STRING
+            date_of_birth: STRING YYYYmmdd
+            sex: STRING 'M' or 'F'
+        '''
+        self.set_demographics(mrn, calculate_age(date_of_birth, today), sex)
+
+    def append_result(self, mrn, timestamp, result):
+        '''
+        Description:
+            Append one creatinine result to the patient's series, adding the patient if needed
+        input:
+            mrn: STRING
+            timestamp: INT epoch seconds
+            result: FLOAT
+        '''
+        row = self.add_patient(mrn)
+        length = int(self.length[row])
+        capacity = int(self.capacity[row])
+        if length == capacity:
+            offset = int(self.offset[row])
+            new_capacity = max(INITIAL_SERIES_CAPACITY, 2 * capacity)
+            if capacity and offset + capacity == self.arena_end:
+                # the series is the last one in the arena, extend it without copying
+                self._reserve_arena(new_capacity - capacity)
+            else:
+                new_offset = self._reserve_arena(new_capacity)
+                self.timestamps[new_offset:new_offset + length] = self.timestamps[offset:offset + length]
+                self.results[new_offset:new_offset + length] = self.results[offset:offset + length]
+                self.offset[row] = new_offset
+                self.free_slots += capacity
+            self.capacity[row] = new_capacity
+            capacity = new_capacity
+        position = int(self.offset[row]) + length
+        self.timestamps[position] = timestamp
+        self.results[position] = result
+        self.length[row] = length + 1
+
+        # shift the feature vector by one result: the newest result has gap 0 and the
+        # previous newest gets the gap to it, the older gaps do not change
+        features = self.features[row]
+        features[4:] = features[2:-2]
+        features[2] = result
+        features[3] = 0
+        features[5] = abs(timestamp - self.timestamps[position - 1]) if length else np.nan
+
+        if self.max_results is not None or self.max_age is not None:
+            start = position - length
+            excess = self._excess_at(start, length + 1)
+            if excess:
+                self.offset[row] = start + excess
+                self.length[row] = length + 1 - excess
+                self.capacity[row] = capacity - excess
+                self.free_slots += excess
+        if self.free_slots > self.arena_end * COMPACT_FREE_FRACTION:
+            self.compact()
+
+    def set_retention(self, max_results=None, max_age=None):
+        '''
+        Description:
+            Bound every patient's series: keep at most max_results results and drop results more
+            than max_age seconds older than the patient's newest one. The newest FEATURE_RESULTS
+            results are always kept, so the model input does not change. Patients already in the
+            store are trimmed now, base patients when they are copied into the overlay.
+        input:
+            max_results: INT or None for no limit, at least FEATURE_RESULTS
+            max_age: INT seconds or None for no limit
+        '''
+        if max_results is not None and max_results < FEATURE_RESULTS:
+            raise ValueError(f'max_results must be at least {FEATURE_RESULTS}, the results the model reads')
+        self.max_results = max_results
+        self.max_age = max_age
+        count = len(self._mrns)
+        lengths = self.length[:count].astype(np.int64)
+        over = lengths > FEATURE_RESULTS
+        if max_results is None and max_age is None or not over.any():
+            return
+        oldest = self.timestamps[np.where(over, self.offset[:count], 0)]
+        newest = self.timestamps[np.where(over, self.offset[:count] + lengths - 1, 0)]
+        if max_results is not None:
+            over &= (lengths > max_results) | ((newest - oldest > max_age) if max_age is not None else False)
+        else:
+            over &= newest - oldest > max_age
+        for row in np.flatnonzero(over):
+            self._retain(row)
+        if self.free_slots > self.arena_end * COMPACT_FREE_FRACTION:
+            self.compact()
+
+    def _excess(self, timestamps):
+        # number of oldest results of a series beyond the retention limits, never one of the newest FEATURE_RESULTS
+        length = len(timestamps)
+        limit = length - FEATURE_RESULTS
+        if limit <= 0:
+            return 0
+        drop = max(length - self.max_results, 0) if self.max_results is not None else 0
+        if self.max_age is not None and drop < limit:
+            old = timestamps[drop:limit] < timestamps[length - 1] - self.max_age
+            drop += len(old) if old.all() else int(np.argmin(old))
+        return min(drop, limit)
+
+    def _excess_at(self, start, length):
+        # _excess() of the series at arena slots start:start + length, without slicing it
+        # unless a result may have fallen out of the age window
+        excess = max(length - self.max_results, 0) if self.max_results is not None else 0
+        if (self.max_age is not None and excess < length - FEATURE_RESULTS
+                and self.timestamps[start + excess] < self.timestamps[start + length - 1] - self.max_age):
+            excess = self._excess(self.timestamps[start:start + length])
+        return excess
+
+    def _retain(self, row):
+        # drop the results beyond the retention limits from the front of the slice; the slots
+        # are not written to, so captures taken earlier still see them until compact()
+        excess = self._excess_at(int(self.offset[row]), int(self.length[row]))
+        if excess:
+            self.offset[row] += excess
+            self.length[row] -= excess
+            self.capacity[row] -= excess
+            self.free_slots += excess
+
+    def feature_row(self, mrn):
+        '''
+        Description:
+            The patient's model input, adding the patient if it does not exist
+        output:
+            features: float32 numpy view of shape (1, FEATURE_COLUMNS), updated in place by later writes
+        '''
+        row = self.add_patient(mrn)
+        return self.features[row:row + 1]
+
+    def series(self, mrn):
+        '''
+        Description:
+            The patient's creatinine series in arrival order
+        output:
+            (timestamps, results): read-only numpy views, empty if the patient is unknown
+        '''
+        row = self._index.get(mrn)
+        if row is None:
+            position = self.base.find(mrn) if self.base is not None else None
+            if position is not None:
+                return self.base.series(position)
+            return self.timestamps[:0], self.results[:0]
+        start = int(self.offset[row])
+        end = start + int(self.length[row])
+        timestamps = self.timestamps[start:end]
+        results = self.results[start:end]
+        timestamps.flags.writeable = False
+        results.flags.writeable = False
+        return timestamps, results
+
+    def overlay_mrns(self):
+        '''patients held in the overlay arrays: every patient without a base, only patients written since the base was compiled with one'''
+        return list(self._mrns)
+
+    def patient_state(self, mrn):
+        '''
+        Description:
+            Everything the store holds for a patient, e.g. to hand the patient over to another store
+        output:
+            (age, sex, timestamps, results): FLOAT or NaN, INT sex code, numpy copies of the series
+        '''
+        row = self._index.get(mrn)
+        position = self.base.find(mrn) if row is None and self.base is not None else None
+        if row is not None:
+            age, sex = float(self.age[row]), int(self.sex[row])
+        elif position is not None:
+            age, sex = float(self.base.age[position]), int(self.base.sex[position])
+        else:
+            age, sex = np.nan, SEX_UNKNOWN
+        timestamps, results = self.series(mrn)
+        return age, sex, np.array(timestamps, dtype=np.int64), np.array(results, dtype=np.float32)
+
+    def replace_patient(self, mrn, age, sex, timestamps, results):
+        '''
+        Description:
+            Replace everything the store holds for a patient, adding the patient if needed.
+            Applying the same state twice leaves the store unchanged.
+        input:
+            mrn: STRING
+            age: FLOAT or NaN
+            sex: INT sex code, as patient_state() returns it
+            timestamps: INT64 epoch seconds, results: FLOAT32, in arrival order
+        '''
+        row = self.add_patient(mrn)
+        length = len(results)
+        self.free_slots += int(self.capacity[row])
+        offset = self._reserve_arena(length)
+        self.timestamps[offset:offset + length] = timestamps
+        self.results[offset:offset + length] = results
+        self.offset[row] = offset
+        self.length[row] = length
+        self.capacity[row] = length
+        self.age[row] = age
+        self.sex[row] = sex
+        self._retain(row)
+        self.features[row] = feature_rows(self.age[row:row + 1], self.sex[row:row + 1], self.timestamps, self.results,
+                                          self.offset[row:row + 1], self.length[row:row + 1])[0]
+
+    def compact(self):
+        '''
+        Description:
+            Rebuild the arenas without the slots left behind by relocated series.
+            New arrays are allocated, so views handed out earlier stay valid.
+        '''
+        count = len(self._mrns)
+        offsets, timestamps, results = gather_series(self.timestamps, self.results, self.offset[:count], self.length[:count])
+        total = len(results)
+        size = max(INITIAL_ARENA_CAPACITY, total)
+        self.timestamps = np.zeros(size, dtype=np.int64)
+        self.results = np.zeros(size, dtype=np.float32)
+        self.timestamps[:total] = timestamps
+        self.results[:total] = results
+        self.offset[:count] = offsets
+        self.capacity[:count] = self.length[:count]
+        self.arena_end = total
+        self.free_slots = 0
+
+    def capture(self):
+        '''
+        Description:
+            Consistent point-in-time view of the store for a background snapshot. Only the
+            per-patient columns are copied; the arenas are shared because written slots are
+            never modified, so later appends do not change what the capture sees.
+        output:
+            capture: DIC, pass to columns_from_capture() on any thread. With a base layer
+            only the overlay is captured, restore it on top of the same base.
+        '''
+        count = len(self._mrns)
+        return {
+            'mrns': list(self._mrns),
+            'age': self.age[:count].copy(),
+            'sex': self.sex[:count].copy(),
+            'offset': self.offset[:count].copy(),
+            'length': self.length[:count].copy(),
+            'timestamps': self.timestamps,
+            'results': self.results,
+            'layered': self.base is not None,
+        }
+
+    def nbytes(self):
+        '''approximate memory used by the numpy columns and arenas, excluding the memory-mapped base'''
+        columns = (self.age, self.sex, self.offset, self.length, self.capacity, self.features, self.timestamps, self.results)
+        return sum(column.nbytes for column in columns)
+
+    def history_frame(self, mrn):
+        '''
+        Description:
+            Adapter for aggregate_data/predict_aki: the patient's data in the layout returned by
+            data_processor.get_patient_history, adding the patient if it does not exist
+        input:
+            mrn: STRING
+        output:
+            test_results: pd DataFrame with the following columns:
+            [age, sex, creatinine_date_0, creatinine_result_0, ..., creatinine_date_49, creatinine_result_49]
+        '''
+        row = self.add_patient(mrn)
+        timestamps, results = self.series(mrn)
+        pairs = max(HISTORY_COLUMN_PAIRS, len(results))
+        values = [np.nan] * (2 + 2 * pairs)
+        age = self.age[row]
+        values[0] = np.nan if np.isnan(age) else int(age)
+        values[1] = SEX_LABELS.get(int(self.sex[row]), np.nan)
+        values[2:2 + 2 * len(results):2] = pd.to_datetime(timestamps, unit='s')
+        values[3:3 + 2 * len(results):2] = results.astype(np.float64).tolist()
+        return pd.DataFrame([values], columns=history_columns(pairs)[1:])
+
+    def columns(self):
+        '''
+        Description:
+            Every patient, base and overlay, in the packed columnar layout of columns_from_capture()
+        '''
+        overlay = columns_from_capture(self.capture())
+        if self.base is None:
+            return overlay
+        keep = np.flatnonzero([mrn not in self._index for mrn in self.base.mrns()])
+        base_offsets, base_lengths, base_timestamps, base_results = self.base.gather(keep)
+        return {
+            'mrns': np.concatenate([self.base.mrn_keys[keep], overlay['mrns']]),
+            'age': np.concatenate([self.base.age[keep], overlay['age']]),
+            'sex': np.concatenate([self.base.sex[keep], overlay['sex']]),
+            'offset': np.concatenate([base_offsets, overlay['offset'] + len(base_results)]),
+            'length': np.concatenate([base_lengths, overlay['length']]),
+            'timestamps': np.concatenate([base_timestamps, overlay['timestamps']]),
+            'results': np.concatenate([base_results, overlay['results']]),
+        }
+
+    def to_dataframe(self):
+        '''
+        Description:
+            Export every patient in the wide layout of load_and_process_history, e.g. for CSV dumps
+        output:
+            historical_data: pd DataFrame [mrn, age, sex, creatinine_date_0, creatinine_result_0, ...]
+        '''
+        columns = self.columns()
+        count = len(columns['mrns'])
+        lengths = columns['length']
+        pairs = max(HISTORY_COLUMN_PAIRS, int(lengths.max()) if count else 0)
+        data = np.full((count, 3 + 2 * pairs), np.nan, dtype=object)
+        data[:, 0] = np.char.decode(columns['mrns']).astype(object) if count else []
+        ages = columns['age']
+        known = ~np.isnan(ages)
+        data[known, 1] = ages[known].astype(np.int64)
+        for code, label in SEX_LABELS.items():
+            data[columns['sex'] == code, 2] = label
+        # format all dates once, in the 'YYYY-mm-dd HH:MM:SS' style of history.csv
+        dates = np.char.replace(np.datetime_as_string(columns['timestamps'].astype('datetime64[s]'), unit='s'), 'T', ' ').astype(object)
+        results = columns['results'].astype(np.float64).astype(object)
+        for row in range(count):
+            start = int(columns['offset'][row])
+            n = int(lengths[row])
+            data[row, 3:3 + 2 * n:2] = dates[start:start + n]
+            data[row, 4:4 + 2 * n:2] = results[start:start + n]
+        return pd.DataFrame(data, columns=history_columns(pairs))
+
+    @classmethod
+    def from_columns(cls, columns, base=None):
+        '''
+        Description:
+            Build a store from the packed columnar layout (e.g. memory-mapped snapshot files)
+        input:
+            columns: DIC of numpy arrays, see columns_from_capture()
+            base: HistoryBase or None, the base the columns were captured on top of
+        output:
+            store: PatientStore
+        '''
+        count = len(columns['mrns'])
+        total = len(columns['results'])
+        store = cls(patient_capacity=count + count // 4 + INITIAL_PATIENT_CAPACITY,
+                    arena_capacity=total + total // 4 + INITIAL_ARENA_CAPACITY, base=base)
+        store._mrns = np.char.decode(columns['mrns']).tolist() if count else []
+        store._index = {mrn: row for row, mrn in enumerate(store._mrns)}
+        if base is not None:
+            store._shadowed = sum(1 for mrn in store._mrns if base.find(mrn) is not None)
+        store.age[:count] = columns['age']
+        store.sex[:count] = columns['sex']
+        store.offset[:count] = columns['offset']
+        store.length[:count] = columns['length']
+        store.capacity[:count] = columns['length']
+        store.timestamps[:total] = columns['timestamps']
+        store.results[:total] = columns['results']
+        store.arena_end = total
+        store.features[:count] = feature_rows(store.age[:count], store.sex[:count], store.timestamps, store.results,
+                                              store.offset[:count], store.length[:count])
+        return store
+
+    @classmethod
+    def from_dataframe(cls, historical_data):
+        '''
+        Description:
+            Build a store from the wide layout of load_and_process_history (or a CSV dump of it)
+        input:
+            historical_data: pd DataFrame [mrn, age, sex, creatinine_date_0, creatinine_result_0, ...]
+        output:
+            store: PatientStore
+        '''
+        count = len(historical_data)
+        dates = historical_data.iloc[:, 3::2]
+        values = historical_data.iloc[:, 4::2]
+        timestamps = np.column_stack([
+            pd.to_datetime(dates[column], errors='coerce').to_numpy(dtype='datetime64[s]').astype(np.int64)
+            for column in dates.columns
+        ]) if count else np.zeros((0, 0), dtype=np.int64)
+        results = values.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        valid = ~np.isnan(results) & (timestamps != np.iinfo(np.int64).min)
+        lengths = valid.sum(axis=1)
+
+        total = int(lengths.sum())
+        # leave headroom so the first admissions and appends do not copy every column
+        store = cls(patient_capacity=count + count // 4 + INITIAL_PATIENT_CAPACITY,
+                    arena_capacity=total + total // 4 + INITIAL_ARENA_CAPACITY)
+        mrns = historical_data['mrn'].astype(str).tolist()
+        store._mrns = mrns
+        store._index = {mrn: row for row, mrn in enumerate(mrns)}
+        # row-major boolean indexing keeps every patient's results contiguous and in order
+        store.timestamps[:total] = timestamps[valid]
+        store.results[:total] = results[valid]
+        store.arena_end = total
+        store.length[:count] = lengths
+        store.capacity[:count] = lengths
+        if count:
+            np.cumsum(lengths[:-1], out=store.offset[1:count])
+        store.age[:count] = pd.to_numeric(historical_data['age'], errors='coerce').to_numpy(dtype=np.float32)
+        store.sex[:count] = historical_data['sex'].map(SEX_CODES).fillna(SEX_UNKNOWN).to_numpy(dtype=np.int8)
+        store.features[:count] = feature_rows(store.age[:count], store.sex[:count], store.timestamps, store.results,
+                                              store.offset[:count], store.length[:count])
+        return store
+
+
+class HistoryBase:
+    '''
+    Description:
+        Read-only patient layer over the packed columnar layout, normally the memory-mapped
+        files written by history_compiler.py. MRNs are sorted, so a patient is found by
+        binary search and its series is a view into the mapped arrays.
+    '''
+
+    def __init__(self, columns):
+        self.mrn_keys = columns['mrns']
+        self.age = columns['age']
+        self.sex = columns['sex']
+        self.offset = columns['offset']
+        self.length = columns['length']
+        self.timestamps = columns['timestamps']
+        self.results = columns['results']
+        self._mrns = None
+
+    def __len__(self):
+        return len(self.mrn_keys)
+
+    def mrns(self):
+        if self._mrns is None:
+            self._mrns = np.char.decode(self.mrn_keys).tolist() if len(self.mrn_keys) else []
+        return self._mrns
+
+    def find(self, mrn):
+        '''position of the patient in the base, None if it is not there'''
+        key = mrn.encode()
+        position = int(np.searchsorted(self.mrn_keys, key))
+        if position < len(self.mrn_keys) and self.mrn_keys[position] == key:
+            return position
+        return None
+
+    def series(self, position):
+        start = int(self.offset[position])
+        end = start + int(self.length[position])
+        return self.timestamps[start:end], self.results[start:end]
+
+    def gather(self, positions):
+        '''
+        Description:
+            The series of the patients at `positions`, packed contiguously in that order, for
+            exports of the whole store
+        output:
+            (offsets, lengths, timestamps, results): numpy arrays
+        '''
+        offsets, timestamps, results = gather_series(self.timestamps, self.results, self.offset[positions], self.length[positions])
+        return offsets, self.length[positions], timestamps, results
+
+
+def empty_features(rows):
+    features = np.full((rows, FEATURE_COLUMNS), np.nan, dtype=np.float32)
+    features[:, 3] = 0
+    return features
+
+
+def feature_rows(age, sex, timestamps, results, offsets, lengths):
+    '''
+    Description:
+        Model feature vectors of many patients at once, from the newest FEATURE_RESULTS
+        results of each series
+    output:
+        features: float32 numpy array (patients, FEATURE_COLUMNS)
+    '''
+    features = empty_features(len(lengths))
+    features[:, 0] = age
+    features[:, 1] = np.where(sex == SEX_UNKNOWN, np.nan, sex)
+    lengths = lengths.astype(np.int64)
+    newer = None
+    for k in range(FEATURE_RESULTS):
+        present = lengths > k
+        position = np.where(present, offsets + lengths - 1 - k, 0)
+        current = timestamps[position] if len(timestamps) else np.zeros(len(lengths), dtype=np.int64)
+        features[present, 2 + 2 * k] = results[position[present]]
+        if k:
+            features[present, 3 + 2 * k] = np.abs(newer[present] - current[present])
+        newer = current
+    return features
+
+
+def sort_columns(columns):
+    '''reorder packed columns by MRN, the layout HistoryBase expects'''
+    order = np.argsort(columns['mrns'], kind='stable')
+    offsets, timestamps, results = gather_series(columns['timestamps'], columns['results'], columns['offset'][order], columns['length'][order])
+    return {
+        'mrns': columns['mrns'][order],
+        'age': columns['age'][order],
+        'sex': columns['sex'][order],
+        'offset': offsets,
+        'length': columns['length'][order],
+        'timestamps': timestamps,
+        'results': results,
+    }
+
+
+def gather_series(timestamps, results, offsets, lengths):
+    '''
+    Description:
+        Pack the series described by offsets/lengths contiguously, in patient order
+    output:
+        (new_offsets, timestamps, results): numpy arrays
+    '''
+    lengths = lengths.astype(np.int64)
+    total = int(lengths.sum())
+    new_offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=new_offsets[1:])
+    # index of every live slot: offset of its series plus its position in the series
+    gather = np.repeat(offsets - new_offsets, lengths) + np.arange(total)
+    return new_offsets, timestamps[gather], results[gather]
+
+
+def columns_from_capture(capture):
+    '''
+    Description:
+        Packed columnar layout of a captured store: MRN index, offsets, lengths, demographics
+        and the packed series. This is the layout of snapshots on disk.
+    '''
+    offsets, timestamps, results = gather_series(capture['timestamps'], capture['results'], capture['offset'], capture['length'])
+    return {
+        'mrns': np.array(capture['mrns'], dtype=np.bytes_) if capture['mrns'] else np.zeros(0, dtype='S1'),
+        'age': capture['age'],
+        'sex': capture['sex'],
+        'offset': offsets,
+        'length': capture['length'],
+        'timestamps': timestamps,
+        'results': results,
+        'layered': np.array([capture.get('layered', False)]),
+    }
+
+
+def columns_from_history(history):
+    '''
+    Description:
+        Packed columnar layout of the typed arrays parsed by data_processor.load_history_arrays,
+        without going through the wide DataFrame
+    '''
+    count = len(history['mrns'])
+    offsets = np.zeros(count, dtype=np.int64)
+    np.cumsum(history['length'][:-1], out=offsets[1:])
+    return {
+        'mrns': history['mrns'].astype(np.bytes_) if count else np.zeros(0, dtype='S1'),
+        'age': np.full(count, np.nan, dtype=np.float32),
+        'sex': np.full(count, SEX_UNKNOWN, dtype=np.int8),
+        'offset': offsets,
+        'length': history['length'].astype(np.int32),
+        'timestamps': history['timestamps'].astype('datetime64[s]').view(np.int64),
+        'results': history['results'].astype(np.float32),
+    }
+
+
+def history_columns(pairs=HISTORY_COLUMN_PAIRS):
+    '''column names of the wide history layout'''
+    columns = ['mrn', 'age', 'sex']
+    for i in range(pairs):
+        columns.append(f'creatinine_date_{i}')
+        columns.append(f'creatinine_result_{i}')
+    return columns
@@ -0,0 +1,108 @@
+import math
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+# seconds of results the input quantiles are computed over
+DEFAULT_WINDOW = 3600.0
+# values per block of the sorted list, blocks are split at twice this size
+BLOCK_SIZE = 512
+
+
+class RollingQuantiles:
+    '''
+    Description:
+        Quantiles of the values added in the last `window` seconds. Values are kept in
+        arrival order for eviction and in a sorted list split into blocks of at most
+        2 * BLOCK_SIZE values: adding or evicting a value is a binary search over the block
+        maxima plus an insert into one bounded block, so it does not depend on how many
+        values the window holds. Quantiles are only computed when asked for, e.g. when
+        the metrics are scraped.
+    '''
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._arrivals = deque()
+        self._blocks = []
+        self._maxima = []
+        self._count = 0
+        # time the newest value was added at, the clock of a window aged by message time
+        self.last_time = None
+        # values are added by the detector thread and read by the metrics server thread
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value, now=None):
+        '''
+        Description:
+            Add a value received at `now` (epoch seconds, default the current time) and evict expired values
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._evict(now)
+            self._arrivals.append((now, value))
+            self._insert(value)
+            self.last_time = now
+
+    def quantile(self, q, now=None):
+        '''
+        Description:
+            The q-quantile of the values in the window, interpolated linearly like pandas' median()
+        output:
+            value: FLOAT, NaN if the window is empty
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._evict(now)
+            if not self._count:
+                return math.nan
+            position = q * (self._count - 1)
+            lower = math.floor(position)
+            low = self._select(lower)
+            if position == lower:
+                return low
+            return low + (self._select(lower + 1) - low) * (position - lower)
+
+    def median(self, now=None):
+        return self.quantile(0.5, now)
+
+    def _evict(self, now):
+        horizon = now - self.window
+        while self._arrivals and self._arrivals[0][0] <= horizon:
+            self._remove(self._arrivals.popleft()[1])
+
+    def _insert(self, value):
+        if not self._blocks:
+            self._blocks.append([value])
+            self._maxima.append(value)
+        else:
+            i = min(bisect_right(self._maxima, value), len(self._blocks) - 1)
+            block = self._blocks[i]
+            insort(block, value)
+            self._maxima[i] = block[-1]
+            if len(block) > 2 * BLOCK_SIZE:
+                self._blocks[i:i + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+                self._maxima[i:i + 1] = [block[BLOCK_SIZE - 1], block[-1]]
+        self._count += 1
+
+    def _remove(self, value):
+        i = bisect_left(self._maxima, value)
+        block = self._blocks[i]
+        del block[bisect_left(block, value)]
+        if block:
+            self._maxima[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxima[i]
+        self._count -= 1
+
+    def _select(self, k):
+        # k-th smallest value, walking the block sizes
+        for block in self._blocks:
+            if k < len(block):
+                return block[k]
+            k -= len(block)
+        raise IndexError(k)
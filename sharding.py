@@ -0,0 +1,298 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ingestion
+import metrics
+from history_index import DEFAULT_CACHE_PATIENTS
+from patient_store import DEFAULT_MAX_RESULTS
+from listener import build_ack, control_id
+
+SHARD_PREFIX = 'shard-'
+# records the number of shards the state directory is split into
+SHARDS_FILE = 'shards'
+# batches sent to the workers and not acknowledged yet before the listener stops reading
+SHARD_IN_FLIGHT = 8
+
+# sent to a worker after the last batch
+STOP = None
+
+
+def shard_of(mrn, shards):
+    '''
+    Description:
+        Shard owning a patient. The hash is stable across processes and restarts, unlike hash().
+    input:
+        mrn: STRING
+        shards: INT
+    output:
+        shard: INT in [0, shards)
+    '''
+    return zlib.crc32(mrn.encode()) % shards
+
+
+def message_mrn(message):
+    '''
+    Description:
+        MRN of an HL7 message for routing: the leading digits of PID-3 of its first PID segment,
+        which is what the parser reads. Messages without one are routed to shard 0, which rejects them.
+    output:
+        mrn: STRING, empty if there is no PID segment
+    '''
+    if b'\n' in message:
+        message = message.replace(b'\n', b'\r')
+    start = message.find(b'\rPID|')
+    if start < 0:
+        return ''
+    end = message.find(b'\r', start + 1)
+    fields = message[start + 1:end if end >= 0 else len(message)].split(b'|', 4)
+    if len(fields) < 4:
+        return ''
+    field = fields[3]
+    digits = len(field) - len(field.lstrip(b'0123456789'))
+    return field[:digits].decode()
+
+
+def shard_history(history, shard, shards):
+    '''
+    Description:
+        Keep the patients of one shard in the typed history arrays of data_processor.load_history_arrays
+    '''
+    keep = np.fromiter((shard_of(mrn, shards) == shard for mrn in history['mrns']), dtype=bool, count=len(history['mrns']))
+    results = np.repeat(keep, history['length'])
+    return {
+        'mrns': history['mrns'][keep],
+        'length': history['length'][keep],
+        'timestamps': history['timestamps'][results],
+        'results': history['results'][results],
+    }
+
+
+def shard_directory(state_dir, shard):
+    return os.path.join(state_dir, f'{SHARD_PREFIX}{shard:03d}')
+
+
+def check_layout(state_dir, shards):
+    '''
+    Description:
+        Refuse to start with a number of shards the state directory was not written with: the
+        patients of a shard would be looked up in another shard's state and their history lost.
+        Records the number of shards on the first sharded start.
+    input:
+        state_dir: STRING
+        shards: INT, 0 for the unsharded layout
+    '''
+    path = os.path.join(state_dir, SHARDS_FILE)
+    existing = 0
+    if os.path.exists(path):
+        with open(path) as file:
+            existing = int(file.read())
+    elif shards and os.path.isdir(state_dir) and any(name.startswith(('journal-', 'snapshot-')) for name in os.listdir(state_dir)):
+        raise ValueError(f'{state_dir} holds unsharded state, it cannot be started with {shards} workers')
+    if existing != shards:
+        if existing:
+            raise ValueError(f'{state_dir} is split into {existing} shards, it cannot be started with {shards} workers')
+        if shards:
+            os.makedirs(state_dir, exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(f'{shards}\n')
+
+
+def run_worker(shard, shards, config, connection):
+    '''
+    Description:
+        Worker process: restore the shard's patients, then apply the batches the listener sends
+        in order and reply with their results once their journal records are durable
+    '''
+    # imported here, the listener process only needs the routing functions
+    import app
+    from prometheus_client import start_http_server
+
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    if config.get('metrics_port') is not None:
+        start_http_server(config['metrics_port'] + shard)
+    app.restore_state(config['history'], config.get('compiled_history'), shard_directory(config['state_dir'], shard),
+                      config['commit_interval'], config['snapshot_interval'],
+                      history_filter=lambda history: shard_history(history, shard, shards), lazy_history=config.get('lazy_history', False),
+                      cache_patients=config.get('cache_patients', DEFAULT_CACHE_PATIENTS), memory_budget=config.get('memory_budget'),
+                      max_results=config.get('max_results', DEFAULT_MAX_RESULTS), max_age=config.get('max_age'))
+    state = app.detector_state(config['model'], config['threshold'], config['input_window'], [])
+    state['message_time'] = config.get('message_time', False)
+    connection.send(shard)
+    try:
+        while True:
+            batch = connection.recv()
+            if batch is STOP:
+                break
+            results = app.handle_batch(batch, state)
+            with metrics.timed('persist'):
+                app.patient_journal.wait_durable()
+            connection.send(results)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        app.patient_journal.close()
+        connection.close()
+
+
+def start_workers(shards, config):
+    '''
+    Description:
+        Start one worker process per shard and wait until every shard is restored
+    input:
+        shards: INT
+        config: DIC with history, compiled_history, state_dir, commit_interval, snapshot_interval,
+            model, threshold, input_window, and optionally metrics_port (the worker of shard k
+            serves its metrics on metrics_port + k), message_time, and lazy_history, cache_patients,
+            memory_budget (per worker), max_results and max_age as app.restore_state() takes them
+    output:
+        workers: list of (process, connection) per shard
+    '''
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for shard in range(shards):
+        connection, child = context.Pipe()
+        process = context.Process(target=run_worker, args=(shard, shards, config, child), name=f'shard-{shard}', daemon=True)
+        process.start()
+        child.close()
+        workers.append((process, connection))
+    start = time.time()
+    for process, connection in workers:
+        connection.recv()
+    print(f"{shards} shard workers ready in {time.time() - start:.2f}s")
+    return workers
+
+
+def stop_workers(workers):
+    '''
+    Description:
+        Stop the workers after the batches already sent, their journals are flushed on the way out
+    '''
+    for process, connection in workers:
+        try:
+            connection.send(STOP)
+        except (OSError, ValueError):
+            pass
+    for process, connection in workers:
+        process.join()
+        connection.close()
+    workers.clear()
+
+
+def read_replies(loop, connection, replies):
+    # one thread per worker hands its replies, in order, to the ACK stage
+    while True:
+        try:
+            reply = connection.recv()
+        except (EOFError, OSError):
+            reply = EOFError('shard worker exited')
+        try:
+            loop.call_soon_threadsafe(replies.put_nowait, reply)
+        except RuntimeError:
+            # the pipeline already finished, e.g. the worker was stopped after the connection closed
+            return
+        if isinstance(reply, Exception):
+            return
+
+
+async def dispatch_batches(loop, frames, in_flight, workers, executor, batch_size, batch_wait):
+    '''
+    Description:
+        Routing stage: split micro-batches of frames by shard and send each part to its worker.
+        A patient's messages always go to the same worker, in arrival order.
+    '''
+    try:
+        closed = False
+        while not closed:
+            batch, closed = await ingestion.collect_batch(loop, frames, batch_size, batch_wait)
+            if not batch:
+                break
+            routes = [shard_of(message_mrn(message), len(workers)) for message, _ in batch]
+            parts = {}
+            for (message, _), shard in zip(batch, routes):
+                parts.setdefault(shard, []).append(message)
+            for shard, messages in parts.items():
+                await loop.run_in_executor(executor, workers[shard][1].send, messages)
+            await in_flight.put((batch, routes, list(parts)))
+    finally:
+        await in_flight.put(None)
+
+
+async def send_acks(loop, sock, in_flight, replies, send_page, executor):
+    '''
+    Description:
+        ACK stage: take the workers' results batch after batch and acknowledge the messages in
+        arrival order. Workers only reply once the records are durable, and a message's page
+        is recorded by send_page before its ACK is sent, so it survives a crash.
+    '''
+    while True:
+        item = await in_flight.get()
+        if item is None:
+            break
+        batch, routes, shards = item
+        results = {}
+        for shard in shards:
+            reply = await replies[shard].get()
+            if isinstance(reply, Exception):
+                raise reply
+            results[shard] = iter(reply)
+        for (message, start_time), shard in zip(batch, routes):
+            processed, page = next(results[shard])
+            if not processed:
+                print("Parsing failed, skipping this message.")
+                continue
+            if page is not None:
+                await loop.run_in_executor(executor, send_page, *page)
+            sent = time.perf_counter()
+            await loop.sock_sendall(sock, build_ack(control_id(message)))
+            metrics.observe('ack', time.perf_counter() - sent)
+            metrics.MESSAGES_ACKNOWLEDGED.inc()
+            overall_latency = time.time() - start_time
+            metrics.OVERALL_LATENCY.set(overall_latency)
+            metrics.observe('overall', overall_latency)
+
+
+async def run_pipeline(sock, workers, send_page, queue_size, batch_size, batch_wait):
+    loop = asyncio.get_running_loop()
+    frames = asyncio.Queue(maxsize=queue_size)
+    in_flight = asyncio.Queue(maxsize=SHARD_IN_FLIGHT)
+    replies = [asyncio.Queue() for _ in workers]
+    for (_, connection), queue in zip(workers, replies):
+        threading.Thread(target=read_replies, args=(loop, connection, queue), daemon=True).start()
+    # one thread each, so batches and pages keep their order
+    with ThreadPoolExecutor(max_workers=1) as sender, ThreadPoolExecutor(max_workers=1) as pager:
+        await asyncio.gather(
+            ingestion.read_frames(loop, sock, frames),
+            dispatch_batches(loop, frames, in_flight, workers, sender, batch_size, batch_wait),
+            send_acks(loop, sock, in_flight, replies, send_page, pager),
+        )
+
+
+def run(sock, workers, send_page, queue_size=ingestion.INGESTION_QUEUE_SIZE,
+        batch_size=ingestion.BATCH_SIZE, batch_wait=ingestion.BATCH_WAIT):
+    '''
+    Description:
+        Run the sharded ingestion engine until the MLLP connection closes: this process frames
+        the messages and acknowledges them in order, the workers from start_workers() parse,
+        store and score them
+    input:
+        sock: socket from ingestion.connect()
+        workers: list from start_workers()
+        send_page: callable(mrn, prediction_date), called before the message's ACK is sent; it
+            should only record the page, e.g. PagerDispatcher.submit(), and leave the delivery
+            to another thread
+        queue_size: INT, maximum number of framed messages waiting to be routed
+        batch_size: INT, maximum number of messages per batch, split between the workers
+        batch_wait: FLOAT, seconds a batch waits for more messages after the first one
+    '''
+    try:
+        asyncio.run(run_pipeline(sock, workers, send_page, queue_size, batch_size, batch_wait))
+    finally:
+        sock.close()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import csv
 import datetime
+import json
 import http.server
+import itertools
+import mmap
+import os
+import random
 import signal
 import socket
 import threading
@@ -12,15 +19,36 @@ VERSION = "0.0.0"
 MLLP_BUFFER_SIZE = 1024
 MLLP_TIMEOUT_SECONDS = 10
 SHUTDOWN_POLL_INTERVAL_SECONDS = 2
+# a page later than this after its ORU^R01 was sent misses the SLA
+PAGE_SLA_SECONDS = 3.0
+# sent results not paged after this long are forgotten, a page arriving later is unmatched
+PAGE_MATCH_HORIZON_SECONDS = 600
 
-def serve_mllp_client(client, source, messages, shutdown_mllp, short_messages):
-    i = 0
+# load generation: MRNs of connection n start at GENERATE_MRN_START + n * patients
+GENERATE_MRN_START = 90000000
+GENERATE_START = "20240401000000"
+# share of generated messages that admit or discharge a patient, the rest are creatinine results
+GENERATE_ADMIT_SHARE = 0.15
+GENERATE_DISCHARGE_SHARE = 0.1
+# an AKI-like trajectory grows by this factor per result, up to GENERATE_AKI_PEAK times its baseline
+GENERATE_AKI_GROWTH = (1.15, 1.5)
+GENERATE_AKI_PEAK = 4.0
+GENERATE_NAMES = ["JOHN DOE", "JANE DOE", "ALEX SMITH", "SAM JONES", "CHRIS TAYLOR", "ROBIN BROWN"]
+
+def serve_mllp_client(client, source, messages, shutdown_mllp, tracker, short_messages):
     buffer = b""
-    while i < len(messages) and not shutdown_mllp.is_set():
+    messages = iter(messages)
+    try:
+        message = next(messages, None)
+    except Exception as e:
+        print(f"mllp: {source}: {e}")
+        print(f"mllp: {source}: closing connection: error")
+        client.close()
+        return
+    while message is not None and not shutdown_mllp.is_set():
         try:
-            mllp = bytes(chr(MLLP_START_OF_BLOCK), "ascii")
-            mllp += messages[i]
-            mllp += bytes(chr(MLLP_END_OF_BLOCK) + chr(MLLP_CARRIAGE_RETURN), "ascii")
+            mllp = to_mllp_frame(message)
+            tracker.record_send(message)
             if not short_messages:
                 client.sendall(mllp)
             else:
@@ -38,7 +66,7 @@ def serve_mllp_client(client, source, messages, shutdown_mllp, short_messages):
             if error:
                 raise Exception(error)
             elif acked:
-                i += 1
+                message = next(messages, None)
             else:
                 print(f"mllp: {source}: message not acknowledged")
         except Exception as e:
@@ -46,14 +74,193 @@ def serve_mllp_client(client, source, messages, shutdown_mllp, short_messages):
             print(f"mllp: {source}: closing connection: error")
             break
     else:
-        if i == len(messages):
+        if message is None:
             print(f"mllp: {source}: closing connection: end of messages")
         else:
             print(f"mllp: {source}: closing connection: mllp shutdown")
     client.close()
 
+def serve_window_client(client, source, messages, shutdown_mllp, tracker, window):
+    # up to `window` messages in flight, every ACK is matched to its message by control ID
+    buffer = b""
+    in_flight = {}
+    sent = 0
+    end_of_messages = False
+    try:
+        messages = iter(messages)
+        while not shutdown_mllp.is_set():
+            frames = []
+            while not end_of_messages and len(in_flight) < window:
+                message = next(messages, None)
+                if message is None:
+                    end_of_messages = True
+                    break
+                sent += 1
+                message, control_id = with_control_id(message, str(sent).encode())
+                if control_id in in_flight:
+                    raise Exception(f"control ID {control_id!r} is already in flight")
+                in_flight[control_id] = message
+                tracker.record_send(message)
+                frames.append(to_mllp_frame(message))
+            if frames:
+                client.sendall(b"".join(frames))
+            if not in_flight:
+                break
+            r = client.recv(MLLP_BUFFER_SIZE)
+            if len(r) == 0:
+                raise Exception("client closed connection")
+            buffer += r
+            received, buffer = parse_mllp_messages(buffer, source)
+            for ack in received:
+                acked, error = verify_ack([ack])
+                if error:
+                    raise Exception(error)
+                control_id = ack_control_id(ack)
+                if control_id not in in_flight:
+                    raise Exception(f"ACK for control ID {control_id!r}, which is not in flight")
+                if acked:
+                    del in_flight[control_id]
+                else:
+                    print(f"mllp: {source}: message {control_id.decode()} not acknowledged")
+                    client.sendall(to_mllp_frame(in_flight[control_id]))
+    except Exception as e:
+        print(f"mllp: {source}: {e}")
+        print(f"mllp: {source}: closing connection: error")
+        client.close()
+        return
+    if shutdown_mllp.is_set():
+        print(f"mllp: {source}: closing connection: mllp shutdown")
+    else:
+        print(f"mllp: {source}: closing connection: end of messages")
+    client.close()
+
+def generate_hl7_messages(patients, seed=0, start=GENERATE_START, interval=60.0, result_mean=90.0,
+                          result_sigma=0.25, aki_fraction=0.1, mrn_start=GENERATE_MRN_START):
+    # endless stream of admissions, creatinine results and discharges over a pool of patients.
+    # Message times advance by exponential gaps of mean `interval` simulated seconds.
+    rng = random.Random(seed)
+    clock = datetime.datetime.strptime(start, "%Y%m%d%H%M%S")
+    waiting = list(range(mrn_start, mrn_start + patients))
+    admitted = []
+    # mrn -> [baseline, current result, aki trajectory, results since admission]
+    stays = {}
+    while True:
+        clock += datetime.timedelta(seconds=rng.expovariate(1 / interval))
+        timestamp = clock.strftime("%Y%m%d%H%M%S")
+        header = f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{timestamp}||"
+        draw = rng.random()
+        if waiting and (not admitted or draw < GENERATE_ADMIT_SHARE):
+            i = rng.randrange(len(waiting))
+            waiting[i], waiting[-1] = waiting[-1], waiting[i]
+            mrn = waiting.pop()
+            admitted.append(mrn)
+            baseline = result_mean * rng.lognormvariate(0, result_sigma)
+            stays[mrn] = [baseline, baseline, rng.random() < aki_fraction, 0]
+            birth = datetime.date(rng.randint(1930, 2005), rng.randint(1, 12), rng.randint(1, 28))
+            yield (f"{header}ADT^A01|||2.5\rPID|1||{mrn}||{rng.choice(GENERATE_NAMES)}||{birth:%Y%m%d}|{rng.choice('MF')}\r"
+                   f"NK1|1|X|PARTNER\r").encode()
+            continue
+        i = rng.randrange(len(admitted))
+        mrn = admitted[i]
+        stay = stays[mrn]
+        if draw > 1 - GENERATE_DISCHARGE_SHARE and stay[3] > 0:
+            admitted[i] = admitted[-1]
+            admitted.pop()
+            del stays[mrn]
+            waiting.append(mrn)
+            yield f"{header}ADT^A03|||2.5\rPID|1||{mrn}\r".encode()
+            continue
+        baseline, current, aki, _ = stay
+        if aki and stay[3] > 0:
+            stay[1] = min(current * rng.uniform(*GENERATE_AKI_GROWTH), baseline * GENERATE_AKI_PEAK)
+        else:
+            stay[1] = baseline * rng.gauss(1, 0.08)
+        stay[3] += 1
+        yield (f"{header}ORU^R01|||2.5\rPID|1||{mrn}\rOBR|1||||||{timestamp}\r"
+               f"OBX|1|SN|CREATININE||{stay[1]:.2f}\r").encode()
+
+def to_mllp_frame(message):
+    return bytes([MLLP_START_OF_BLOCK]) + message + bytes([MLLP_END_OF_BLOCK, MLLP_CARRIAGE_RETURN])
+
+def read_load_acks(client, source, stats, sending_done):
+    buffer = b""
+    while not (sending_done.is_set() and stats["acked"] + stats["nacked"] >= stats["sent"]):
+        try:
+            r = client.recv(MLLP_BUFFER_SIZE)
+        except TimeoutError:
+            if sending_done.is_set():
+                print(f"mllp: {source}: timed out waiting for acks")
+                return
+            continue
+        except OSError:
+            return
+        if len(r) == 0:
+            return
+        buffer += r
+        received, buffer = parse_mllp_messages(buffer, source)
+        for ack in received:
+            acked, error = verify_ack([ack])
+            if acked:
+                stats["acked"] += 1
+            else:
+                stats["nacked"] += 1
+
+def serve_load_client(client, source, messages, shutdown_mllp, tracker, rate, duration):
+    # open loop: message i is sent at start + i / rate whether or not earlier messages were
+    # acknowledged yet, ACKs are counted by a separate reader
+    stats = {"sent": 0, "acked": 0, "nacked": 0}
+    sending_done = threading.Event()
+    reader = threading.Thread(target=read_load_acks, args=(client, source, stats, sending_done), daemon=True)
+    reader.start()
+    start = time.monotonic()
+    max_lag = 0.0
+    try:
+        for i, message in enumerate(messages):
+            now = time.monotonic()
+            if shutdown_mllp.is_set() or (duration and now - start >= duration):
+                break
+            if rate:
+                lag = now - (start + i / rate)
+                if lag < 0:
+                    time.sleep(-lag)
+                else:
+                    max_lag = max(max_lag, lag)
+            tracker.record_send(message)
+            client.sendall(to_mllp_frame(message))
+            stats["sent"] += 1
+    except Exception as e:
+        print(f"mllp: {source}: {e}")
+    elapsed = time.monotonic() - start
+    sending_done.set()
+    reader.join()
+    print(f"mllp: {source}: sent {stats['sent']} messages in {elapsed:.1f}s ({stats['sent'] / max(elapsed, 1e-9):.0f}/s, "
+          f"target {rate or 'unlimited'}/s, max send lag {max_lag * 1000:.0f}ms), "
+          f"{stats['acked']} acknowledged, {stats['nacked']} not acknowledged")
+    print(f"mllp: {source}: closing connection: end of load")
+    client.close()
+
 HL7_MSA_ACK_CODE_FIELD = 1
 HL7_MSA_ACK_CODE_ACCEPT = b"AA"
+HL7_MSA_CONTROL_ID_FIELD = 2
+HL7_MSH_CONTROL_ID_FIELD = 9
+
+def with_control_id(message, control_id):
+    # the message and its MSH-10 control ID, which is set to control_id if the message has none
+    end = message.find(b"\r")
+    end = len(message) if end == -1 else end
+    fields = message[:end].split(b"|")
+    if len(fields) > HL7_MSH_CONTROL_ID_FIELD and fields[HL7_MSH_CONTROL_ID_FIELD]:
+        return message, fields[HL7_MSH_CONTROL_ID_FIELD]
+    fields.extend([b""] * (HL7_MSH_CONTROL_ID_FIELD + 1 - len(fields)))
+    fields[HL7_MSH_CONTROL_ID_FIELD] = control_id
+    return b"|".join(fields) + message[end:], control_id
+
+def ack_control_id(message):
+    for segment in message.split(b"\r"):
+        fields = segment.split(b"|")
+        if fields[0] == b"MSA":
+            return fields[HL7_MSA_CONTROL_ID_FIELD] if len(fields) > HL7_MSA_CONTROL_ID_FIELD else b""
+    return b""
 
 def verify_ack(messages):
     if len(messages) != 1:
@@ -69,14 +276,16 @@ def verify_ack(messages):
         return False, "Wrong number of fields in MSA segment"
     return fields[HL7_MSA_ACK_CODE_FIELD] == HL7_MSA_ACK_CODE_ACCEPT, None
 
-def run_mllp_server(host, port, hl7_messages, shutdown_mllp, short_messages):
+def run_mllp_server(host, port, filename, shutdown_mllp, tracker, short_messages, load=None, window=1):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
         s.settimeout(SHUTDOWN_POLL_INTERVAL_SECONDS)
-        s.listen(1)
+        s.listen(16)
         print(f"mllp: listening on {host}:{port}")
-        while not shutdown_mllp.is_set():
+        for connection in itertools.count():
+            if shutdown_mllp.is_set():
+                break
             try:
                 client, (host, port) = s.accept()
             except TimeoutError:
@@ -84,48 +293,197 @@ def run_mllp_server(host, port, hl7_messages, shutdown_mllp, short_messages):
             source = f"{host}:{port}"
             print(f"mllp: {source}: accepted connection")
             client.settimeout(MLLP_TIMEOUT_SECONDS)
-            t = threading.Thread(target=serve_mllp_client, args=(client, source, hl7_messages, shutdown_mllp, short_messages), daemon=True)
+            if load is None and window > 1:
+                t = threading.Thread(target=serve_window_client, args=(client, source, stream_hl7_messages(filename), shutdown_mllp, tracker, window), daemon=True)
+            elif load is None:
+                # every connection replays the capture from the start
+                t = threading.Thread(target=serve_mllp_client, args=(client, source, stream_hl7_messages(filename), shutdown_mllp, tracker, short_messages), daemon=True)
+            else:
+                # every connection gets its own stream of patients
+                messages = generate_hl7_messages(load.patients, seed=load.seed + connection, start=load.start, interval=load.interval,
+                                                 result_mean=load.result_mean, result_sigma=load.result_sigma,
+                                                 aki_fraction=load.aki_fraction, mrn_start=GENERATE_MRN_START + connection * load.patients)
+                if load.count:
+                    messages = itertools.islice(messages, load.count)
+                t = threading.Thread(target=serve_load_client, args=(client, source, messages, shutdown_mllp, tracker, load.rate, load.duration), daemon=True)
             t.start()
         print("mllp: graceful shutdown")
 
 MLLP_START_OF_BLOCK = 0x0b
 MLLP_END_OF_BLOCK = 0x1c
 MLLP_CARRIAGE_RETURN = 0x0d
+# what the codec searches for, mmap.find() only takes bytes
+MLLP_END_BYTE = bytes([MLLP_END_OF_BLOCK])
+
+# bytes of a memory-mapped capture replayed before its pages are released again
+STREAM_RELEASE_BYTES = 1 << 24
+
+def next_mllp_frame(buffer, start, source):
+    # the frame starting at `start` and the position after it, None if it is not complete yet
+    if buffer[start] != MLLP_START_OF_BLOCK:
+        raise Exception(f"{source}: bad MLLP encoding: want {hex(MLLP_START_OF_BLOCK)}, found {hex(buffer[start])}")
+    end = buffer.find(MLLP_END_BYTE, start + 1)
+    if end == -1 or end + 1 == len(buffer):
+        return None
+    if buffer[end + 1] != MLLP_CARRIAGE_RETURN:
+        raise Exception(f"{source}: bad MLLP encoding: want {hex(MLLP_CARRIAGE_RETURN)}, found {hex(buffer[end + 1])}")
+    return buffer[start + 1:end], end + 2
 
 def parse_mllp_messages(buffer, source):
-    i = 0
     messages = []
     consumed = 0
-    expect = MLLP_START_OF_BLOCK
-    while i < len(buffer):
-        if expect is not None:
-            if buffer[i] != expect:
-                raise Exception(f"{source}: bad MLLP encoding: want {hex(expect)}, found {hex(buffer[i])}")
-            if expect == MLLP_START_OF_BLOCK:
-                expect = None
-                consumed = i
-            elif expect == MLLP_CARRIAGE_RETURN:
-                messages.append(buffer[consumed+1:i-1])
-                expect = MLLP_START_OF_BLOCK
-                consumed = i + 1
-        else:
-            if buffer[i] == MLLP_END_OF_BLOCK:
-                expect = MLLP_CARRIAGE_RETURN
-        i += 1
+    while consumed < len(buffer):
+        frame = next_mllp_frame(buffer, consumed, source)
+        if frame is None:
+            break
+        message, consumed = frame
+        messages.append(message)
     return messages, buffer[consumed:]
 
-def read_hl7_messages(filename):
+def stream_hl7_messages(filename):
+    # frames of a capture, read lazily from a memory-mapped file: replay starts at once and
+    # pages already replayed are released, so memory stays constant for any file size
     with open(filename, "rb") as r:
-        messages, remaining = parse_mllp_messages(r.read(), filename)
-        if len(remaining) > 0:
-                print(f"messages: {len(messages)} remaining: {len(remaining)}")
-                raise Exception(f"{filename}: Unexpected data at end of file")
-        return messages
+        if os.fstat(r.fileno()).st_size == 0:
+            return
+        with mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            consumed = 0
+            released = 0
+            while consumed < len(data):
+                frame = next_mllp_frame(data, consumed, filename)
+                if frame is None:
+                    raise Exception(f"{filename}: Unexpected data at end of file")
+                message, consumed = frame
+                yield message
+                if consumed - released >= STREAM_RELEASE_BYTES:
+                    release = (consumed - released) // mmap.PAGESIZE * mmap.PAGESIZE
+                    data.madvise(mmap.MADV_DONTNEED, released, release)
+                    released += release
+
+def read_hl7_messages(filename):
+    return list(stream_hl7_messages(filename))
+
+def hl7_time(value):
+    return datetime.datetime.strptime(value[:14].ljust(14, "0"), "%Y%m%d%H%M%S")
+
+def result_key(message):
+    # (mrn, result time) of an ORU^R01, None for any other message
+    if b"ORU^R01" not in message:
+        return None
+    mrn = None
+    result_time = None
+    for segment in message.split(b"\r"):
+        fields = segment.split(b"|")
+        try:
+            if fields[0] == b"PID":
+                mrn = str(int(fields[3]))
+            elif fields[0] == b"OBR":
+                result_time = hl7_time(fields[7].decode())
+        except (IndexError, ValueError):
+            return None
+    if mrn is None or result_time is None:
+        return None
+    return mrn, result_time
+
+def read_expected_pages(filename):
+    # (mrn, date) rows after the header of aki.csv, or of a recorded_predictions.csv from an earlier run
+    with open(filename) as r:
+        rows = csv.reader(r)
+        next(rows, None)
+        return {(str(int(row[0])), datetime.datetime.fromisoformat(row[1])) for row in rows if row}
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+class PageLatencyTracker:
+    # end-to-end latency from sending an ORU^R01 to receiving its page, matched by MRN and
+    # result time; pages without a timestamp match the last result sent for the MRN
+
+    def __init__(self, sla=PAGE_SLA_SECONDS, expected=None, horizon=PAGE_MATCH_HORIZON_SECONDS):
+        self.sla = sla
+        self.expected = expected
+        self.horizon = horizon
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.sent_order = collections.deque()
+        self.last_result = {}
+        self.paged = set()
+        self.latencies = []
+        self.results = 0
+        self.late = 0
+        self.missing = 0
+        self.unmatched = 0
+        self.duplicates = 0
+
+    def record_send(self, message):
+        key = result_key(message)
+        if key is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.forget(now)
+            # a result resent after a NAK keeps its first send time, one replayed again is new
+            if key in self.sent and key not in self.paged:
+                return
+            self.paged.discard(key)
+            self.sent[key] = now
+            self.sent_order.append((now, key))
+            self.last_result[key[0]] = key
+            self.results += 1
+
+    def forget(self, now):
+        while self.sent_order and self.sent_order[0][0] < now - self.horizon:
+            sent, key = self.sent_order.popleft()
+            if self.sent.get(key) != sent:
+                continue
+            del self.sent[key]
+            if key in self.paged:
+                self.paged.discard(key)
+            elif self.expected is not None and key in self.expected:
+                self.missing += 1
+            if self.last_result.get(key[0]) == key:
+                del self.last_result[key[0]]
+
+    def record_page(self, mrn, timestamp):
+        now = time.monotonic()
+        with self.lock:
+            key = (str(mrn), timestamp) if timestamp else self.last_result.get(str(mrn))
+            if key not in self.sent:
+                self.unmatched += 1
+                return None
+            if key in self.paged:
+                self.duplicates += 1
+                return None
+            self.paged.add(key)
+            latency = now - self.sent[key]
+            self.latencies.append(latency)
+            if latency > self.sla:
+                self.late += 1
+            return latency
+
+    def report(self, final=False):
+        now = time.monotonic()
+        with self.lock:
+            self.forget(now)
+            ordered = sorted(self.latencies)
+            report = {"results_sent": self.results, "pages": len(ordered), "sla_seconds": self.sla, "late": self.late,
+                      "unmatched": self.unmatched, "duplicates": self.duplicates}
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+                report[f"{name}_seconds"] = percentile(ordered, q) if ordered else None
+            if self.expected is None:
+                report["missing"] = None
+            else:
+                # expected pages still outstanding count once their SLA has passed, or all of them at the end
+                outstanding = [key for key, sent in self.sent.items()
+                               if key in self.expected and key not in self.paged and (final or now - sent > self.sla)]
+                report["missing"] = self.missing + len(outstanding)
+            return report
 
 class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
 
-    def __init__(self, shutdown, *args, **kwargs):
+    def __init__(self, shutdown, tracker, *args, **kwargs):
         self.shutdown = shutdown
+        self.tracker = tracker
         super().__init__(*args, **kwargs)
 
     def do_POST(self):
@@ -142,7 +500,11 @@ class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
 
     def do_GET(self):
-        self.do_POST()
+        if self.path == "/latency":
+            self.server_version = f"coursework3-simulator/{VERSION}"
+            self.do_GET_latency()
+        else:
+            self.do_POST()
 
     def do_POST_page(self):
         length = 0
@@ -175,10 +537,12 @@ class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_response(http.HTTPStatus.BAD_REQUEST, error)
                 self.end_headers()
                 return
+        latency = self.tracker.record_page(mrn, timestamp)
+        latency = "unmatched" if latency is None else f"{latency * 1000:.0f}ms after its result"
         if timestamp:
-            print(f"pager: paging for MRN {mrn} at {timestamp}")
+            print(f"pager: paging for MRN {mrn} at {timestamp} ({latency})")
         else:
-            print(f"pager: paging for MRN {mrn}")
+            print(f"pager: paging for MRN {mrn} ({latency})")
         self.send_response(http.HTTPStatus.OK)
         self.send_header("Content-Type", "text/plain")
         self.end_headers()
@@ -190,6 +554,12 @@ class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"ok\n")
 
+    def do_GET_latency(self):
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(self.tracker.report(), indent=2).encode() + b"\n")
+
     def do_POST_shutdown(self):
         self.send_response(http.HTTPStatus.OK)
         self.send_header("Content-Type", "text/plain")
@@ -206,19 +576,37 @@ def main():
     parser.add_argument("--mllp", default=8440, type=int, help="Port on which to replay HL7 messages via MLLP")
     parser.add_argument("--pager", default=8441, type=int, help="Post on which to listen for pager requests via HTTP")
     parser.add_argument("--short_messages", default=False, action="store_true", help="Encourage all outgoing messages to be split in two")
+    parser.add_argument("--window", default=1, type=int, help="Messages replayed without waiting for their ACKs, matched by MSH-10 control ID; 1 is stop-and-wait")
+    parser.add_argument("--generate", default=False, action="store_true", help="Synthesize ADT^A01/A03 and ORU^R01 traffic instead of replaying --messages")
+    parser.add_argument("--patients", default=1000, type=int, help="Generated patients per connection")
+    parser.add_argument("--rate", default=100.0, type=float, help="Generated messages per second per connection, sent without waiting for ACKs; 0 sends as fast as possible")
+    parser.add_argument("--count", default=0, type=int, help="Generated messages per connection, 0 for no limit")
+    parser.add_argument("--duration", default=0.0, type=float, help="Seconds to generate messages for per connection, 0 for no limit")
+    parser.add_argument("--interval", default=60.0, type=float, help="Mean simulated seconds between generated messages")
+    parser.add_argument("--start", default=GENERATE_START, help="Simulated time of the first generated message, YYYYmmddHHMMSS")
+    parser.add_argument("--result_mean", default=90.0, type=float, help="Median baseline creatinine of generated patients")
+    parser.add_argument("--result_sigma", default=0.25, type=float, help="Log-normal spread of the generated baselines")
+    parser.add_argument("--aki_fraction", default=0.1, type=float, help="Fraction of admissions whose results rise like AKI")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the generator of the first connection")
+    parser.add_argument("--sla", default=PAGE_SLA_SECONDS, type=float, help="Seconds from sending a result to its page before the page counts as late")
+    parser.add_argument("--expected", default=None, help="CSV of expected pages (mrn,date like aki.csv or recorded_predictions.csv), to count missing pages")
     flags = parser.parse_args()
-    hl7_messages = read_hl7_messages(flags.messages)
+    if not flags.generate and not os.path.isfile(flags.messages):
+        parser.error(f"no such file: {flags.messages}")
+    tracker = PageLatencyTracker(flags.sla, read_expected_pages(flags.expected) if flags.expected else None)
     shutdown_event = threading.Event()
-    mllp_thread = threading.Thread(target=run_mllp_server, args=("0.0.0.0", flags.mllp, hl7_messages, shutdown_event, flags.short_messages), daemon=True)
+    mllp_thread = threading.Thread(target=run_mllp_server, args=("0.0.0.0", flags.mllp, flags.messages, shutdown_event, tracker, flags.short_messages,
+                                                                  flags if flags.generate else None, flags.window), daemon=True)
     mllp_thread.start()
     pager = None
     def shutdown():
         shutdown_event.set()
+        print(f"pager: page latency: {json.dumps(tracker.report(final=True))}")
         print("pager: graceful shutdown")
         pager.shutdown()
     signal.signal(signal.SIGTERM, lambda signal, frame: shutdown())
     def new_pager_handler(*args, **kwargs):
-        return PagerRequestHandler(shutdown, *args, **kwargs)
+        return PagerRequestHandler(shutdown, tracker, *args, **kwargs)
     pager = http.server.ThreadingHTTPServer(("0.0.0.0", flags.pager), new_pager_handler)
     print(f"pager: listening on 0.0.0.0:{flags.pager}")
     pager_thread = threading.Thread(target=pager.serve_forever, args=(), kwargs={"poll_interval": SHUTDOWN_POLL_INTERVAL_SECONDS}, daemon=True)
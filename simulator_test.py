@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import http
+import itertools
+import json
 import os
 import shutil
 import socket
@@ -135,6 +137,47 @@ class SimulatorTest(unittest.TestCase):
         else:
             self.fail("Expected /page to return an error with a bad MRN")
 
+    def test_window_of_messages_in_flight(self):
+        self.simulator.terminate()
+        self.simulator.wait()
+        self.simulator = subprocess.Popen(["./simulator.py", f"--mllp={TEST_MLLP_PORT}", f"--pager={TEST_PAGER_PORT}",
+                                           f"--messages={os.path.join(self.directory, 'messages.mllp')}", "--window=2"])
+        self.assertTrue(wait_until_healthy(self.simulator, f"localhost:{TEST_PAGER_PORT}"))
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect(("localhost", TEST_MLLP_PORT))
+            buffer = b""
+            messages = []
+            while len(messages) < 2:
+                buffer += s.recv(1024)
+                messages, _ = simulator.parse_mllp_messages(buffer, "test")
+            control_ids = [m.split(b"\r")[0].split(b"|")[9] for m in messages]
+            self.assertEqual(control_ids, [b"1", b"2"])
+            # ACKs are matched by control ID, so they may arrive in any order
+            for control_id in reversed(control_ids):
+                s.sendall(to_mllp(ACK[:1] + [f"MSA|AA|{control_id.decode()}"]))
+            last = b""
+            while not last.endswith(bytes([simulator.MLLP_END_OF_BLOCK, simulator.MLLP_CARRIAGE_RETURN])):
+                last += s.recv(1024)
+            self.assertEqual(from_mllp(last)[1:], ADT_A03[1:])
+            s.sendall(to_mllp(ACK[:1] + ["MSA|AA|3"]))
+            self.assertEqual(s.recv(1024), b"")
+
+    def test_page_latency(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect(("localhost", TEST_MLLP_PORT))
+            while True:
+                buffer = s.recv(1024)
+                if len(buffer) == 0:
+                    break
+                if from_mllp(buffer) == ORU_R01:
+                    urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/page", data=b"478237423,20240120224300")
+                s.sendall(to_mllp(ACK))
+        urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/page", data=b"1234")
+        report = json.load(urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/latency"))
+        self.assertEqual((report["results_sent"], report["pages"], report["unmatched"], report["late"]), (1, 1, 1, 0))
+        self.assertLess(report["max_seconds"], 1.0)
+        self.assertIsNone(report["missing"])
+
     def tearDown(self):
         try:
             r = urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/shutdown")
@@ -146,5 +189,152 @@ class SimulatorTest(unittest.TestCase):
                 self.simulator.kill()
             shutil.rmtree(self.directory)
 
+def fields(message):
+    segments = {s.split(b"|")[0]: s.split(b"|") for s in message.split(b"\r") if s}
+    return segments[b"MSH"][8].decode(), segments[b"PID"][3].decode(), segments
+
+class LoadGeneratorTest(unittest.TestCase):
+
+    def test_generated_traffic_is_consistent(self):
+        messages = list(itertools.islice(simulator.generate_hl7_messages(50, seed=1), 3000))
+        self.assertEqual(messages, list(itertools.islice(simulator.generate_hl7_messages(50, seed=1), 3000)))
+        admitted = set()
+        times = []
+        for message in messages:
+            message_type, mrn, segments = fields(message)
+            times.append(segments[b"MSH"][6])
+            if message_type == "ADT^A01":
+                self.assertNotIn(mrn, admitted)
+                admitted.add(mrn)
+            elif message_type == "ADT^A03":
+                admitted.remove(mrn)
+            else:
+                self.assertEqual(message_type, "ORU^R01")
+                self.assertIn(mrn, admitted)
+                self.assertEqual(segments[b"OBR"][7], segments[b"MSH"][6])
+                float(segments[b"OBX"][5])
+        self.assertEqual(times, sorted(times))
+        self.assertLessEqual(len({fields(m)[1] for m in messages}), 50)
+
+    def test_aki_fraction(self):
+        for aki_fraction in (0.0, 1.0):
+            results = {}
+            for message in itertools.islice(simulator.generate_hl7_messages(20, aki_fraction=aki_fraction), 2000):
+                message_type, mrn, segments = fields(message)
+                if message_type == "ADT^A01":
+                    results[mrn] = []
+                elif message_type == "ORU^R01":
+                    results[mrn].append(float(segments[b"OBX"][5]))
+            rises = [max(r) / r[0] for r in results.values() if len(r) > 3]
+            if aki_fraction:
+                self.assertTrue(all(rise >= 1.5 for rise in rises))
+            else:
+                self.assertTrue(all(rise < 1.5 for rise in rises))
+
+    def test_open_loop_load(self):
+        simulator_process = subprocess.Popen([
+            "./simulator.py",
+            f"--mllp={TEST_MLLP_PORT}",
+            f"--pager={TEST_PAGER_PORT}",
+            "--generate",
+            "--count=300",
+            "--rate=0",
+        ])
+        try:
+            self.assertTrue(wait_until_healthy(simulator_process, f"localhost:{TEST_PAGER_PORT}"))
+            runs = []
+            for _ in range(2):
+                messages = []
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.connect(("localhost", TEST_MLLP_PORT))
+                    buffer = b""
+                    while True:
+                        r = s.recv(65536)
+                        if len(r) == 0:
+                            break
+                        received, buffer = simulator.parse_mllp_messages(buffer + r, "test")
+                        messages += received
+                        s.sendall(to_mllp(ACK) * len(received))
+                runs.append(messages)
+            self.assertEqual(len(runs[0]), 300)
+            # the second connection gets its own patients
+            self.assertFalse({fields(m)[1] for m in runs[0]} & {fields(m)[1] for m in runs[1]})
+            urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/shutdown")
+            simulator_process.wait()
+        finally:
+            if simulator_process.poll() is None:
+                simulator_process.kill()
+
 if __name__ == "__main__":
     unittest.main()
+
+class FrameCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.messages = list(itertools.islice(simulator.generate_hl7_messages(20, seed=2), 500))
+        self.capture = b"".join(simulator.to_mllp_frame(m) for m in self.messages)
+
+    def write(self, data):
+        filename = os.path.join(self.directory, "messages.mllp")
+        with open(filename, "wb") as w:
+            w.write(data)
+        return filename
+
+    def test_split_buffers(self):
+        frames = b"".join(simulator.to_mllp_frame(m) for m in self.messages[:3])
+        for split in range(len(frames) + 1):
+            first, remaining = simulator.parse_mllp_messages(frames[:split], "test")
+            second, remaining = simulator.parse_mllp_messages(remaining + frames[split:], "test")
+            self.assertEqual(first + second, self.messages[:3])
+            self.assertEqual(remaining, b"")
+
+    def test_bad_encoding(self):
+        with self.assertRaisesRegex(Exception, "want 0xb"):
+            simulator.parse_mllp_messages(b"x" + self.capture, "test")
+        with self.assertRaisesRegex(Exception, "want 0xd"):
+            simulator.parse_mllp_messages(to_mllp(ACK)[:-1] + b"\n", "test")
+
+    def test_stream_releases_pages(self):
+        original = simulator.STREAM_RELEASE_BYTES
+        simulator.STREAM_RELEASE_BYTES = 3 * 4096
+        try:
+            self.assertEqual(list(simulator.stream_hl7_messages(self.write(self.capture))), self.messages)
+        finally:
+            simulator.STREAM_RELEASE_BYTES = original
+        self.assertEqual(simulator.read_hl7_messages(self.write(self.capture)), self.messages)
+
+    def test_stream_truncated_file(self):
+        self.assertEqual(list(simulator.stream_hl7_messages(self.write(b""))), [])
+        stream = simulator.stream_hl7_messages(self.write(self.capture[:-1]))
+        with self.assertRaisesRegex(Exception, "Unexpected data at end of file"):
+            for _ in stream:
+                pass
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class PageLatencyTrackerTest(unittest.TestCase):
+
+    def test_late_missing_and_duplicate_pages(self):
+        messages = [b"\r".join(s.encode() for s in ORU_R01), b"\r".join(s.encode() for s in ADT_A01)]
+        messages.append(messages[0].replace(b"478237423", b"100").replace(b"202401202243", b"202401210100"))
+        expected = {("478237423", simulator.hl7_time("202401202243")), ("100", simulator.hl7_time("202401210100"))}
+        tracker = simulator.PageLatencyTracker(sla=0.05, expected=expected)
+        for message in messages:
+            tracker.record_send(message)
+        time.sleep(0.1)
+        self.assertGreater(tracker.record_page(478237423, None), 0.05)
+        self.assertIsNone(tracker.record_page(478237423, simulator.hl7_time("202401202243")))
+        self.assertIsNone(tracker.record_page(478237423, simulator.hl7_time("202401202244")))
+        report = tracker.report()
+        self.assertEqual((report["results_sent"], report["pages"], report["late"], report["duplicates"], report["unmatched"], report["missing"]),
+                         (2, 1, 1, 1, 1, 1))
+
+    def test_forgotten_results(self):
+        tracker = simulator.PageLatencyTracker(expected=set(), horizon=0)
+        tracker.record_send(b"\r".join(s.encode() for s in ORU_R01))
+        time.sleep(0.01)
+        self.assertEqual(tracker.report()["missing"], 0)
+        self.assertIsNone(tracker.record_page(478237423, None))
+        self.assertEqual(tracker.report()["unmatched"], 1)
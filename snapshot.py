@@ -0,0 +1,164 @@
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from patient_store import PatientStore, columns_from_capture
+
+SNAPSHOT_PREFIX = 'snapshot-'
+DEFAULT_SNAPSHOT_INTERVAL = 300
+
+
+def snapshot_path(directory, segment):
+    return os.path.join(directory, f'{SNAPSHOT_PREFIX}{segment:08d}')
+
+
+def list_snapshots(directory):
+    '''
+    Description:
+        Complete snapshots in the directory, oldest first. Snapshot N contains every
+        journal record of the segments before N.
+    output:
+        snapshots: list of (segment, path)
+    '''
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name[len(SNAPSHOT_PREFIX):].isdigit():
+            snapshots.append((int(name[len(SNAPSHOT_PREFIX):]), os.path.join(directory, name)))
+    return sorted(snapshots)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_columns(path, columns):
+    '''
+    Description:
+        Write each column as a .npy file in a new directory, published atomically by renaming
+        it into place once every file is on disk
+    input:
+        path: STRING, directory to create
+        columns: DIC of numpy arrays
+    '''
+    temporary = path + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, column in columns.items():
+        file_path = os.path.join(temporary, name + '.npy')
+        np.save(file_path, column)
+        fsync_path(file_path)
+    if os.path.exists(path):
+        # replacing an existing layout, e.g. recompiling the history
+        os.rename(path, path + '.old')
+        os.rename(temporary, path)
+        shutil.rmtree(path + '.old')
+    else:
+        os.rename(temporary, path)
+    fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def load_columns(path, mmap=True):
+    '''
+    Description:
+        Load the columns written by write_columns, memory-mapped read-only by default
+    output:
+        columns: DIC of numpy arrays
+    '''
+    mode = 'r' if mmap else None
+    return {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode=mode)
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def load_latest_snapshot(directory, base=None):
+    '''
+    Description:
+        Restore the patient store from the newest snapshot
+    input:
+        directory: STRING
+        base: HistoryBase or None, the compiled or lazily read history the snapshot overlays
+    output:
+        store: PatientStore, None if there is no snapshot
+        segment: INT, first journal segment that still has to be replayed
+    '''
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        return None, 0
+    segment, path = snapshots[-1]
+    print(f'load data from snapshot {path}')
+    columns = load_columns(path)
+    if base is None and 'layered' in columns and columns['layered'][0]:
+        raise ValueError(f'{path} only holds the overlay on top of a compiled history, start with --compiled_history or --lazy_history')
+    return PatientStore.from_columns(columns, base=base), segment
+
+
+class Snapshotter:
+    '''
+    Description:
+        Periodically snapshots the patient store and truncates the journal behind it.
+        maybe_snapshot() must be called from the thread that processes messages, between
+        two messages: it only rotates the journal and captures the store, the packing and
+        writing happen on a background thread while processing carries on.
+    '''
+
+    def __init__(self, directory, store, journal, interval=DEFAULT_SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.store = store
+        self.journal = journal
+        self.interval = interval
+        self._due = time.monotonic() + interval
+        self._last_sequence = journal.barrier()
+        self._writer = None
+
+    def maybe_snapshot(self):
+        '''start a snapshot if the interval has passed and the store changed since the last one'''
+        now = time.monotonic()
+        if now < self._due or (self._writer is not None and self._writer.is_alive()):
+            return None
+        self._due = now + self.interval
+        if self.journal.barrier() == self._last_sequence:
+            return None
+        return self.snapshot()
+
+    def snapshot(self):
+        '''
+        Description:
+            Capture the store at the current journal position and write it in the background
+        output:
+            writer: threading.Thread
+        '''
+        start = time.perf_counter()
+        segment, sequence = self.journal.rotate()
+        capture = self.store.capture()
+        metrics.SNAPSHOT_CAPTURE_PAUSE.set(time.perf_counter() - start)
+        self._last_sequence = sequence
+        self._writer = threading.Thread(target=self._write, args=(capture, segment, sequence), name='snapshot-writer', daemon=True)
+        self._writer.start()
+        return self._writer
+
+    def _write(self, capture, segment, sequence):
+        start = time.perf_counter()
+        try:
+            columns = columns_from_capture(capture)
+            # never publish state that was not acknowledged: the captured records must be durable first
+            self.journal.wait_durable(sequence)
+            write_columns(snapshot_path(self.directory, segment), columns)
+            for older, path in list_snapshots(self.directory):
+                if older < segment:
+                    shutil.rmtree(path)
+            self.journal.remove_segments(segment)
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+            metrics.SNAPSHOT_FAILED.inc()
+            return
+        metrics.SNAPSHOT_DURATION.set(time.perf_counter() - start)
+        print(f"snapshot {segment}: {len(capture['mrns'])} patients in {time.perf_counter() - start:.2f}s")
@@ -1,8 +1,42 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+from datetime import datetime
+import app
+import cluster
+import ingestion
+import metrics
+import sharding
+import numpy as np
+import pandas as pd
+from data_processor import load_and_process_history, load_history_arrays, get_patient_history, update_patient_data
+from patient_store import PatientStore, HistoryBase, hl7_to_epoch, columns_from_capture, columns_from_history, sort_columns
+from aki_detector import load_model, load_engine, aggregate_data, build_test_data, predict_aki, predict_features, InferenceEngine, DEFAULT_THRESHOLD
+from rolling_quantiles import RollingQuantiles, DEFAULT_WINDOW
+from journal import Journal, replay as replay_journal, list_segments, decode, encode_patient
+from snapshot import Snapshotter, load_latest_snapshot, list_snapshots, load_columns
+from history_compiler import compile_history, ensure_compiled, open_history_base
+from backfill import read_capture, parse_capture, feature_matrix, backfill
+from f3_evaluation import check_aki_detection_accuracy
+from history_index import open_lazy_history, RSS_CHECK_INTERVAL
 from hl7_processor import parse_hl7_message, extract_mrn
-from listener import receive_message, close_connection, ack_message, start_listener
-from pager_system import send_pager_message
+from benchmark import parse_hl7_message_regex
+from listener import receive_message, close_connection, ack_message, start_listener, MLLPFramer, control_id
+from pager_system import send_pager_message, PagerDispatcher, read_pending_pages
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client import REGISTRY
 
 """
     To run the unit tests, simply run the following command in the CLI:
@@ -38,6 +72,972 @@ class ListenerConnectionTesting(unittest.TestCase):
         self.assertIsNone(message)
         print('None and Exception assertion passed')
 
+class MLLPFramerTesting(unittest.TestCase):
+    def setUp(self):
+        self.message = b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201800||ORU^R01|||2.5\rPID|1||478237423\r"
+        self.frame = b'\x0b' + self.message + b'\x1c\x0d'
+        self.server, self.client = socket.socketpair()
+
+    def read_all(self, framer):
+        self.server.close()
+        frames = []
+        while framer.read_from(self.client):
+            frames.extend(framer)
+        return frames
+
+    # Checks that a frame split across several reads is reassembled
+    def test_split_frame(self):
+        framer = MLLPFramer()
+        self.server.sendall(self.frame[:10])
+        framer.read_from(self.client)
+        self.assertIsNone(framer.next_frame())
+        self.server.sendall(self.frame[10:-1])
+        framer.read_from(self.client)
+        self.assertIsNone(framer.next_frame())
+        self.server.sendall(self.frame[-1:])
+        self.assertEqual(self.read_all(framer), [self.message])
+
+    # Checks that several frames received in one read are all returned in order
+    def test_coalesced_frames(self):
+        framer = MLLPFramer()
+        self.server.sendall(self.frame * 5)
+        self.assertEqual(self.read_all(framer), [self.message] * 5)
+        self.assertEqual(framer.pending(), 0)
+
+    # Checks that frames larger than the receive buffer grow it instead of being truncated
+    def test_oversized_frame(self):
+        framer = MLLPFramer(buffer_size=64)
+        message = self.message + b'NTE|1||' + b'x' * 100000 + b'\r'
+        frame = b'\x0b' + message + b'\x1c\x0d'
+        for i in range(0, len(frame), 1024):
+            framer.feed(frame[i:i + 1024])
+        self.assertEqual(list(framer), [message])
+
+    # Checks that bytes outside of a frame are skipped
+    def test_resynchronise_on_garbage(self):
+        framer = MLLPFramer()
+        framer.feed(b'garbage' + self.frame + b'\r\n' + self.frame)
+        self.assertEqual(list(framer), [self.message, self.message])
+        self.assertEqual(framer.discarded_bytes, len(b'garbage\r\n'))
+
+    # Checks that the serial receive path records the framing of every message in the 'frame' stage
+    def test_receive_message_timed(self):
+        import listener
+        listener.s, listener.framer = self.client, MLLPFramer()
+        self.server.sendall(self.frame * 2)
+        samples = metrics.collect_stage_samples()
+        try:
+            self.assertEqual([receive_message(), receive_message()], [self.message] * 2)
+        finally:
+            metrics.collect_stage_samples(False)
+        self.assertEqual(len(samples['frame']), 2)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+class AsyncIngestionTesting(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.client.setblocking(False)
+
+    # Checks that every message is processed and acknowledged in order, and its page is sent in order
+    def test_messages_acknowledged_in_order(self):
+        processed = []
+        pages = []
+        def handle_message(message):
+            processed.append(message)
+            return True, (message.decode(), None) if message.endswith(b'7') else None
+        def send_page(mrn, prediction_date):
+            pages.append(mrn)
+
+        messages = [f'MSH|{i}'.encode() for i in range(20)]
+        self.server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+        self.server.shutdown(socket.SHUT_WR)
+        engine = threading.Thread(target=ingestion.run, args=(self.client, handle_message, send_page, 4))
+        engine.start()
+        acks = b''
+        while True:
+            data = self.server.recv(4096)
+            if not data:
+                break
+            acks += data
+        engine.join()
+
+        self.assertEqual(processed, messages)
+        self.assertEqual(acks.count(b'MSA|AA'), len(messages))
+        self.assertEqual(pages, ['MSH|7', 'MSH|17'])
+
+    # Checks that queued messages are handed over in bounded batches, in order, with one ACK per message
+    def test_micro_batches(self):
+        batches = []
+        def handle_batch(messages):
+            batches.append(messages)
+            return [(True, (message.decode(), None) if message.endswith(b'7') else None) for message in messages]
+        pages = []
+        messages = [f'MSH|{i}'.encode() for i in range(20)]
+        self.server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+        self.server.shutdown(socket.SHUT_WR)
+        ingestion.run(self.client, None, lambda mrn, date: pages.append(mrn), handle_batch=handle_batch, batch_size=8, batch_wait=0.05)
+        self.assertEqual(sum(batches, []), messages)
+        self.assertTrue(all(len(batch) <= 8 for batch in batches))
+        self.assertLess(len(batches), len(messages))
+        self.assertEqual(pages, ['MSH|7', 'MSH|17'])
+        self.assertEqual(self.server.recv(4096).count(b'MSA|AA'), len(messages))
+
+    # Checks that each ACK echoes the MSH-10 control ID of its message, so a sender can keep several in flight
+    def test_acks_echo_control_ids(self):
+        messages = [f'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201800||ORU^R01|{i}||2.5\rPID|1||{i}'.encode() for i in range(10)]
+        messages.append(b'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||202401201800||ORU^R01|||2.5')
+        self.server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+        self.server.shutdown(socket.SHUT_WR)
+        ingestion.run(self.client, lambda message: (True, None), lambda *page: None)
+        acks = [segment for segment in self.server.recv(4096).split(b'\r') if segment.startswith(b'MSA')]
+        self.assertEqual(acks, [f'MSA|AA|{i}'.encode() for i in range(10)] + [b'MSA|AA'])
+        self.assertEqual(control_id(b'PID|1||5'), b'')
+
+    # Checks that messages received while the detector loads are buffered, then processed in order once it is ready
+    def test_buffered_while_loading(self):
+        loaded = threading.Event()
+        processed = []
+        def handle_message(message):
+            processed.append(message)
+            return True, None
+        def load():
+            # nothing is journaled, so there is no durability to return
+            loaded.wait()
+        engine = threading.Thread(target=ingestion.run, args=(self.client, handle_message, lambda *page: None), kwargs={'ready': load})
+        engine.start()
+        messages = [f'MSH|{i}'.encode() for i in range(5)]
+        self.server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+        time.sleep(0.2)
+        self.assertEqual(processed, [])
+        loaded.set()
+        self.server.shutdown(socket.SHUT_WR)
+        acks = b''
+        while True:
+            data = self.server.recv(4096)
+            if not data:
+                break
+            acks += data
+        engine.join()
+        self.assertEqual(processed, messages)
+        self.assertEqual(acks.count(b'MSA|AA'), len(messages))
+        self.assertEqual(REGISTRY.get_sample_value('startup_buffered_messages'), len(messages))
+
+    # Checks that a message's page is in pages.log before its ACK is written, so the page of an acknowledged message survives a crash
+    def test_page_recorded_before_ack(self):
+        directory = tempfile.mkdtemp()
+        unused = socket.socket()
+        unused.bind(('localhost', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        # the pager is down, so every page stays pending in pages.log
+        dispatcher = PagerDispatcher(f'localhost:{port}', directory, backoff=60, fsync=False)
+        def send_page(mrn, prediction_date):
+            # a slow pages.log write must hold the ACK back, not race it
+            time.sleep(0.05)
+            dispatcher.submit(mrn, prediction_date)
+        def handle_message(message):
+            return True, (message.decode().split('|')[1], '2024-04-29 05:41:00') if message.endswith(b'7') else None
+
+        messages = [f'MSH|{i}'.encode() for i in range(20)]
+        self.server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+        self.server.shutdown(socket.SHUT_WR)
+        engine = threading.Thread(target=ingestion.run, args=(self.client, handle_message, send_page), kwargs={'batch_size': 4})
+        engine.start()
+        try:
+            acks = b''
+            while True:
+                data = self.server.recv(4096)
+                if not data:
+                    break
+                acks += data
+                recorded = [body.split(',')[0] for _, body in read_pending_pages(os.path.join(directory, 'pages.log'))]
+                acknowledged = [str(i) for i in range(acks.count(b'MSA|AA')) if i % 10 == 7]
+                self.assertEqual(recorded[:len(acknowledged)], acknowledged)
+            self.assertEqual(acks.count(b'MSA|AA'), len(messages))
+        finally:
+            engine.join()
+            dispatcher.close(timeout=0)
+            shutil.rmtree(directory)
+
+    # Checks that unparsable messages are not acknowledged
+    def test_failed_messages_not_acknowledged(self):
+        self.server.sendall(b'\x0bbad\x1c\x0d\x0bgood\x1c\x0d')
+        self.server.shutdown(socket.SHUT_WR)
+        ingestion.run(self.client, lambda message: (message == b'good', None), lambda *page: None)
+        self.assertEqual(self.server.recv(4096).count(b'MSA|AA'), 1)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+class PatientStoreTesting(unittest.TestCase):
+    def setUp(self):
+        self.historical_data = load_and_process_history('history.csv')
+        self.store = PatientStore.from_dataframe(self.historical_data)
+
+    # Checks that every patient of history.csv is indexed with the same number of results
+    def test_load_from_history(self):
+        self.assertEqual(len(self.store), len(self.historical_data))
+        for row in range(0, len(self.historical_data), 97):
+            mrn = self.historical_data['mrn'].iloc[row]
+            expected = self.historical_data.iloc[row, 4::2].dropna().astype(float).to_numpy()
+            _, results = self.store.series(mrn)
+            np.testing.assert_allclose(results, expected, rtol=1e-6)
+
+    # Checks that appending beyond a slice's capacity relocates it without corrupting other patients
+    def test_append_and_compact(self):
+        mrns = self.store.mrns()[:3]
+        before = {mrn: self.store.series(mrn)[1].copy() for mrn in mrns}
+        for i in range(40):
+            self.store.append_result(mrns[0], hl7_to_epoch('20240201120000') + i, float(i))
+        self.store.append_result('12345678', hl7_to_epoch('20240201120000'), 99.5)
+        self.store.compact()
+        self.assertEqual(self.store.free_slots, 0)
+        np.testing.assert_array_equal(self.store.series(mrns[0])[1][len(before[mrns[0]]):], np.arange(40))
+        for mrn in mrns[1:]:
+            np.testing.assert_array_equal(self.store.series(mrn)[1], before[mrn])
+        self.assertEqual(self.store.series('12345678')[1].tolist(), [99.5])
+
+    # Checks that the adapter returns the same layout as get_patient_history
+    def test_history_frame_adapter(self):
+        mrn = self.historical_data['mrn'].iloc[0]
+        self.store.admit(mrn, '19840203', 'F')
+        frame = self.store.history_frame(mrn)
+        expected = get_patient_history(self.historical_data, mrn)
+        self.assertEqual(list(frame.columns), list(expected.columns))
+        self.assertEqual(frame['sex'].iloc[0], 'F')
+        self.assertEqual(pd.Timestamp(frame['creatinine_date_0'].iloc[0]), pd.Timestamp(expected['creatinine_date_0'].iloc[0]))
+
+    # Checks that a CSV dump of the store loads back to the same state
+    def test_dataframe_round_trip(self):
+        self.store.admit('12345678', '19840203', 'M')
+        self.store.append_result('12345678', hl7_to_epoch('20240201120000'), 99.5)
+        reloaded = PatientStore.from_dataframe(self.store.to_dataframe())
+        self.assertEqual(reloaded.mrns(), self.store.mrns())
+        for mrn in self.store.mrns()[::101] + ['12345678']:
+            for a, b in zip(reloaded.series(mrn), self.store.series(mrn)):
+                np.testing.assert_array_equal(a, b)
+        self.assertEqual(reloaded.sex[reloaded.row('12345678')], 0)
+
+    # Checks that a retained series stays bounded for a busy patient and the model input matches the unbounded store
+    def test_retention_bounds_busy_patient(self):
+        unbounded = PatientStore.from_dataframe(self.historical_data)
+        self.store.set_retention(max_results=50)
+        mrn = self.store.mrns()[0]
+        start = hl7_to_epoch('20240201120000')
+        for i in range(2000):
+            for store in (self.store, unbounded):
+                store.append_result(mrn, start + 3600 * i, float(i))
+            if i == 999:
+                arena_end = self.store.arena_end
+        timestamps, results = self.store.series(mrn)
+        self.assertEqual(len(results), 50)
+        np.testing.assert_array_equal(results, unbounded.series(mrn)[1][-50:])
+        np.testing.assert_array_equal(self.store.feature_row(mrn), unbounded.feature_row(mrn))
+        # the arenas are compacted instead of growing with every result
+        self.assertLessEqual(self.store.arena_end, 2 * arena_end)
+        self.assertLessEqual(self.store.free_slots, self.store.arena_end // 2)
+
+    # Checks that results older than the age limit are dropped, except the newest ones the model reads
+    def test_retention_by_age(self):
+        self.store.set_retention(max_age=10 * 86400)
+        start = hl7_to_epoch('20240201120000')
+        for day in range(30):
+            self.store.append_result('12345678', start + 86400 * day, float(day))
+        self.assertEqual(self.store.series('12345678')[1].tolist(), [float(day) for day in range(19, 30)])
+        self.store.append_result('12345678', start + 86400 * 100, 100.0)
+        self.assertEqual(self.store.series('12345678')[1].tolist(), [26.0, 27.0, 28.0, 29.0, 100.0])
+        with self.assertRaises(ValueError):
+            self.store.set_retention(max_results=4)
+
+    # Checks that a result beyond the last column pair replaces the oldest pair instead of widening the frame
+    def test_aggregate_data_does_not_widen(self):
+        mrn = self.historical_data['mrn'].iloc[0]
+        store = PatientStore()
+        for i in range(50):
+            store.append_result(mrn, hl7_to_epoch('20240201120000') + 60 * i, float(i))
+        frame = store.history_frame(mrn)
+        combined, _, _ = aggregate_data({'test_time': '20240301120000', 'test_result': '123.5'}, frame, RollingQuantiles())
+        self.assertEqual(list(combined.columns), list(frame.columns))
+        self.assertEqual(combined['creatinine_result_0'].iloc[0], 1.0)
+        self.assertEqual(combined['creatinine_result_49'].iloc[0], 123.5)
+        width = self.historical_data.shape[1]
+        update_patient_data(mrn, combined, self.historical_data, type='ORU')
+        self.assertEqual(self.historical_data.shape[1], width)
+
+class JournalTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write_events(self):
+        journal = Journal(self.directory)
+        journal.append_admit('478237423', '19840203', 'F')
+        for i in range(10):
+            journal.append_result('478237423', hl7_to_epoch('20240120224300') + i, 100.5 + i)
+        journal.wait_durable()
+        journal.close()
+
+    # Checks that replaying the journal rebuilds the same patient state
+    def test_replay(self):
+        self.write_events()
+        store = PatientStore()
+        self.assertEqual(replay_journal(self.directory, store), 11)
+        timestamps, results = store.series('478237423')
+        self.assertEqual(results.tolist(), [100.5 + i for i in range(10)])
+        self.assertEqual(timestamps[0], hl7_to_epoch('20240120224300'))
+        self.assertEqual(store.sex[store.row('478237423')], 1)
+
+    # Checks that a record torn by a crash is dropped and the journal stays appendable
+    def test_torn_record_truncated(self):
+        self.write_events()
+        path = list_segments(self.directory)[-1][1]
+        size = os.path.getsize(path)
+        with open(path, 'ab') as file:
+            file.write(b'\x20\x00\x00\x00partial')
+        self.assertEqual(replay_journal(self.directory, PatientStore()), 11)
+        self.assertEqual(os.path.getsize(path), size)
+        self.write_events()
+        self.assertEqual(replay_journal(self.directory, PatientStore()), 22)
+
+    # Checks that a group commit that os.write only writes in part is written in full before it is durable
+    def test_short_writes(self):
+        write = os.write
+        with unittest.mock.patch('os.write', lambda fd, data: write(fd, bytes(data[:7]))):
+            self.write_events()
+        self.assertEqual(replay_journal(self.directory, PatientStore()), 11)
+
+    # Checks that the directory is synced for every new segment, before records in it are durable
+    def test_new_segment_synced(self):
+        with unittest.mock.patch('journal.fsync_path') as fsync_path:
+            journal = Journal(self.directory)
+            self.assertEqual(fsync_path.call_count, 1)
+            journal.rotate()
+            journal.wait_durable(journal.append_result('478237423', 0, 1.0))
+            self.assertEqual(fsync_path.call_count, 2)
+            journal.close()
+            Journal(self.directory).close()
+            self.assertEqual(fsync_path.call_count, 2)
+        fsync_path.assert_called_with(self.directory)
+
+    # Checks that records appended by several threads are all durable after their group commits
+    def test_group_commit(self):
+        journal = Journal(self.directory, commit_interval=0.005)
+        def append():
+            for i in range(100):
+                journal.wait_durable(journal.append_result(str(i), i, float(i)))
+        threads = [threading.Thread(target=append) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(journal.is_durable(400))
+        journal.close()
+        self.assertEqual(replay_journal(self.directory, PatientStore()), 400)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class SnapshotTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+        self.journal = Journal(self.directory)
+
+    def apply_result(self, mrn, i):
+        self.journal.append_result(mrn, hl7_to_epoch('20240201120000') + i, float(i))
+        self.store.append_result(mrn, hl7_to_epoch('20240201120000') + i, float(i))
+
+    # Checks that restart loads the snapshot, replays only the journal tail and drops older segments
+    def test_snapshot_and_restore(self):
+        mrns = self.store.mrns()[:5]
+        for i, mrn in enumerate(mrns):
+            self.apply_result(mrn, i)
+        Snapshotter(self.directory, self.store, self.journal, interval=0).snapshot().join()
+        self.apply_result(mrns[0], 100)
+        self.apply_result('12345678', 101)
+        self.journal.close()
+
+        self.assertEqual(len(list_snapshots(self.directory)), 1)
+        self.assertEqual(len(list_segments(self.directory)), 1)
+        restored, first_segment = load_latest_snapshot(self.directory)
+        self.assertEqual(replay_journal(self.directory, restored, first_segment), 2)
+        self.assertEqual(restored.mrns(), self.store.mrns())
+        for mrn in mrns + ['12345678']:
+            np.testing.assert_array_equal(restored.series(mrn)[1], self.store.series(mrn)[1])
+
+    # Checks that appends after the capture do not leak into the snapshot being written
+    def test_snapshot_is_point_in_time(self):
+        mrn = self.store.mrns()[0]
+        self.apply_result(mrn, 1)
+        expected = self.store.series(mrn)[1].copy()
+        writer = Snapshotter(self.directory, self.store, self.journal, interval=0).snapshot()
+        for i in range(50):
+            self.apply_result(mrn, 2 + i)
+        self.store.compact()
+        writer.join()
+        restored, _ = load_latest_snapshot(self.directory)
+        np.testing.assert_array_equal(restored.series(mrn)[1], expected)
+
+    # Checks that no snapshot is taken when nothing changed
+    def test_skip_unchanged(self):
+        snapshotter = Snapshotter(self.directory, self.store, self.journal, interval=0)
+        self.assertIsNone(snapshotter.maybe_snapshot())
+        self.apply_result(self.store.mrns()[0], 1)
+        snapshotter.maybe_snapshot().join()
+        self.assertIsNone(snapshotter.maybe_snapshot())
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+class HistoryBaseTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compiled = os.path.join(self.directory, 'history.compiled')
+        compile_history('history.csv', self.compiled)
+        self.base = open_history_base(self.compiled)
+        self.reference = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+
+    # Checks that every patient of the compiled history matches the csv loader
+    def test_compiled_matches_history(self):
+        store = PatientStore(base=self.base)
+        self.assertEqual(len(store), len(self.reference))
+        self.assertEqual(sorted(store.mrns()), sorted(self.reference.mrns()))
+        for mrn in self.reference.mrns()[::53]:
+            for a, b in zip(store.series(mrn), self.reference.series(mrn)):
+                np.testing.assert_array_equal(a, b)
+        self.assertNotIn('12345678', store)
+
+    # Checks that processes compiling the same history at once compile it once and all map a complete layout
+    def test_concurrent_compile(self):
+        compiled = os.path.join(self.directory, 'shared.compiled')
+        outcomes = []
+        threads = [threading.Thread(target=lambda: outcomes.append(ensure_compiled('history.csv', compiled))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(outcomes), [False, False, False, True])
+        self.assertFalse(os.path.exists(compiled + '.tmp'))
+        base = open_history_base(compiled)
+        np.testing.assert_array_equal(base.mrn_keys, self.base.mrn_keys)
+        np.testing.assert_array_equal(base.results, self.base.results)
+
+    # Checks that a compiled history is recompiled once its csv changes, and not when only its modification time does
+    def test_recompile_changed_csv(self):
+        csv_path = os.path.join(self.directory, 'history.csv')
+        compiled = os.path.join(self.directory, 'copy.compiled')
+        shutil.copy('history.csv', csv_path)
+        self.assertTrue(ensure_compiled(csv_path, compiled))
+        self.assertFalse(ensure_compiled(csv_path, compiled))
+        os.utime(csv_path, ns=(0, 10 ** 18))
+        self.assertFalse(ensure_compiled(csv_path, compiled))
+        with open(csv_path, 'a') as file:
+            file.write('99999999,2024-01-01 10:00:00,77.5\n')
+        self.assertTrue(ensure_compiled(csv_path, compiled))
+        base = open_history_base(compiled)
+        self.assertEqual(len(base), len(self.base) + 1)
+        self.assertEqual(base.series(base.find('99999999'))[1].tolist(), [77.5])
+
+    # Checks that writes go to the overlay and leave the mapped base untouched
+    def test_overlay_copy_on_write(self):
+        store = PatientStore(base=self.base)
+        mrn = self.reference.mrns()[0]
+        store.admit(mrn, '19840203', 'M')
+        store.append_result(mrn, hl7_to_epoch('20240201120000'), 99.5)
+        store.append_result('12345678', hl7_to_epoch('20240201120000'), 42.0)
+        self.assertEqual(store.series(mrn)[1].tolist()[:-1], self.reference.series(mrn)[1].tolist())
+        self.assertEqual(store.series(mrn)[1][-1], 99.5)
+        self.assertEqual(len(store), len(self.reference) + 1)
+        self.assertEqual(self.base.series(self.base.find(mrn))[1].tolist(), self.reference.series(mrn)[1].tolist())
+        self.assertEqual(store.history_frame(mrn)['sex'].iloc[0], 'M')
+
+    # Checks that snapshots only hold the overlay and are restored on top of the base
+    def test_overlay_snapshot(self):
+        store = PatientStore(base=self.base)
+        mrn = self.reference.mrns()[0]
+        journal = Journal(self.directory)
+        store.append_result(mrn, hl7_to_epoch('20240201120000'), 99.5)
+        journal.append_result(mrn, hl7_to_epoch('20240201120000'), 99.5)
+        Snapshotter(self.directory, store, journal, interval=0).snapshot().join()
+        journal.close()
+        restored, _ = load_latest_snapshot(self.directory, base=self.base)
+        self.assertEqual(len(load_columns(list_snapshots(self.directory)[-1][1])['mrns']), 1)
+        self.assertEqual(len(restored.mrns()), len(store.mrns()))
+        self.assertEqual(restored.series(mrn)[1].tolist(), store.series(mrn)[1].tolist())
+        with self.assertRaises(ValueError):
+            load_latest_snapshot(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class HistoryIndexTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reference = PatientStore.from_columns(columns_from_history(load_history_arrays('history.csv')))
+
+    # Checks that patients read lazily through the MRN index match the eager loader, and writes go to the overlay
+    def test_lazy_matches_history(self):
+        store = PatientStore(base=open_lazy_history('history.csv'))
+        self.assertEqual(len(store), len(self.reference))
+        self.assertEqual(sorted(store.mrns()), sorted(self.reference.mrns()))
+        for mrn in self.reference.mrns()[::29]:
+            for a, b in zip(store.series(mrn), self.reference.series(mrn)):
+                np.testing.assert_array_equal(a, b)
+        self.assertNotIn('12345678', store)
+        mrn = self.reference.mrns()[0]
+        for patient in (store, self.reference):
+            patient.append_result(mrn, hl7_to_epoch('20240201120000'), 99.5)
+        np.testing.assert_array_equal(store.feature_row(mrn), self.reference.feature_row(mrn))
+        # exports of the whole store stream the rest of the csv past the working set
+        cached = len(store.base._cache)
+        with unittest.mock.patch('history_index.HISTORY_CHUNK_BYTES', 4096):
+            exported = PatientStore.from_columns(store.columns())
+        self.assertEqual(len(store.base._cache), cached)
+        self.assertEqual(sorted(exported.mrns()), sorted(self.reference.mrns()))
+        for mrn in self.reference.mrns()[::7]:
+            for a, b in zip(exported.series(mrn), self.reference.series(mrn)):
+                np.testing.assert_array_equal(a, b)
+
+    # Checks that blank lines, CRLF line ends, lines without results and a last line without a newline are indexed
+    def test_index_edge_cases(self):
+        path = os.path.join(self.directory, 'history.csv')
+        with open(path, 'wb') as file:
+            file.write(b'mrn,creatinine_date_0,creatinine_result_0,creatinine_date_1,creatinine_result_1\r\n'
+                       b'300,2024-01-01 10:00:00,80.5,,\r\n\r\n'
+                       b'100\n'
+                       b'200,2024-01-02 10:00:00,90.0,2024-01-03 10:00:00,95.25')
+        base = open_lazy_history(path)
+        self.assertEqual(base.mrns(), ['100', '200', '300'])
+        self.assertEqual(base.series(base.find('100'))[1].tolist(), [])
+        self.assertEqual(base.series(base.find('200'))[1].tolist(), [90.0, 95.25])
+        self.assertEqual(base.series(base.find('300'))[0].tolist(), [hl7_to_epoch('20240101100000')])
+        self.assertIsNone(base.find('400'))
+        base.close()
+
+    # Checks the LRU bound and that the working set is halved once the resident set size exceeds the budget
+    def test_working_set_eviction(self):
+        counter = lambda name: REGISTRY.get_sample_value(f'history_cache_{name}_total')
+        hits, misses, evictions = counter('hits'), counter('misses'), counter('evictions')
+        base = open_lazy_history('history.csv', cache_patients=10)
+        for position in list(range(20)) + list(range(15, 20)):
+            base.series(position)
+        self.assertEqual(counter('misses') - misses, 20)
+        self.assertEqual(counter('hits') - hits, 5)
+        self.assertEqual(counter('evictions') - evictions, 10)
+        self.assertEqual(list(base._cache), list(range(10, 20)))
+
+        base = open_lazy_history('history.csv', cache_patients=1000, memory_budget=1)
+        for position in range(RSS_CHECK_INTERVAL):
+            base.series(position)
+        self.assertEqual(len(base._cache), RSS_CHECK_INTERVAL // 2)
+        self.assertEqual(REGISTRY.get_sample_value('history_cache_patients'), RSS_CHECK_INTERVAL // 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class HistoryLoaderTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'history.csv')
+        with open(self.path, 'w') as file:
+            file.write('mrn,creatinine_date_0,creatinine_result_0\n')
+            file.write('100,2024-01-01 06:12:00,101.5,2024-01-02 07:00:00,99.0\n')
+            file.write('200,,,2024-01-03 08:30:00,120.25\n')
+            file.write('300\n')
+            file.write('\n')
+            file.write('400,2024-01-04T09:00:00,1.5e2,2024-01-05 10:00:00,abc\r\n')
+            file.write('500,2024-01-06 11:00:00,7')
+
+    # Checks that ragged rows are packed per patient in file order, skipping empty pairs
+    def test_ragged_rows(self):
+        history = load_history_arrays(self.path)
+        self.assertEqual(history['mrns'].tolist(), ['100', '200', '300', '400', '500'])
+        self.assertEqual(history['length'].tolist(), [2, 1, 0, 1, 1])
+        self.assertEqual(history['timestamps'].dtype, np.dtype('datetime64[s]'))
+        self.assertEqual(str(history['timestamps'][2]), '2024-01-03T08:30:00')
+        self.assertEqual(str(history['timestamps'][3]), '2024-01-04T09:00:00')
+        self.assertEqual(history['results'].tolist(), [101.5, 99.0, 120.25, 150.0, 7.0])
+        historical_data = load_and_process_history(self.path)
+        self.assertEqual(historical_data.shape, (5, 103))
+        self.assertEqual(historical_data['creatinine_result_0'].iloc[1], 120.25)
+        self.assertTrue(pd.isna(historical_data['creatinine_date_1'].iloc[1]))
+
+    # Checks that the chunk size does not change the parsed history
+    def test_chunked_matches_single_pass(self):
+        whole = load_history_arrays('history.csv', chunk_bytes=1 << 30)
+        chunked = load_history_arrays('history.csv', chunk_bytes=4096)
+        for name in whole:
+            np.testing.assert_array_equal(whole[name], chunked[name])
+        self.assertEqual(int(whole['length'].sum()), len(whole['results']))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class FeatureVectorTesting(unittest.TestCase):
+    def setUp(self):
+        self.model = load_model('aki_model.json')
+        self.store = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+        self.mrns = self.store.mrns()[::40] + ['12345678']
+        self.input_quantiles = RollingQuantiles()
+
+    def apply_result(self, store, mrn, test_time, test_result):
+        # the DataFrame path of predict_aki next to the incrementally maintained feature row
+        patient_history = store.history_frame(mrn)
+        new_data = {'mrn': mrn, 'test_time': test_time, 'test_result': str(test_result)}
+        combined_data, self.input_quantiles, _ = aggregate_data(new_data, patient_history, self.input_quantiles)
+        store.append_result(mrn, hl7_to_epoch(test_time), test_result)
+        return combined_data, store.feature_row(mrn)
+
+    # Checks that the feature rows hold exactly the model input built by predict_aki, with identical predictions
+    def test_features_match_predict_aki(self):
+        for i, mrn in enumerate(self.mrns):
+            if i % 3 == 0:
+                self.store.admit(mrn, '19700101', 'FM'[i % 2])
+            for day, result in enumerate((95.0, 180.5, 310.25)):
+                combined_data, features = self.apply_result(self.store, mrn, f'202406{day + 10}0930{i % 60:02d}', result + i)
+                test_data, _ = build_test_data(combined_data.copy())
+                np.testing.assert_array_equal(test_data.to_numpy(dtype=np.float32), features)
+                rate = {'positive': 0, 'negative': 0, 'rate': 0}
+                prediction, _, _, _ = predict_aki(self.model, combined_data, dict(rate))
+                self.assertEqual(predict_features(self.model, features, dict(rate))[0][0], prediction[0])
+
+    # Checks that restored and copy-on-write patients get the same feature rows
+    def test_features_after_restore(self):
+        for mrn in self.mrns:
+            self.store.append_result(mrn, hl7_to_epoch('20240610093000'), 150.0)
+        restored = PatientStore.from_columns(columns_from_capture(self.store.capture()))
+        for mrn in self.mrns:
+            np.testing.assert_array_equal(restored.feature_row(mrn), self.store.feature_row(mrn))
+        directory = tempfile.mkdtemp()
+        try:
+            compile_history('history.csv', os.path.join(directory, 'history.compiled'))
+            layered = PatientStore(base=open_history_base(os.path.join(directory, 'history.compiled')))
+            reference = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+            for mrn in self.mrns[:-1]:
+                np.testing.assert_array_equal(layered.feature_row(mrn), reference.feature_row(mrn))
+        finally:
+            shutil.rmtree(directory)
+
+class InferenceEngineTesting(unittest.TestCase):
+    def setUp(self):
+        self.model = load_model('aki_model.json')
+        store = PatientStore.from_dataframe(load_and_process_history('history.csv'))
+        self.features = np.concatenate([store.feature_row(mrn) for mrn in store.mrns()[::5]])
+
+    # Checks that in-place Booster predictions match the XGBClassifier row by row
+    def test_matches_classifier(self):
+        engine = InferenceEngine('aki_model.json')
+        for i in range(len(self.features)):
+            row = self.features[i:i + 1]
+            self.assertEqual(engine.predict(row)[0], self.model.predict(row)[0])
+            self.assertAlmostEqual(float(engine.predict_proba(row)[0]), float(self.model.predict_proba(row)[0, 1]), places=6)
+
+    # Checks that the decision threshold is configurable
+    def test_threshold(self):
+        probabilities = InferenceEngine('aki_model.json').predict_proba(self.features)
+        self.assertEqual(InferenceEngine('aki_model.json', threshold=0.9).predict(self.features).sum(), (probabilities > 0.9).sum())
+        self.assertEqual(InferenceEngine('aki_model.json', threshold=1.0, warmup=0).predict(self.features).sum(), 0)
+
+class MicroBatchTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.historical_data = load_and_process_history('history.csv')
+        self.messages = [b'MSH|garbage']
+        for i, mrn in enumerate(self.historical_data['mrn'].iloc[::70].tolist() + ['12345678']):
+            header = 'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240610093000||'
+            if i % 2:
+                self.messages.append(f'{header}ADT^A01|||2.5\rPID|1||{mrn}||JANE DOE||19600101|F\r'.encode())
+            for j, result in enumerate((90.0, 240.5)):
+                self.messages.append(f'{header}ORU^R01|||2.5\rPID|1||{mrn}\rOBR|1||||||2024061{j}0930{i % 60:02d}\rOBX|1|SN|CREATININE||{result + i}\r'.encode())
+
+    def start(self, name):
+        # fresh module state for app.handle_message/handle_batch
+        directory = os.path.join(self.directory, name)
+        app.patient_store = PatientStore.from_dataframe(self.historical_data.copy())
+        app.patient_journal = Journal(directory, fsync=False)
+        app.patient_snapshotter = Snapshotter(directory, app.patient_store, app.patient_journal, interval=3600)
+        return {
+            'model': load_engine('aki_model.json'),
+            'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+            'input_quantiles': RollingQuantiles(),
+            'recorded_predictions': [],
+        }
+
+    # Checks that each message records one sample per stage it goes through: the row lookup and the store update apart
+    def test_message_stages(self):
+        state = self.start('stages')
+        samples = metrics.collect_stage_samples()
+        try:
+            app.handle_batch(self.messages, state)
+        finally:
+            metrics.collect_stage_samples(False)
+        app.patient_journal.close()
+        admissions = sum(b'ADT^A01' in message for message in self.messages)
+        results = sum(b'ORU^R01' in message for message in self.messages)
+        self.assertEqual(len(samples['parse']), len(self.messages))
+        self.assertEqual(len(samples['lookup']), admissions + results)
+        self.assertEqual(len(samples['update']), admissions + results)
+        self.assertEqual(len(samples['features']), results)
+
+    # Checks that scoring micro-batches gives the same results, in order, as one message at a time
+    def test_batches_match_single_messages(self):
+        state = self.start('single')
+        single = [app.handle_message(message, state) for message in self.messages]
+        app.patient_journal.close()
+        batched_state = self.start('batched')
+        batched = []
+        for i in range(0, len(self.messages), 16):
+            batched += app.handle_batch(self.messages[i:i + 16], batched_state)
+        app.patient_journal.close()
+        self.assertEqual(batched, single)
+        self.assertEqual(batched_state['recorded_predictions'], state['recorded_predictions'])
+        self.assertEqual(batched_state['prediction_rate_dic'], state['prediction_rate_dic'])
+        self.assertFalse(single[0][0])
+        self.assertTrue(any(page is not None for _, page in single))
+
+    # Checks that a replay ages the input window by the messages' test times, not the wall clock
+    def test_message_time_window(self):
+        state = self.start('replay')
+        state['message_time'] = True
+        state['input_quantiles'] = RollingQuantiles(window=3600)
+        # a replayed feed arrives in test time order, the window evicts in arrival order
+        results = sorted((m for m in self.messages if b'ORU^R01' in m), key=lambda m: m.split(b'|||||')[1][:14])
+        app.handle_batch(results, state)
+        app.patient_journal.close()
+        # the results of the last day are the only ones within an hour of the last test time
+        last_day = [float(m.rsplit(b'|', 1)[1]) for m in results if b'|||||20240611' in m]
+        self.assertEqual(len(state['input_quantiles']), len(last_day))
+        self.assertEqual(state['input_quantiles'].median(hl7_to_epoch('20240611093100')), np.median(last_day))
+
+    # Checks that the input quantile gauges of a message time replay are read at the last message time, not the wall clock
+    def test_message_time_gauges(self):
+        self.start('gauges')
+        state = app.detector_state('aki_model.json', DEFAULT_THRESHOLD, 3600, [])
+        state['message_time'] = True
+        results = sorted((m for m in self.messages if b'ORU^R01' in m), key=lambda m: m.split(b'|||||')[1][:14])
+        app.handle_batch(results, state)
+        app.patient_journal.close()
+        last_day = [float(m.rsplit(b'|', 1)[1]) for m in results if b'|||||20240611' in m]
+        # the replayed results are months old, a wall clock window would have evicted all of them
+        self.assertEqual(REGISTRY.get_sample_value('median_input'), np.median(last_day))
+        self.assertEqual(len(state['input_quantiles']), len(last_day))
+        self.assertEqual(REGISTRY.get_sample_value('input_p95'), np.percentile(last_day, 95))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class BackfillTesting(unittest.TestCase):
+    def setUp(self):
+        import simulator
+        self.directory = tempfile.mkdtemp()
+        self.historical_data = load_and_process_history('history.csv')
+        self.base = HistoryBase(sort_columns(columns_from_history(load_history_arrays('history.csv'))))
+        self.messages = [b'MSH|garbage']
+        for i, mrn in enumerate(self.historical_data['mrn'].iloc[::40].tolist()):
+            header = 'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240610093000||'
+            if i % 2:
+                self.messages.append(f'{header}ADT^A01|||2.5\rPID|1||{mrn}||JANE DOE||19600101|F\r'.encode())
+            for j, result in enumerate((90.0, 240.5, 400.0)):
+                self.messages.append(f'{header}ORU^R01|||2.5\rPID|1||{mrn}\rOBR|1||||||2024061{j}0930{i % 60:02d}\rOBX|1|SN|CREATININE||{result + i}\r'.encode())
+        self.messages += list(itertools.islice(simulator.generate_hl7_messages(300, seed=5, aki_fraction=0.3), 3000))
+        self.capture = os.path.join(self.directory, 'messages.mllp')
+        with open(self.capture, 'wb') as file:
+            file.write(b''.join(simulator.to_mllp_frame(message) for message in self.messages))
+
+    # Checks that the offline backfill flags the same results as the streaming detector on the same capture
+    def test_matches_streaming(self):
+        app.patient_store = PatientStore.from_dataframe(self.historical_data.copy())
+        app.patient_journal = Journal(os.path.join(self.directory, 'state'), fsync=False)
+        app.patient_snapshotter = Snapshotter(os.path.join(self.directory, 'state'), app.patient_store, app.patient_journal, interval=3600)
+        state = {
+            'model': load_engine('aki_model.json'),
+            'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+            'input_quantiles': RollingQuantiles(),
+            'recorded_predictions': [],
+        }
+        for i in range(0, len(self.messages), 64):
+            app.handle_batch(self.messages[i:i + 64], state)
+        app.patient_journal.close()
+        self.assertEqual(list(read_capture(self.capture)), self.messages)
+        predictions, stats = backfill(read_capture(self.capture), self.base, load_engine('aki_model.json'), batch_rows=500)
+        self.assertEqual(stats['messages'], len(self.messages))
+        self.assertEqual(stats['skipped'], 1)
+        self.assertGreater(len(predictions), 0)
+        self.assertEqual(predictions.to_dict('records'), state['recorded_predictions'])
+        report = check_aki_detection_accuracy(predictions.copy(), pd.DataFrame(state['recorded_predictions']).rename(columns={'prediction_date': 'date'}))
+        self.assertEqual(report['F3'], 1.0)
+
+    # Checks that the streamed capture skips bytes outside frames and a truncated last frame, as MLLPFramer does
+    def test_read_capture_resync(self):
+        frames = [b'\x0b' + message + b'\x1c\r' for message in self.messages[:3]]
+        capture = os.path.join(self.directory, 'noisy.mllp')
+        with open(capture, 'wb') as file:
+            file.write(b'\r\n' + frames[0] + b'junk' + frames[1] + frames[2][:-5])
+        framer = MLLPFramer()
+        framer.feed(b'\r\n' + frames[0] + b'junk' + frames[1] + frames[2][:-5])
+        self.assertEqual(list(read_capture(capture)), self.messages[:2])
+        self.assertEqual(list(read_capture(capture)), list(framer))
+
+    # Checks that events are applied in event time order per patient, not in capture order
+    def test_event_time_order(self):
+        header = 'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{}||'
+        messages = [
+            f'{header.format("20240610100000")}ORU^R01|||2.5\rPID|1||12345678\rOBR|1||||||20240610100000\rOBX|1|SN|CREATININE||95.5\r'.encode(),
+            f'{header.format("20240610090000")}ADT^A01|||2.5\rPID|1||12345678||JANE DOE||19600101|F\r'.encode(),
+            f'{header.format("20240610080000")}ORU^R01|||2.5\rPID|1||12345678\rOBR|1||||||20240610080000\rOBX|1|SN|CREATININE||80.0\r'.encode(),
+        ]
+        events, _ = parse_capture(messages, today=datetime(2024, 6, 10))
+        results, features = feature_matrix(events, self.base)
+        self.assertEqual(results.tolist(), [2, 0])
+        # the earlier result has no admission yet, the later one is scored after it with the earlier result before it
+        self.assertTrue(np.isnan(features[0, 0]))
+        self.assertEqual(features[1, :4].tolist(), [64.0, 1.0, 95.5, 0.0])
+        self.assertEqual(features[1, 4:6].tolist(), [80.0, 7200.0])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class RollingQuantilesTesting(unittest.TestCase):
+    # Checks the median and p5/p95 against numpy over the values still in the window, across block splits and evictions
+    def test_matches_numpy(self):
+        rng = np.random.default_rng(0)
+        window = RollingQuantiles(window=600)
+        times = np.cumsum(rng.uniform(0, 0.5, 5000))
+        values = np.round(rng.normal(100, 30, 5000), 1)
+        for i, (now, value) in enumerate(zip(times, values)):
+            window.add(value, now)
+            if i % 97 == 0:
+                recent = values[:i + 1][times[:i + 1] > now - 600]
+                self.assertEqual(len(window), len(recent))
+                for q in (0.05, 0.5, 0.95):
+                    self.assertAlmostEqual(window.quantile(q, now), np.quantile(recent, q), places=9)
+        self.assertEqual(window.median(times[-1]), np.median(values[times > times[-1] - 600]))
+
+    # Checks that values expire from the window even when nothing new arrives
+    def test_eviction(self):
+        window = RollingQuantiles(window=60)
+        self.assertTrue(np.isnan(window.median(0)))
+        for i, value in enumerate((5.0, 1.0, 3.0)):
+            window.add(value, i * 30)
+        self.assertEqual(window.median(60), 2.0)
+        self.assertTrue(np.isnan(window.median(1000)))
+        self.assertEqual(len(window), 0)
+
+def random_hl7_message(rng):
+    # each field is well-formed most of the time and otherwise malformed; versions stay valid because
+    # the regex parser also accepts a version number found in a later segment, e.g. an OBX value like 85.69
+    def pick(valid, malformed):
+        return valid if rng.random() < 0.85 else rng.choice(malformed)
+    message_type = rng.choice(['ADT^A01', 'ADT^A03', 'ORU^R01', 'ORU^R01'])
+    msh = ['MSH', '^~\\&', 'SIMULATION', 'SOUTH RIVERSIDE', '', '', pick('20240401100000', ['202404011000', '2024040110000x', '']), '',
+           pick(message_type, ['ADT^A01^ADT_A01', 'ORU^R01X', 'ADT^A02', 'ACK', '']), '', '', rng.choice(['2.5', '2.5.1', '2.3'])]
+    pid = ['PID', pick('1', ['', 'x']), pick('', ['7']), pick('822825', ['8228A5', 'A1', '']), '', pick('JOHN DOE', ['']), '',
+           pick('19500203', ['1950020', '']), pick(rng.choice(['M', 'F']), ['MALE', 'U', ''])]
+    segments = ['|'.join(msh), '|'.join(pid if message_type == 'ADT^A01' else pid[:4])]
+    if message_type == 'ADT^A01':
+        segments.append('NK1|1|X|PARTNER')
+    if message_type == 'ORU^R01':
+        segments.append('|'.join(['OBR', pick('1', ['']), '', '', '', '', pick('', ['x']),
+                                  pick('20240401100000', ['2024040110000', '2024040110000059'])]))
+        for i in range(pick(1, [0, 2, 3])):
+            segments.append('|'.join(['OBX', pick(str(i + 1), ['']), pick('SN', ['']), pick('CREATININE', ['SODIUM', '']), '',
+                                      pick(rng.choice(['85.69', '103']), ['.5', '1e3', 'abc', ''])]))
+    separator = pick('\r', ['\r\n'])
+    return (separator.join(segments) + pick(separator, [''])).encode()
+
+
+class StageMetricsTesting(unittest.TestCase):
+    # Checks that timed() records one observation per block or call in the stage's histogram
+    def test_timed(self):
+        metrics.configure_stage_buckets({'test_timed': (0.001, 1.0)})
+        @metrics.timed('test_timed')
+        def stage(value):
+            return value * 2
+        self.assertEqual(stage(21), 42)
+        with metrics.timed('test_timed'):
+            pass
+        with self.assertRaises(KeyError):
+            with metrics.timed('test_timed'):
+                raise KeyError('the block failed')
+        self.assertEqual(REGISTRY.get_sample_value('stage_test_timed_latency_seconds_count'), 3)
+        self.assertEqual(REGISTRY.get_sample_value('stage_test_timed_latency_seconds_bucket', {'le': '0.001'}), 3)
+
+    # Checks that bucket sets can only change before the stage is first observed
+    def test_configure_after_use(self):
+        metrics.configure_stage_buckets({'test_configure': (0.1, 1.0)})
+        metrics.observe('test_configure', 0.5)
+        with self.assertRaises(ValueError):
+            metrics.configure_stage_buckets({'test_configure': (1.0,)})
+        self.assertEqual(app.parse_stage_buckets('predict=0.01,0.001'), ('predict', (0.01, 0.001)))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            app.parse_stage_buckets('unknown=0.1')
+
+    # Checks that /ready answers 503 while loading and 200 once ready, next to the metrics
+    def test_readiness(self):
+        loaded = threading.Event()
+        server = metrics.start_metrics_server(0, loaded.is_set)
+        url = f'http://localhost:{server.server_address[1]}'
+        try:
+            with self.assertRaises(urllib.error.HTTPError) as loading:
+                urllib.request.urlopen(url + '/ready')
+            self.assertEqual(loading.exception.code, 503)
+            loaded.set()
+            self.assertEqual(urllib.request.urlopen(url + '/ready').read(), b'ready\n')
+            self.assertIn(b'startup_phase_seconds', urllib.request.urlopen(url + '/metrics').read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class Hl7ParserTesting(unittest.TestCase):
+    # Checks that the byte-level parser returns what the regex parser did for a corpus of generated messages
+    def test_parity_with_regex_parser(self):
+        rng = random.Random(0)
+        # the regex parser backtracks for up to 0.15s on a message with a malformed MSH, keep the corpus small
+        for _ in range(1000):
+            message = random_hl7_message(rng)
+            parsed, message_type = parse_hl7_message(message)
+            try:
+                expected, expected_type = parse_hl7_message_regex(message)
+            except TypeError:
+                # the regex parser crashed on a PID segment it could not match, this is now a parse failure
+                self.assertEqual((parsed, message_type), (None, 'ADT' if b'|ADT^' in message else 'ORU'), message)
+                continue
+            if parsed is not None:
+                observations = parsed.pop('observations', None)
+                if observations is not None:
+                    self.assertEqual(observations[0], (parsed['test_type'], parsed['test_result']))
+            self.assertEqual((parsed, message_type), (expected, expected_type), message)
+
+    # Checks that every OBX segment of an ORU is returned
+    def test_multiple_observations(self):
+        message = (b'MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240401100000||ORU^R01|||2.5\r'
+                   b'PID|1||822825\rOBR|1||||||20240401100000\r'
+                   b'OBX|1|SN|CREATININE||85.69\rOBX|2|SN|SODIUM||140\r')
+        parsed, message_type = parse_hl7_message(memoryview(message))
+        self.assertEqual(message_type, 'ORU')
+        self.assertEqual((parsed['pid'], parsed['test_time'], parsed['test_type'], parsed['test_result']),
+                         ('822825', '20240401100000', 'CREATININE', '85.69'))
+        self.assertEqual(parsed['observations'], [('CREATININE', '85.69'), ('SODIUM', '140')])
+
+    # Checks that truncated and corrupted messages are rejected or parsed, never raise
+    def test_corrupted_messages(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            message = bytearray(random_hl7_message(rng))
+            for _ in range(rng.randint(1, 4)):
+                position = rng.randrange(len(message) + 1)
+                if rng.random() < 0.5:
+                    del message[position:position + rng.randint(1, 8)]
+                else:
+                    message[position:position] = rng.choice([b'|', b'\r', b'\n', b'0', b'.', b'MSH|', b'OBX|', b'^'])
+            parsed, message_type = parse_hl7_message(bytes(message))
+            self.assertIn(message_type, ('ADT', 'ORU', 'Invalid Message Format'))
+            self.assertTrue(parsed is None or 'pid' in parsed)
+
 class Hl7MessageServiceTesting(unittest.TestCase):
     def setUp(self):
         start_listener("0.0.0.0:8440")
@@ -79,6 +1079,338 @@ class Hl7MessageServiceTesting(unittest.TestCase):
     def tearDown(self):
         close_connection()
 
+class PagerHandler(BaseHTTPRequestHandler):
+    # keep-alive, answers with the status codes queued in server.statuses and then 200
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if getattr(self.server, 'gate', None) is not None:
+            # held until the test lets the pager answer
+            self.server.gate.wait(5)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.server.requests.append((self.client_address[1], body, status))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class PagerDispatcherTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PagerHandler)
+        self.server.statuses, self.server.requests = [], []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pager = f'127.0.0.1:{self.server.server_address[1]}'
+
+    # Checks that pages are delivered in order over one connection, with 5xx responses retried and 4xx given up
+    def test_delivery_and_retries(self):
+        self.server.statuses = [503, 500, 400]
+        delivered = REGISTRY.get_sample_value('stage_delivery_latency_seconds_count') or 0
+        dispatcher = PagerDispatcher(self.pager, self.directory, backoff=0.01, fsync=False)
+        dispatcher.submit('1001', '2024-04-29 05:41:00')
+        dispatcher.submit('1002', '2024-04-29 05:42:00')
+        self.assertTrue(dispatcher.wait_delivered(5))
+        dispatcher.close()
+        # only the accepted page has a delivery latency
+        self.assertEqual(REGISTRY.get_sample_value('stage_delivery_latency_seconds_count') - delivered, 1)
+        self.assertEqual([(body, status) for _, body, status in self.server.requests],
+                         [('1001,20240429054100', 503), ('1001,20240429054100', 500), ('1001,20240429054100', 400),
+                          ('1002,20240429054200', 200)])
+        self.assertEqual(len({port for port, _, _ in self.server.requests}), 1)
+        self.assertEqual(read_pending_pages(os.path.join(self.directory, 'pages.log')), [])
+
+    # Checks that pages the pager did not accept before shutdown are sent after a restart
+    def test_pending_pages_survive_restart(self):
+        self.server.statuses = [503] * 1000
+        dispatcher = PagerDispatcher(self.pager, self.directory, backoff=0.01, max_backoff=0.01)
+        dispatcher.submit('1001', '2024-04-29 05:41:00')
+        dispatcher.submit('1002', '2024-04-29 05:42:00')
+        dispatcher.close(timeout=0.1)
+        self.assertEqual([body for _, body in read_pending_pages(os.path.join(self.directory, 'pages.log'))],
+                         ['1001,20240429054100', '1002,20240429054200'])
+
+        self.server.statuses, self.server.requests = [], []
+        dispatcher = PagerDispatcher(self.pager, self.directory)
+        dispatcher.submit('1003', '2024-04-29 05:43:00')
+        self.assertTrue(dispatcher.wait_delivered(5))
+        dispatcher.close()
+        self.assertEqual([body for _, body, _ in self.server.requests],
+                         ['1001,20240429054100', '1002,20240429054200', '1003,20240429054300'])
+
+    # Checks that the pages file is compacted at runtime while a page stays pending, instead of growing with every page
+    def test_pages_file_compacted(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        path = os.path.join(self.directory, 'pages.log')
+        # the pager is down: the first page keeps failing while later pages are done
+        dispatcher = PagerDispatcher(f'127.0.0.1:{port}', self.directory, backoff=60, fsync=False, compact_bytes=256)
+        dispatcher.submit('1000', '2024-04-29 05:41:00')
+        for i in range(1, 200):
+            dispatcher.submit(str(1000 + i), '2024-04-29 05:41:00')
+            dispatcher._done(i + 1)
+            self.assertLess(os.path.getsize(path), 300)
+        self.assertEqual([body for _, body in read_pending_pages(path)], ['1000,20240429054100'])
+        dispatcher.close(timeout=0)
+        self.assertEqual([body for _, body in read_pending_pages(path)], ['1000,20240429054100'])
+
+    # Checks that a page submitted while the previous one is being delivered is never truncated out of the pages file
+    def test_concurrent_submit_and_delivery(self):
+        self.server.gate = threading.Event()
+        self.server.statuses = [200] + [503] * 1000
+        dispatcher = PagerDispatcher(self.pager, self.directory, backoff=0.01, max_backoff=0.01, fsync=False)
+        dispatcher.submit('1001', '2024-04-29 05:41:00')
+        lock, gate = dispatcher._lock, self.server.gate
+
+        class DeliverOnRelease:
+            # the first time submit() releases the lock, let the delivery of 1001 finish before it carries on
+            armed = True
+
+            def __enter__(self):
+                lock.acquire()
+
+            def __exit__(self, *exc):
+                lock.release()
+                if DeliverOnRelease.armed and threading.current_thread() is threading.main_thread():
+                    DeliverOnRelease.armed = False
+                    gate.set()
+                    deadline = time.time() + 5
+                    while 1 in dispatcher._pending and time.time() < deadline:
+                        time.sleep(0.001)
+
+        dispatcher._lock = DeliverOnRelease()
+        dispatcher.submit('1002', '2024-04-29 05:42:00')
+        self.assertNotIn(1, dispatcher._pending)
+        dispatcher.close(timeout=0.1)
+        self.assertEqual([body for _, body in read_pending_pages(os.path.join(self.directory, 'pages.log'))], ['1002,20240429054200'])
+
+    # Checks that a pager that never answers times out instead of stalling delivery
+    def test_timeout(self):
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        dispatcher = PagerDispatcher(f'127.0.0.1:{silent.getsockname()[1]}', self.directory, timeout=(0.1, 0.1), backoff=10)
+        dispatcher.submit('1001', '2024-04-29 05:41:00')
+        start = time.time()
+        dispatcher.close(timeout=0.3)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(read_pending_pages(os.path.join(self.directory, 'pages.log'))), 1)
+        silent.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+class ShardingTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    # Checks that messages are routed by the MRN the parser reads, with a hash that is stable across processes
+    def test_routing(self):
+        rng = random.Random(1)
+        for _ in range(1000):
+            message = random_hl7_message(rng)
+            parsed, _ = parse_hl7_message(message)
+            if parsed is not None:
+                self.assertEqual(sharding.message_mrn(message), extract_mrn(parsed))
+        self.assertEqual(sharding.message_mrn(b'MSH|^~\\&|||||20240401100000||ORU^R01|||2.5\nPID|1||822825abc\n'), '822825')
+        self.assertEqual(sharding.message_mrn(b'MSH|^~\\&'), '')
+        self.assertEqual([sharding.shard_of(mrn, 4) for mrn in ('822825', '16318', '')], [1, 3, 0])
+
+    # Checks that each shard keeps exactly its patients' results
+    def test_shard_history(self):
+        history = load_history_arrays('history.csv')
+        shards = [sharding.shard_history(history, shard, 3) for shard in range(3)]
+        self.assertEqual(sum(len(shard['mrns']) for shard in shards), len(history['mrns']))
+        self.assertEqual(sum(len(shard['results']) for shard in shards), len(history['results']))
+        for shard, part in enumerate(shards):
+            self.assertTrue(all(sharding.shard_of(mrn, 3) == shard for mrn in part['mrns']))
+            self.assertEqual(part['length'].sum(), len(part['timestamps']))
+
+    # Checks that a state directory is only started with the number of shards it was written with
+    def test_layout(self):
+        sharding.check_layout(self.directory, 2)
+        sharding.check_layout(self.directory, 2)
+        with self.assertRaises(ValueError):
+            sharding.check_layout(self.directory, 4)
+        with self.assertRaises(ValueError):
+            sharding.check_layout(self.directory, 0)
+        unsharded = os.path.join(self.directory, 'unsharded')
+        Journal(unsharded, fsync=False).close()
+        with self.assertRaises(ValueError):
+            sharding.check_layout(unsharded, 2)
+
+    # Checks that the workers page what the in-process detector pages, that ACKs come back in message order
+    # and that a message's page is recorded before its ACK is sent
+    def test_workers_match_in_process_detector(self):
+        import simulator
+        generated = simulator.generate_hl7_messages(300, seed=3, mrn_start=100000, aki_fraction=0.3)
+        messages = [simulator.with_control_id(message, str(i).encode())[0] for i, message in enumerate(itertools.islice(generated, 1500))]
+
+        app.patient_store = PatientStore.from_columns(columns_from_history(load_history_arrays('history.csv')))
+        app.patient_journal = Journal(os.path.join(self.directory, 'reference'), fsync=False)
+        app.patient_snapshotter = Snapshotter(self.directory, app.patient_store, app.patient_journal, interval=float('inf'))
+        state = {'model': load_engine('aki_model.json'), 'prediction_rate_dic': {"positive": 0, "negative": 0, "rate": 0.0},
+                 'input_quantiles': RollingQuantiles(), 'recorded_predictions': [], 'message_time': True}
+        results = app.handle_batch(messages, state)
+        expected = [page for _, page in results if page is not None]
+        paged = [i for i, (_, page) in enumerate(results) if page is not None]
+        app.patient_journal.close()
+        self.assertTrue(expected)
+
+        workers = sharding.start_workers(2, {
+            'history': 'history.csv', 'state_dir': os.path.join(self.directory, 'sharded'), 'commit_interval': 0.001,
+            'snapshot_interval': float('inf'), 'model': 'aki_model.json', 'threshold': DEFAULT_THRESHOLD,
+            'input_window': DEFAULT_WINDOW, 'message_time': True})
+        server, client = socket.socketpair()
+        client.setblocking(False)
+        pages = []
+        try:
+            engine = threading.Thread(target=sharding.run, args=(client, workers, lambda *page: pages.append(page)), kwargs={'batch_size': 16})
+            engine.start()
+            server.sendall(b''.join(b'\x0b' + m + b'\x1c\x0d' for m in messages))
+            server.shutdown(socket.SHUT_WR)
+            acks = b''
+            while True:
+                data = server.recv(65536)
+                if not data:
+                    break
+                acks += data
+                acknowledged = acks.count(b'MSA|AA')
+                self.assertGreaterEqual(len(pages), sum(1 for i in paged if i < acknowledged))
+            engine.join()
+        finally:
+            sharding.stop_workers(workers)
+            server.close()
+        self.assertEqual([segment for segment in acks.split(b'\r') if segment.startswith(b'MSA')],
+                         [f'MSA|AA|{i}'.encode() for i in range(len(messages))])
+        self.assertEqual(sorted(pages), sorted(expected))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'sharded'))), ['shard-000', 'shard-001'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class ClusterTesting(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+
+    def replica(self, name, handle=None):
+        # a replica with its own store and journal: a handoff server, and an MLLP server appending the results of `handle`
+        store = PatientStore()
+        journal = Journal(os.path.join(self.directory, name), fsync=False)
+        handoff = cluster.serve_handoff('localhost:0', store, journal)
+        mllp = ingestion.listen('localhost:0')
+        self.servers += [handoff, mllp]
+
+        def handle_message(message):
+            try:
+                store.append_result(*handle(message))
+            except ValueError:
+                return False, None
+            return True, None
+
+        def serve():
+            while True:
+                try:
+                    sock, _ = mllp.accept()
+                except OSError:
+                    return
+                sock.setblocking(False)
+                ingestion.run(sock, handle_message, lambda *page: None,
+                              durability=journal, reject_failed=True)
+
+        threading.Thread(target=serve, daemon=True).start()
+        address = lambda server: f'localhost:{server.getsockname()[1]}'
+        return store, journal, (address(mllp), address(handoff))
+
+    # Checks that the ring spreads patients evenly and that adding a replica only moves patients to it
+    def test_ring(self):
+        mrns = [str(mrn) for mrn in range(100000, 130000)]
+        ring = cluster.HashRing(['a', 'b', 'c'])
+        owners = [ring.owner(mrn) for mrn in mrns]
+        for node in ring.nodes:
+            self.assertGreater(owners.count(node), len(mrns) / 3 * 0.7)
+        grown = cluster.HashRing(['a', 'b', 'c', 'd'])
+        moved = [(old, grown.owner(mrn)) for mrn, old in zip(mrns, owners) if grown.owner(mrn) != old]
+        self.assertTrue(all(new == 'd' for _, new in moved))
+        self.assertLess(len(moved), len(mrns) / 4 * 1.3)
+        with self.assertRaises(ValueError):
+            cluster.HashRing([]).owner('822825')
+
+    # Checks that a handed over patient is journaled and replaces what the store held, idempotently
+    def test_patient_record(self):
+        store = PatientStore()
+        store.admit('822825', '19700101', 'F', today=pd.Timestamp('2024-04-01'))
+        for timestamp, result in ((100, 80.5), (200, 120.25), (300, 95.0)):
+            store.append_result('822825', timestamp, result)
+        state = store.patient_state('822825')
+        record = decode(encode_patient('822825', *state))
+        self.assertEqual(record[1], '822825')
+        np.testing.assert_array_equal(record[2][2], [100, 200, 300])
+
+        journal = Journal(self.directory, fsync=False)
+        journal.append_result('822825', 50, 999.0)
+        journal.append_patient('822825', *state)
+        journal.append_patient('822825', *state)
+        journal.close()
+        restored = PatientStore()
+        replay_journal(self.directory, restored)
+        for restored_value, value in zip(restored.patient_state('822825'), state):
+            np.testing.assert_array_equal(restored_value, value)
+        np.testing.assert_array_equal(restored.feature_row('822825'), store.feature_row('822825'))
+
+    # Checks that after growing the ring mid-stream every patient's whole series is on its owner, in order
+    def test_router_resize(self):
+        handle = lambda message: (sharding.message_mrn(message), int(control_id(message)), float(message.rsplit(b'|', 1)[1]))
+        replicas = {name: self.replica(name, handle) for name in ('a', 'b', 'c')}
+        rng = random.Random(5)
+        messages = [f'MSH|^~\\&|||||20240401100000||ORU^R01|{i}||2.5\rPID|1||{rng.randrange(1000, 1100)}\rOBX|1|SN|CREATININE||{rng.uniform(50, 150):.2f}'.encode()
+                    for i in range(600)]
+        messages[10] = b'MSH|^~\\&|||||20240401100000||ORU^R01|10||2.5\rPID|1||1000\rOBX|1|SN|CREATININE||not a number'
+
+        router = cluster.Router({name: replicas[name][2] for name in ('a', 'b')})
+        upstream, client = socket.socketpair()
+        client.setblocking(False)
+        engine = threading.Thread(target=asyncio.run, args=(router.run(client),))
+        engine.start()
+        upstream.sendall(b''.join(b'\x0b' + message + b'\x1c\x0d' for message in messages[:300]))
+        acks = b''
+        while acks.count(b'MSA|AA') < 299:
+            acks += upstream.recv(65536)
+        moved = asyncio.run_coroutine_threadsafe(router.resize({name: address for name, (_, _, address) in replicas.items()}), router.loop).result()
+        self.assertGreater(moved, 0)
+        upstream.sendall(b''.join(b'\x0b' + message + b'\x1c\x0d' for message in messages[300:]))
+        upstream.shutdown(socket.SHUT_WR)
+        while True:
+            data = upstream.recv(65536)
+            if not data:
+                break
+            acks += data
+        engine.join()
+        upstream.close()
+
+        # the message that failed on its replica is not acknowledged, every other one is, in order
+        self.assertEqual([segment for segment in acks.split(b'\r') if segment.startswith(b'MSA')],
+                         [f'MSA|AA|{i}'.encode() for i in range(len(messages)) if i != 10])
+        expected = {}
+        for message in messages[:10] + messages[11:]:
+            mrn, timestamp, result = handle(message)
+            expected.setdefault(mrn, []).append((timestamp, np.float32(result)))
+        for mrn, series in expected.items():
+            timestamps, results = replicas[router.ring.owner(mrn)][0].series(mrn)
+            self.assertEqual(list(zip(timestamps, results)), series)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        shutil.rmtree(self.directory)
+
 class PagerSystemTesting(unittest.TestCase):
     def setUp(self):
         start_listener("0.0.0.0:8440")